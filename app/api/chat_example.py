@@ -3,58 +3,82 @@ Ejemplo de uso del endpoint de chat
 Muestra cómo hacer peticiones al endpoint /api/chat
 """
 
+import asyncio
+import aiohttp
 import requests
-import json
+import orjson
 import time
-from typing import Dict, Any
+from typing import Dict, Any, Tuple
+from requests.adapters import HTTPAdapter
 
-def test_chat_endpoint(base_url: str = "http://localhost:7071") -> None:
+# Sesión HTTP compartida para reutilizar conexiones (keep-alive) entre peticiones
+SESSION = requests.Session()
+SESSION.mount("http://", HTTPAdapter(pool_connections=4, pool_maxsize=10))
+SESSION.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=10))
+SESSION.headers.update({"Content-Type": "application/json"})
+
+# Preguntas de prueba
+TEST_QUESTIONS = (
+    "¿Qué es la inteligencia artificial?",
+    "¿Cuáles son los diferentes tipos de machine learning?",
+    "¿Cómo funciona el deep learning?",
+    "¿Qué es el procesamiento de lenguaje natural?"
+)
+
+HEADERS = {"Content-Type": "application/json"}
+
+async def _post_question(session: aiohttp.ClientSession, url: str, payload: bytes) -> Tuple[int, str, float]:
+    """
+    Enviar una pregunta ya serializada al endpoint de chat y medir el tiempo total de la petición
+    """
+    start_time = time.perf_counter()
+    async with session.post(url, data=payload, headers=HEADERS) as response:
+        text = await response.text()
+        return response.status, text, time.perf_counter() - start_time
+
+async def test_chat_endpoint(base_url: str = "http://localhost:7071") -> None:
     """
     Probar el endpoint de chat con diferentes preguntas
+    Las preguntas se envían de forma concurrente y se imprimen en orden
     """
     print("🚀 Probando endpoint de chat...")
     print(f"URL base: {base_url}")
     print("=" * 60)
     
-    # Preguntas de prueba
-    test_questions = [
-        "¿Qué es la inteligencia artificial?",
-        "¿Cuáles son los diferentes tipos de machine learning?",
-        "¿Cómo funciona el deep learning?",
-        "¿Qué es el procesamiento de lenguaje natural?"
-    ]
+    url = f"{base_url}/api/chat"
+    
+    # Serializar todos los payloads antes de lanzar las peticiones
+    payloads = [orjson.dumps({"question": question}) for question in TEST_QUESTIONS]
+    
+    # Hacer todas las peticiones en paralelo sobre una única sesión
+    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=0)) as session:
+        responses = await asyncio.gather(
+            *[_post_question(session, url, payload) for payload in payloads],
+            return_exceptions=True
+        )
     
-    for i, question in enumerate(test_questions, 1):
+    for i, (question, response) in enumerate(zip(TEST_QUESTIONS, responses), 1):
         print(f"\n📝 Pregunta {i}: {question}")
         
         try:
-            # Preparar la petición
-            url = f"{base_url}/api/chat"
-            payload = {
-                "question": question
-            }
-            headers = {
-                "Content-Type": "application/json"
-            }
+            if isinstance(response, BaseException):
+                raise response
             
-            # Hacer la petición
-            start_time = time.time()
-            response = requests.post(url, json=payload, headers=headers)
-            end_time = time.time()
+            status, text, elapsed = response
             
             # Procesar la respuesta
-            if response.status_code == 200:
-                result = response.json()
+            if status == 200:
+                result = orjson.loads(text)
                 print(f"✅ Respuesta exitosa:")
                 print(f"   Respuesta: {result.get('answer', '')[:200]}...")
                 print(f"   Tiempo de procesamiento: {result.get('processing_time_seconds', 0):.2f}s")
                 print(f"   Documentos recuperados: {result.get('documents_retrieved', 0)}")
-                print(f"   Tiempo total (incluyendo red): {end_time - start_time:.2f}s")
+                print(f"   Tiempo total (incluyendo red): {elapsed:.2f}s")
             else:
-                print(f"❌ Error HTTP {response.status_code}:")
-                print(f"   {response.text}")
+                print(f"❌ Error HTTP {status}:")
+                print(f"   {text}")
                 
-        except requests.exceptions.RequestException as e:
+        except aiohttp.ClientError as e:
             print(f"❌ Error de conexión: {str(e)}")
         except Exception as e:
             print(f"❌ Error inesperado: {str(e)}")
@@ -72,7 +96,7 @@ def test_invalid_requests(base_url: str = "http://localhost:7071") -> None:
     print("\n📝 Prueba 1: JSON inválido")
     try:
         url = f"{base_url}/api/chat"
-        response = requests.post(url, data="invalid json", headers={"Content-Type": "application/json"})
+        response = SESSION.post(url, data="invalid json")
         print(f"   Status: {response.status_code}")
         print(f"   Respuesta: {response.text[:100]}...")
     except Exception as e:
@@ -83,7 +107,7 @@ def test_invalid_requests(base_url: str = "http://localhost:7071") -> None:
     try:
         url = f"{base_url}/api/chat"
         payload = {"other_field": "test"}
-        response = requests.post(url, json=payload, headers={"Content-Type": "application/json"})
+        response = SESSION.post(url, json=payload)
         print(f"   Status: {response.status_code}")
         print(f"   Respuesta: {response.text[:100]}...")
     except Exception as e:
@@ -93,7 +117,7 @@ def test_invalid_requests(base_url: str = "http://localhost:7071") -> None:
     print("\n📝 Prueba 3: Método GET (no permitido)")
     try:
         url = f"{base_url}/api/chat"
-        response = requests.get(url)
+        response = SESSION.get(url)
         print(f"   Status: {response.status_code}")
         print(f"   Respuesta: {response.text[:100]}...")
     except Exception as e:
@@ -108,7 +132,7 @@ def test_health_endpoint(base_url: str = "http://localhost:7071") -> None:
     
     try:
         url = f"{base_url}/?action=health"
-        response = requests.get(url)
+        response = SESSION.get(url)
         
         if response.status_code == 200:
             result = response.json()
@@ -133,7 +157,7 @@ def test_system_status(base_url: str = "http://localhost:7071") -> None:
     
     try:
         url = f"{base_url}/?action=status"
-        response = requests.get(url)
+        response = SESSION.get(url)
         
         if response.status_code == 200:
             result = response.json()
@@ -166,7 +190,7 @@ def main():
     # Ejecutar pruebas
     test_health_endpoint(base_url)
     test_system_status(base_url)
-    test_chat_endpoint(base_url)
+    asyncio.run(test_chat_endpoint(base_url))
     test_invalid_requests(base_url)
     
     print("\n🎉 Pruebas completadas!")
@@ -4,14 +4,24 @@ Endpoint de chat usando FastAPI y Azure Functions con RAG
 """
 
 import azure.functions as func
-import json
+import orjson
 import logging
 import asyncio
-from typing import Dict, Any
-from pydantic import BaseModel, Field
+import atexit
+import concurrent.futures
+import threading
+from typing import Dict, Any, Optional
+from cachetools import TTLCache
+from pydantic import BaseModel, Field, ValidationError
 
-from app.utils.logger import get_logger
-from app.core.conversation_agent import ConversationAgent
+from app.config.settings import settings
+from app.utils.logger import get_logger, setup_logging
+
+# Configurar el logging antes de importar el resto de módulos, que ya registran mensajes al cargarse
+setup_logging()
+
+from app.core.conversation_agent import ConversationAgent, get_conversation_agent
+from app.utils.azure_clients import close_openai_http_client
 
 logger = get_logger(__name__)
 
@@ -25,12 +35,27 @@ class ChatRequest(BaseModel):
 class ChatResponse(BaseModel):
     """
     Modelo de respuesta para las peticiones de chat
+    Documenta el contrato de la respuesta; la ruta de éxito de chat() serializa
+    el payload directamente con orjson sin instanciar el modelo
     """
     answer: str = Field(..., description="Respuesta del agente")
     success: bool = Field(..., description="Indica si la operación fue exitosa")
     processing_time_seconds: float = Field(..., description="Tiempo de procesamiento en segundos")
     documents_retrieved: int = Field(..., description="Número de documentos recuperados")
 
+# Event loop persistente para todas las invocaciones
+# Se crea una sola vez por worker y corre en un hilo daemon, de modo que los
+# pools de conexiones de los clientes asíncronos sobreviven entre peticiones
+# Ningún handler llama a new_event_loop()/set_event_loop() en la ruta de cada petición
+_LOOP = asyncio.new_event_loop()
+
+def _run_loop() -> None:
+    """Asociar el loop persistente a su hilo y ejecutarlo indefinidamente"""
+    asyncio.set_event_loop(_LOOP)
+    _LOOP.run_forever()
+
+threading.Thread(target=_run_loop, name="mfn-event-loop", daemon=True).start()
+
 # Instancia global del agente conversacional
 # Esta es una buena práctica para optimizar el rendimiento y costos en entornos serverless:
 # 1. Evita la inicialización repetida del agente en cada petición
@@ -38,7 +63,158 @@ class ChatResponse(BaseModel):
 # 3. Minimiza el uso de memoria y CPU
 # 4. Permite reutilizar conexiones a servicios externos (Azure OpenAI, Azure Search)
 # 5. Reduce costos al mantener el estado entre peticiones
-conversation_agent = ConversationAgent()
+# La construcción se hace en segundo plano para no bloquear el arranque del worker;
+# la primera petición espera a que termine si todavía está en curso.
+_agent_future: Optional[concurrent.futures.Future] = None
+_agent_lock = threading.Lock()
+
+async def _build_agent() -> ConversationAgent:
+    """Obtener el agente e inicializar sus clientes y cadenas en el event loop persistente"""
+    agent = get_conversation_agent()
+    await agent._ensure_ready()
+    return agent
+
+def _get_agent() -> ConversationAgent:
+    """
+    Obtener el agente conversacional, construyéndolo la primera vez
+    Si la construcción falla, la siguiente llamada vuelve a intentarlo
+    """
+    global _agent_future
+    with _agent_lock:
+        if _agent_future is None:
+            _agent_future = asyncio.run_coroutine_threadsafe(_build_agent(), _LOOP)
+        future = _agent_future
+    try:
+        return future.result()
+    except Exception:
+        with _agent_lock:
+            if _agent_future is future:
+                _agent_future = None
+        raise
+
+def _warm_agent() -> None:
+    """Pre-calentar el agente al importar el módulo"""
+    try:
+        _get_agent()
+    except Exception as e:
+        logger.error("Error inicializando el agente en segundo plano: %s", e)
+
+threading.Thread(target=_warm_agent, name="mfn-agent-warmup", daemon=True).start()
+
+# Coalescencia de preguntas idénticas
+# Las preguntas en curso se comparten entre peticiones concurrentes y las respuestas
+# exitosas recientes se reutilizan, evitando llamadas duplicadas al LLM.
+# Ambas estructuras solo se usan desde el event loop persistente.
+_inflight: Dict[str, asyncio.Task] = {}
+_answer_cache: TTLCache = TTLCache(maxsize=1024, ttl=60)
+
+# Límite de preguntas concurrentes hacia el agente, para no saturar los pools de
+# conexiones ni las cuotas de Azure OpenAI / Azure Search durante ráfagas
+_SEM = asyncio.Semaphore(settings.MAX_CONCURRENT_ASK)
+
+async def _bounded_ask(agent: ConversationAgent, question: str) -> Dict[str, Any]:
+    """Procesar una pregunta respetando el límite de concurrencia"""
+    async with _SEM:
+        return await agent.ask(question)
+
+async def _ask(agent: ConversationAgent, question: str) -> Dict[str, Any]:
+    """
+    Procesar una pregunta reutilizando respuestas recientes o peticiones en curso
+    
+    Args:
+        agent: Agente conversacional ya inicializado
+        question: Pregunta del usuario
+        
+    Returns:
+        Respuesta del agente
+    """
+    # Misma normalización que la caché de respuestas del grafo: "Hola" y "hola " comparten entrada
+    key = " ".join(question.lower().split())
+    cached = _answer_cache.get(key)
+    if cached is not None:
+        return cached
+    
+    task = _inflight.get(key)
+    if task is None:
+        task = asyncio.ensure_future(_bounded_ask(agent, question))
+        _inflight[key] = task
+        task.add_done_callback(lambda _: _inflight.pop(key, None))
+    
+    # shield evita que la cancelación de una petición cancele la de las demás
+    agent_response = await asyncio.shield(task)
+    if agent_response.get("success", False):
+        _answer_cache[key] = agent_response
+    return agent_response
+
+def _shutdown() -> None:
+    """
+    Cerrar el pool de conexiones compartido de Azure OpenAI al terminar el worker
+    """
+    try:
+        asyncio.run_coroutine_threadsafe(close_openai_http_client(), _LOOP).result(timeout=5)
+    except Exception as e:
+        logger.error("Error cerrando el cliente HTTP de Azure OpenAI: %s", e)
+
+atexit.register(_shutdown)
+
+# Payloads estáticos pre-serializados
+# Los endpoints de información y salud se consultan como sondas de disponibilidad,
+# por lo que se evitan construir y serializar el mismo JSON en cada petición
+_INFO_BYTES = orjson.dumps({
+    "status": "success",
+    "message": "API de IA mfn-mvp funcionando correctamente",
+    "endpoints": {
+        "chat": "POST /api/chat con body JSON: {\"question\": \"<pregunta>\"}",
+        "health": "GET /?action=health",
+        "status": "GET /?action=status"
+    },
+    "example_request": {
+        "question": "¿Qué es la inteligencia artificial?"
+    },
+    "example_response": {
+        "answer": "La inteligencia artificial es...",
+        "success": True,
+        "processing_time_seconds": 1.5,
+        "documents_retrieved": 3
+    }
+}, option=orjson.OPT_INDENT_2)
+
+_HEALTH_BYTES = orjson.dumps({
+    "status": "healthy",
+    "service": "mfn-mvp",
+    "version": "1.0.0",
+    "endpoint": "/api/chat",
+    "timestamp": "2024-01-01T00:00:00Z"
+})
+
+# Se calcula en la primera llamada a system_status()
+_STATUS_BYTES: Optional[bytes] = None
+
+_INFO_RESPONSE = func.HttpResponse(
+    body=_INFO_BYTES,
+    status_code=200,
+    mimetype="application/json"
+)
+
+# Respuestas de error fijas del endpoint de chat
+_METHOD_NOT_ALLOWED_RESPONSE = func.HttpResponse(
+    body=orjson.dumps({"error": "Método no permitido. Solo se aceptan peticiones POST"}),
+    status_code=405,
+    mimetype="application/json",
+    headers={"Allow": "POST"}
+)
+
+_INTERNAL_ERROR_RESPONSE = func.HttpResponse(
+    body=orjson.dumps({
+        "error": "Error interno del servidor",
+        "answer": "Lo siento, ocurrió un error inesperado.",
+        "success": False,
+        "processing_time_seconds": 0.0,
+        "documents_retrieved": 0
+    }),
+    status_code=500,
+    mimetype="application/json"
+)
 
 def chat(req: func.HttpRequest) -> func.HttpResponse:
     """
@@ -48,75 +224,64 @@ def chat(req: func.HttpRequest) -> func.HttpResponse:
     try:
         # Verificar que sea una petición POST
         if req.method != "POST":
-            return func.HttpResponse(
-                json.dumps({"error": "Método no permitido. Solo se aceptan peticiones POST"}),
-                status_code=405,
-                mimetype="application/json"
-            )
-        
-        # Obtener el cuerpo de la petición
-        body = req.get_body().decode('utf-8')
+            return _METHOD_NOT_ALLOWED_RESPONSE
         
-        # Logging de la petición entrante
-        logger.info(f"📨 Petición de chat recibida: {body[:200]}...")
-        
-        # Parsear y validar el JSON usando Pydantic
+        # Parsear y validar el JSON directamente desde los bytes del cuerpo usando Pydantic
         try:
-            request_data = json.loads(body)
-            chat_request = ChatRequest(**request_data)
-        except json.JSONDecodeError as e:
-            logger.error(f"❌ Error parseando JSON: {str(e)}")
+            chat_request = ChatRequest.model_validate_json(req.get_body())
+        except ValidationError as e:
+            if any(error["type"] == "json_invalid" for error in e.errors()):
+                logger.error("❌ Error parseando JSON: %s", e)
+                return func.HttpResponse(
+                    orjson.dumps({"error": "JSON inválido en el cuerpo de la petición"}),
+                    status_code=400,
+                    mimetype="application/json"
+                )
+            logger.error("❌ Error validando datos: %s", e)
             return func.HttpResponse(
-                json.dumps({"error": "JSON inválido en el cuerpo de la petición"}),
-                status_code=400,
-                mimetype="application/json"
-            )
-        except Exception as e:
-            logger.error(f"❌ Error validando datos: {str(e)}")
-            return func.HttpResponse(
-                json.dumps({"error": f"Datos de entrada inválidos: {str(e)}"}),
+                orjson.dumps({"error": f"Datos de entrada inválidos: {str(e)}"}),
                 status_code=400,
                 mimetype="application/json"
             )
         
-        # Llamar al método ask() del agente conversacional
-        logger.info(f"🤔 Procesando pregunta: {chat_request.question}")
+        # Logging de la petición entrante
+        logger.info("📨 Petición de chat recibida: %.200s...", chat_request.question)
         
-        # Ejecutar la pregunta de forma asíncrona
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        try:
-            agent_response = loop.run_until_complete(conversation_agent.ask(chat_request.question))
-        finally:
-            loop.close()
+        # Sin modo streaming: el modelo de programación v1 de Azure Functions no acepta
+        # iteradores como cuerpo, así que la respuesta se devuelve completa; acumular
+        # ConversationAgent.ask_stream en un buffer no adelantaría ningún fragmento al cliente
+        
+        # Ejecutar la pregunta en el event loop persistente
+        future = asyncio.run_coroutine_threadsafe(_ask(_get_agent(), chat_request.question), _LOOP)
+        agent_response = future.result()
         
         # Logging de la respuesta del agente
-        logger.info(f"✅ Respuesta del agente generada en {agent_response.get('processing_time_seconds', 0):.2f}s")
+        logger.info("✅ Respuesta del agente generada en %.2fs", agent_response.get("processing_time_seconds", 0))
         
-        # Construir la respuesta usando el modelo Pydantic
+        # Construir la respuesta con la forma de ChatResponse
         if agent_response.get("success", False):
-            chat_response = ChatResponse(
-                answer=agent_response.get("answer", "No se pudo generar una respuesta"),
-                success=True,
-                processing_time_seconds=agent_response.get("processing_time_seconds", 0.0),
-                documents_retrieved=agent_response.get("documents_retrieved", 0)
-            )
+            answer = agent_response.get("answer", "No se pudo generar una respuesta")
             
             # Logging de respuesta exitosa
-            logger.info(f"📤 Respuesta enviada: {len(chat_response.answer)} caracteres")
+            logger.info("📤 Respuesta enviada: %d caracteres", len(answer))
             
             return func.HttpResponse(
-                json.dumps(chat_response.dict(), indent=2, ensure_ascii=False),
+                orjson.dumps({
+                    "answer": answer,
+                    "success": True,
+                    "processing_time_seconds": agent_response.get("processing_time_seconds", 0.0),
+                    "documents_retrieved": agent_response.get("documents_retrieved", 0)
+                }),
                 status_code=200,
                 mimetype="application/json"
             )
         else:
             # Manejar error del agente
             error_message = agent_response.get("error", "Error desconocido en el agente")
-            logger.error(f"❌ Error del agente: {error_message}")
+            logger.error("❌ Error del agente: %s", error_message)
             
             return func.HttpResponse(
-                json.dumps({
+                orjson.dumps({
                     "error": error_message,
                     "answer": "Lo siento, no pude procesar tu pregunta en este momento.",
                     "success": False,
@@ -129,18 +294,8 @@ def chat(req: func.HttpRequest) -> func.HttpResponse:
             
     except Exception as e:
         # Manejar errores inesperados
-        logger.error(f"❌ Error inesperado en el endpoint de chat: {str(e)}")
-        return func.HttpResponse(
-            json.dumps({
-                "error": "Error interno del servidor",
-                "answer": "Lo siento, ocurrió un error inesperado.",
-                "success": False,
-                "processing_time_seconds": 0.0,
-                "documents_retrieved": 0
-            }),
-            status_code=500,
-            mimetype="application/json"
-        )
+        logger.error("❌ Error inesperado en el endpoint de chat: %s", e)
+        return _INTERNAL_ERROR_RESPONSE
 
 # Función principal para compatibilidad con Azure Functions
 def main(req: func.HttpRequest) -> func.HttpResponse:
@@ -148,100 +303,80 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
     Función principal que redirige a los endpoints específicos
     """
     try:
-        # Obtener la ruta de la petición
-        route = req.route_params.get("route", "")
+        # Obtener la ruta de la petición (o la acción indicada por query string)
+        route = req.route_params.get("route") or req.params.get("action") or ""
         
-        # Redirigir al endpoint de chat
-        if route == "chat" or req.url.endswith("/api/chat"):
-            return chat(req)
+        # Redirigir al endpoint correspondiente
+        handler = _ROUTES.get(route)
+        if handler is not None:
+            return handler(req)
         
         # Endpoint por defecto con información de la API
-        else:
-            response_data = {
-                "status": "success",
-                "message": "API de IA mfn-mvp funcionando correctamente",
-                "endpoints": {
-                    "chat": "POST /api/chat con body JSON: {\"question\": \"<pregunta>\"}",
-                    "health": "GET /?action=health",
-                    "status": "GET /?action=status"
-                },
-                "example_request": {
-                    "question": "¿Qué es la inteligencia artificial?"
-                },
-                "example_response": {
-                    "answer": "La inteligencia artificial es...",
-                    "success": True,
-                    "processing_time_seconds": 1.5,
-                    "documents_retrieved": 3
-                }
-            }
-            return func.HttpResponse(
-                json.dumps(response_data, indent=2, ensure_ascii=False),
-                status_code=200,
-                mimetype="application/json"
-            )
+        return _INFO_RESPONSE
             
     except Exception as e:
-        logger.error(f"Error en función principal: {str(e)}")
+        logger.error("Error en función principal: %s", e)
         return func.HttpResponse(
-            json.dumps({"error": str(e)}),
+            orjson.dumps({"error": str(e)}),
             status_code=500,
             mimetype="application/json"
         )
 
 # Endpoints adicionales para compatibilidad
-def health_check() -> func.HttpResponse:
+def health_check(req: Optional[func.HttpRequest] = None) -> func.HttpResponse:
     """
     Endpoint de verificación de salud
     """
     try:
-        response_data = {
-            "status": "healthy",
-            "service": "mfn-mvp",
-            "version": "1.0.0",
-            "endpoint": "/api/chat",
-            "timestamp": "2024-01-01T00:00:00Z"
-        }
         return func.HttpResponse(
-            json.dumps(response_data),
+            body=_HEALTH_BYTES,
             status_code=200,
             mimetype="application/json"
         )
     except Exception as e:
-        logger.error(f"Error en health check: {str(e)}")
+        logger.error("Error en health check: %s", e)
         return func.HttpResponse(
-            json.dumps({"error": str(e)}),
+            orjson.dumps({"error": str(e)}),
             status_code=500,
             mimetype="application/json"
         )
 
-def system_status() -> func.HttpResponse:
+def system_status(req: Optional[func.HttpRequest] = None) -> func.HttpResponse:
     """
     Endpoint de estado del sistema
     """
+    global _STATUS_BYTES
     try:
-        # Obtener información del agente
-        agent_info = conversation_agent.get_agent_info()
-        
-        response_data = {
-            "status": "operational",
-            "service": "mfn-mvp",
-            "agent_info": agent_info,
-            "endpoints": {
-                "chat": "/api/chat",
-                "health": "/?action=health"
+        # La configuración del agente no cambia después del arranque,
+        # así que el payload se serializa una sola vez
+        if _STATUS_BYTES is None:
+            response_data = {
+                "status": "operational",
+                "service": "mfn-mvp",
+                "agent_info": _get_agent().get_agent_info(),
+                "endpoints": {
+                    "chat": "/api/chat",
+                    "health": "/?action=health"
+                }
             }
-        }
+            _STATUS_BYTES = orjson.dumps(response_data, option=orjson.OPT_INDENT_2)
         
         return func.HttpResponse(
-            json.dumps(response_data, indent=2),
+            body=_STATUS_BYTES,
             status_code=200,
             mimetype="application/json"
         )
     except Exception as e:
-        logger.error(f"Error obteniendo estado del sistema: {str(e)}")
+        logger.error("Error obteniendo estado del sistema: %s", e)
         return func.HttpResponse(
-            json.dumps({"error": str(e)}),
+            orjson.dumps({"error": str(e)}),
             status_code=500,
             mimetype="application/json"
         )
+
+# Tabla de enrutamiento: ruta o acción -> handler
+_ROUTES = {
+    "chat": chat,
+    "health": health_check,
+    "status": system_status
+}
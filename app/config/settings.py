@@ -4,86 +4,166 @@ Configuración específica para servicios de Azure AI con patrón RAG
 """
 
 import os
-from typing import Optional
-from dotenv import load_dotenv
+import functools
+from types import MappingProxyType
+from typing import Any, List, Mapping, Optional
+from dotenv import find_dotenv, load_dotenv
 
-# Cargar variables de entorno desde .env
-load_dotenv()
+# Cargar variables de entorno desde .env solo en desarrollo local
+# En Azure Functions las variables las inyecta la plataforma, así que se evita
+# buscar y parsear el archivo durante el cold start. find_dotenv busca el .env desde
+# este módulo hacia arriba, así que se encuentra aunque se ejecute desde un subdirectorio
+if os.getenv("AZURE_FUNCTIONS_ENVIRONMENT") is None:
+    _dotenv_path = find_dotenv()
+    if _dotenv_path:
+        load_dotenv(_dotenv_path)
+
+# Referencia única al entorno del proceso para todas las lecturas de configuración
+_ENV = os.environ
+
+def _int(key: str, default: str) -> int:
+    """Leer una variable de entorno entera"""
+    return int(_ENV.get(key, default))
+
+def _float(key: str, default: str) -> float:
+    """Leer una variable de entorno decimal"""
+    return float(_ENV.get(key, default))
+
+def _bool(key: str, default: str) -> bool:
+    """Leer una variable de entorno booleana ("true"/"false")"""
+    return _ENV.get(key, default).lower() == "true"
 
 class Settings:
     """
     Clase para manejar todas las configuraciones de la aplicación
     Incluye configuraciones para servicios de Azure AI necesarios para RAG
+    
+    Los atributos se leen una sola vez al importar el módulo, por lo que los
+    métodos get_*_config se memorizan y devuelven siempre la misma vista de solo
+    lectura (MappingProxyType), que ningún llamador puede modificar
     """
     
     # ============================================================================
     # CONFIGURACIONES DE AZURE OPENAI
     # ============================================================================
-    AZURE_OPENAI_ENDPOINT: Optional[str] = os.getenv("AZURE_OPENAI_ENDPOINT")
-    AZURE_OPENAI_API_KEY: Optional[str] = os.getenv("AZURE_OPENAI_API_KEY")
-    AZURE_OPENAI_DEPLOYMENT_NAME: Optional[str] = os.getenv("AZURE_OPENAI_DEPLOYMENT_NAME")
+    AZURE_OPENAI_ENDPOINT: Optional[str] = _ENV.get("AZURE_OPENAI_ENDPOINT")
+    AZURE_OPENAI_API_KEY: Optional[str] = _ENV.get("AZURE_OPENAI_API_KEY")
+    AZURE_OPENAI_DEPLOYMENT_NAME: Optional[str] = _ENV.get("AZURE_OPENAI_DEPLOYMENT_NAME")
+    # Deployment de un modelo pequeño (p. ej. gpt-4o-mini) para router y filtros; opcional
+    AZURE_OPENAI_SMALL_DEPLOYMENT_NAME: Optional[str] = _ENV.get("AZURE_OPENAI_SMALL_DEPLOYMENT_NAME")
     
     # ============================================================================
     # CONFIGURACIONES DE AZURE COGNITIVE SEARCH
     # ============================================================================
-    AZURE_SEARCH_ENDPOINT: Optional[str] = os.getenv("AZURE_SEARCH_ENDPOINT")
-    AZURE_SEARCH_API_KEY: Optional[str] = os.getenv("AZURE_SEARCH_API_KEY")
-    AZURE_SEARCH_INDEX_NAME: Optional[str] = os.getenv("AZURE_SEARCH_INDEX_NAME")
+    AZURE_SEARCH_ENDPOINT: Optional[str] = _ENV.get("AZURE_SEARCH_ENDPOINT")
+    AZURE_SEARCH_API_KEY: Optional[str] = _ENV.get("AZURE_SEARCH_API_KEY")
+    AZURE_SEARCH_INDEX_NAME: Optional[str] = _ENV.get("AZURE_SEARCH_INDEX_NAME")
+    # Campo vectorial del índice (p. ej. "content_vector"); si no se define, la búsqueda es solo por texto
+    AZURE_SEARCH_VECTOR_FIELD: Optional[str] = _ENV.get("AZURE_SEARCH_VECTOR_FIELD")
+    # Campos que devuelve la búsqueda del RAG (separados por comas); vacío devuelve todos,
+    # incluido el campo vectorial, que el agente no usa
+    AZURE_SEARCH_SELECT_FIELDS: List[str] = [field.strip() for field in _ENV.get("AZURE_SEARCH_SELECT_FIELDS", "").split(",") if field.strip()]
     
     # ============================================================================
     # CONFIGURACIONES DE AZURE DOCUMENT INTELLIGENCE
     # ============================================================================
-    AZURE_DOCUMENT_INTELLIGENCE_ENDPOINT: Optional[str] = os.getenv("AZURE_DOCUMENT_INTELLIGENCE_ENDPOINT")
-    AZURE_DOCUMENT_INTELLIGENCE_KEY: Optional[str] = os.getenv("AZURE_DOCUMENT_INTELLIGENCE_KEY")
+    AZURE_DOCUMENT_INTELLIGENCE_ENDPOINT: Optional[str] = _ENV.get("AZURE_DOCUMENT_INTELLIGENCE_ENDPOINT")
+    AZURE_DOCUMENT_INTELLIGENCE_KEY: Optional[str] = _ENV.get("AZURE_DOCUMENT_INTELLIGENCE_KEY")
     
     # ============================================================================
     # CONFIGURACIONES DE AZURE STORAGE
     # ============================================================================
-    AZURE_STORAGE_CONNECTION_STRING: Optional[str] = os.getenv("AZURE_STORAGE_CONNECTION_STRING")
-    AZURE_STORAGE_CONTAINER_NAME: Optional[str] = os.getenv("AZURE_STORAGE_CONTAINER_NAME")
+    AZURE_STORAGE_CONNECTION_STRING: Optional[str] = _ENV.get("AZURE_STORAGE_CONNECTION_STRING")
+    AZURE_STORAGE_CONTAINER_NAME: Optional[str] = _ENV.get("AZURE_STORAGE_CONTAINER_NAME")
+    
+    # ============================================================================
+    # AUTENTICACIÓN CON ENTRA ID
+    # ============================================================================
+    # Autenticar con la identidad de Entra ID del entorno (DefaultAzureCredential) los servicios
+    # sin clave API; desactivado, las claves de OpenAI, Search y Document Intelligence son obligatorias
+    AZURE_USE_ENTRA_ID: bool = _bool("AZURE_USE_ENTRA_ID", "False")
     
     # ============================================================================
     # CONFIGURACIONES DE LA APLICACIÓN
     # ============================================================================
     APP_NAME: str = "mfn-mvp"
     APP_VERSION: str = "1.0.0"
-    DEBUG: bool = os.getenv("DEBUG", "False").lower() == "true"
+    DEBUG: bool = _bool("DEBUG", "False")
+    # Incluir el estado completo del grafo ("trace") en las respuestas de /chat/
+    DEBUG_TRACE: bool = _bool("DEBUG_TRACE", "False")
+    
+    # Máximo de preguntas procesadas en paralelo por el agente en cada worker
+    MAX_CONCURRENT_ASK: int = _int("MAX_CONCURRENT_ASK", "32")
+    
+    # Hilos máximos para llamadas síncronas (SDK de Azure, disco) descargadas del event loop
+    THREAD_POOL_SIZE: int = _int("THREAD_POOL_SIZE", "32")
+    
+    # Pool de conexiones HTTP compartido por los clientes de Azure
+    AZURE_HTTP_POOL_MAXSIZE: int = _int("AZURE_HTTP_POOL_MAXSIZE", "200")
+    AZURE_HTTP_POOL_PER_HOST: int = _int("AZURE_HTTP_POOL_PER_HOST", "50")
+    AZURE_HTTP_MAX_IDLE_SECONDS: int = _int("AZURE_HTTP_MAX_IDLE_SECONDS", "75")
     
     # ============================================================================
     # CONFIGURACIONES DE IA Y MODELOS
     # ============================================================================
     # Modelo de embeddings para vectorización de documentos
-    EMBEDDING_MODEL: str = os.getenv("EMBEDDING_MODEL", "text-embedding-ada-002")
+    EMBEDDING_MODEL: str = _ENV.get("EMBEDDING_MODEL", "text-embedding-ada-002")
     
     # Modelo de generación para respuestas
-    GENERATION_MODEL: str = os.getenv("GENERATION_MODEL", "gpt-4")
+    GENERATION_MODEL: str = _ENV.get("GENERATION_MODEL", "gpt-4")
     
     # Configuraciones de tokens
-    MAX_TOKENS: int = int(os.getenv("MAX_TOKENS", "1000"))
-    TEMPERATURE: float = float(os.getenv("TEMPERATURE", "0.7"))
+    MAX_TOKENS: int = _int("MAX_TOKENS", "1000")
+    TEMPERATURE: float = _float("TEMPERATURE", "0.7")
+    
+    # Número máximo de llamadas concurrentes al LLM por proceso
+    LLM_CONCURRENCY: int = _int("LLM_CONCURRENCY", "16")
+    
+    # Carpeta del modelo ONNX de sentimiento (int8); si no se define, se usa el LLM
+    SENTIMENT_ONNX_MODEL_DIR: Optional[str] = _ENV.get("SENTIMENT_ONNX_MODEL_DIR")
     
     # ============================================================================
     # CONFIGURACIONES DE RAG
     # ============================================================================
     # Número de documentos a recuperar para el contexto
-    TOP_K_DOCUMENTS: int = int(os.getenv("TOP_K_DOCUMENTS", "5"))
+    TOP_K_DOCUMENTS: int = _int("TOP_K_DOCUMENTS", "5")
     
     # Umbral de similitud para filtrar documentos
-    SIMILARITY_THRESHOLD: float = float(os.getenv("SIMILARITY_THRESHOLD", "0.7"))
+    SIMILARITY_THRESHOLD: float = _float("SIMILARITY_THRESHOLD", "0.7")
     
     # Tamaño del chunk para dividir documentos
-    CHUNK_SIZE: int = int(os.getenv("CHUNK_SIZE", "1000"))
-    CHUNK_OVERLAP: int = int(os.getenv("CHUNK_OVERLAP", "200"))
+    CHUNK_SIZE: int = _int("CHUNK_SIZE", "1000")
+    CHUNK_OVERLAP: int = _int("CHUNK_OVERLAP", "200")
+    
+    # Número máximo de textos por llamada al endpoint de embeddings
+    EMBEDDING_BATCH_SIZE: int = _int("EMBEDDING_BATCH_SIZE", "64")
+    
+    # Número máximo de búsquedas concurrentes en Azure Search
+    MAX_CONCURRENT_SEARCHES: int = _int("MAX_CONCURRENT_SEARCHES", "8")
+    
+    # Presupuesto de tokens del prompt y reserva para instrucciones y pregunta
+    # El contexto de documentos se recorta para no superar la diferencia
+    MAX_PROMPT_TOKENS: int = _int("MAX_PROMPT_TOKENS", "6000")
+    PROMPT_TOKEN_RESERVE: int = _int("PROMPT_TOKEN_RESERVE", "500")
+    
+    # Segundos que se conservan en caché los embeddings y resultados de búsqueda por consulta
+    RAG_CACHE_TTL: int = _int("RAG_CACHE_TTL", "300")
+    
+    # Tipo de cadena de RAG: "stuff" (un solo prompt) o "map_reduce" (resume cada
+    # documento en paralelo cuando el contexto supera el presupuesto de tokens)
+    RAG_CHAIN_TYPE: str = _ENV.get("RAG_CHAIN_TYPE", "stuff")
     
     # ============================================================================
     # CONFIGURACIONES DE LOGGING
     # ============================================================================
-    LOG_LEVEL: str = os.getenv("LOG_LEVEL", "INFO")
+    LOG_LEVEL: str = _ENV.get("LOG_LEVEL", "INFO")
     
     @classmethod
+    @functools.lru_cache(maxsize=1)
     def validate(cls) -> bool:
         """
         Validar que todas las configuraciones requeridas estén presentes
+        El resultado exitoso se memoriza, por lo que solo se valida una vez por proceso
         
         Returns:
             bool: True si todas las configuraciones están presentes
@@ -125,6 +205,11 @@ class Settings:
             document_intelligence_required
         )
         
+        # Con Entra ID activado las claves API son opcionales
+        api_keys = {"AZURE_OPENAI_API_KEY", "AZURE_SEARCH_API_KEY", "AZURE_DOCUMENT_INTELLIGENCE_KEY"}
+        if cls.AZURE_USE_ENTRA_ID:
+            all_required = [var for var in all_required if var not in api_keys]
+        
         missing_vars = []
         for var in all_required:
             if not getattr(cls, var):
@@ -140,78 +225,91 @@ class Settings:
         return True
     
     @classmethod
-    def get_azure_openai_config(cls) -> dict:
+    @functools.lru_cache(maxsize=1)
+    def get_azure_openai_config(cls) -> Mapping[str, Any]:
         """
         Obtener configuración para Azure OpenAI
         
         Returns:
-            dict: Configuración de Azure OpenAI
+            Mapping: Configuración de Azure OpenAI
         """
-        return {
+        return MappingProxyType({
             "endpoint": cls.AZURE_OPENAI_ENDPOINT,
             "api_key": cls.AZURE_OPENAI_API_KEY,
             "deployment_name": cls.AZURE_OPENAI_DEPLOYMENT_NAME,
             "api_version": "2024-02-15-preview"
-        }
+        })
     
     @classmethod
-    def get_azure_search_config(cls) -> dict:
+    @functools.lru_cache(maxsize=1)
+    def get_azure_search_config(cls) -> Mapping[str, Any]:
         """
         Obtener configuración para Azure Cognitive Search
         
         Returns:
-            dict: Configuración de Azure Search
+            Mapping: Configuración de Azure Search
         """
-        return {
+        return MappingProxyType({
             "endpoint": cls.AZURE_SEARCH_ENDPOINT,
             "api_key": cls.AZURE_SEARCH_API_KEY,
-            "index_name": cls.AZURE_SEARCH_INDEX_NAME
-        }
+            "index_name": cls.AZURE_SEARCH_INDEX_NAME,
+            "vector_field": cls.AZURE_SEARCH_VECTOR_FIELD,
+            "select_fields": tuple(cls.AZURE_SEARCH_SELECT_FIELDS)
+        })
     
     @classmethod
-    def get_document_intelligence_config(cls) -> dict:
+    @functools.lru_cache(maxsize=1)
+    def get_document_intelligence_config(cls) -> Mapping[str, Any]:
         """
         Obtener configuración para Azure Document Intelligence
         
         Returns:
-            dict: Configuración de Document Intelligence
+            Mapping: Configuración de Document Intelligence
         """
-        return {
+        return MappingProxyType({
             "endpoint": cls.AZURE_DOCUMENT_INTELLIGENCE_ENDPOINT,
             "api_key": cls.AZURE_DOCUMENT_INTELLIGENCE_KEY
-        }
+        })
     
     @classmethod
-    def get_storage_config(cls) -> dict:
+    @functools.lru_cache(maxsize=1)
+    def get_storage_config(cls) -> Mapping[str, Any]:
         """
         Obtener configuración para Azure Storage
         
         Returns:
-            dict: Configuración de Azure Storage
+            Mapping: Configuración de Azure Storage
         """
-        return {
+        return MappingProxyType({
             "connection_string": cls.AZURE_STORAGE_CONNECTION_STRING,
             "container_name": cls.AZURE_STORAGE_CONTAINER_NAME
-        }
+        })
     
     @classmethod
-    def get_rag_config(cls) -> dict:
+    @functools.lru_cache(maxsize=1)
+    def get_rag_config(cls) -> Mapping[str, Any]:
         """
         Obtener configuración para el patrón RAG
         
         Returns:
-            dict: Configuración de RAG
+            Mapping: Configuración de RAG
         """
-        return {
+        return MappingProxyType({
             "top_k": cls.TOP_K_DOCUMENTS,
             "similarity_threshold": cls.SIMILARITY_THRESHOLD,
             "chunk_size": cls.CHUNK_SIZE,
             "chunk_overlap": cls.CHUNK_OVERLAP,
+            "embedding_batch_size": cls.EMBEDDING_BATCH_SIZE,
+            "max_concurrent_searches": cls.MAX_CONCURRENT_SEARCHES,
+            "max_prompt_tokens": cls.MAX_PROMPT_TOKENS,
+            "prompt_token_reserve": cls.PROMPT_TOKEN_RESERVE,
+            "cache_ttl": cls.RAG_CACHE_TTL,
+            "chain_type": cls.RAG_CHAIN_TYPE,
             "embedding_model": cls.EMBEDDING_MODEL,
             "generation_model": cls.GENERATION_MODEL,
             "max_tokens": cls.MAX_TOKENS,
             "temperature": cls.TEMPERATURE
-        }
+        })
 
 # Instancia global de configuraciones
 settings = Settings()
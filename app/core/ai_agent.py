@@ -3,17 +3,65 @@ Agente de Inteligencia Artificial principal para mfn-mvp
 Actualizado para usar el patrón RAG con Azure AI
 """
 
+import asyncio
+import functools
+import time
 import logging
-from typing import Dict, Any, List, Optional
+from typing import Dict, Any, List, Optional, AsyncIterator, Tuple
 from datetime import datetime
 
+from cachetools import TTLCache
+
 from app.config.settings import settings
 from app.utils.azure_clients import get_openai_client, get_openai_embeddings_client
-from app.utils.azure_helpers import search_helper
+from app.core.sentiment_onnx import get_sentiment_classifier
+from app.utils import azure_helpers
+from app.utils.context_budget import get_context_token_budget, pack_by_relevance
 from app.utils.logger import get_logger
 
 logger = get_logger(__name__)
 
+# Instrucciones fijas del prompt de RAG
+# Se mantienen sin interpolación para que el prefijo sea idéntico en todas las
+# peticiones y pueda aprovechar la caché de prompts de Azure OpenAI
+_RAG_SYSTEM_PREFIX = (
+    "Eres un asistente de IA para la aplicación mfn-mvp.\n"
+    "Responde la pregunta usando solo el siguiente contexto. "
+    "Si la información no está en el contexto, indica que no la tienes.\n"
+)
+
+def _normalize(query: str) -> str:
+    """Normalizar una consulta para usarla como clave de caché"""
+    return " ".join(query.lower().split())
+
+async def _drain(queue: asyncio.Queue, max_items: int, timeout: float) -> Tuple[List[Any], bool]:
+    """
+    Sacar de la cola hasta max_items elementos, esperando como mucho timeout segundos
+    por cada elemento después del primero
+    
+    Args:
+        queue: Cola de entrada (None indica fin)
+        max_items: Tamaño máximo del lote
+        timeout: Espera máxima entre elementos, en segundos
+        
+    Returns:
+        Lote de elementos y si se recibió la marca de fin
+    """
+    item = await queue.get()
+    if item is None:
+        return [], True
+    
+    batch = [item]
+    while len(batch) < max_items:
+        try:
+            item = await asyncio.wait_for(queue.get(), timeout)
+        except asyncio.TimeoutError:
+            break
+        if item is None:
+            return batch, True
+        batch.append(item)
+    return batch, False
+
 class AIAgent:
     """Agente principal de IA que maneja la lógica de procesamiento con RAG"""
     
@@ -21,6 +69,14 @@ class AIAgent:
         """Inicializar el agente de IA"""
         self.openai_client = get_openai_client()
         self.embeddings_client = get_openai_embeddings_client()
+        self._search_semaphore = asyncio.Semaphore(settings.MAX_CONCURRENT_SEARCHES)
+        
+        # Límite de llamadas concurrentes al LLM
+        self._llm_semaphore = asyncio.Semaphore(settings.LLM_CONCURRENCY)
+        
+        # Cachés por consulta normalizada para evitar repetir embeddings y búsquedas
+        self._embedding_cache: TTLCache = TTLCache(maxsize=1024, ttl=settings.RAG_CACHE_TTL)
+        self._retrieval_cache: TTLCache = TTLCache(maxsize=1024, ttl=settings.RAG_CACHE_TTL)
         
         logger.info("Agente de IA inicializado con RAG")
     
@@ -36,22 +92,18 @@ class AIAgent:
             Respuesta procesada por la IA con RAG
         """
         try:
-            start_time = datetime.utcnow()
+            start_time = time.perf_counter()
             
-            # 1. Generar embeddings de la consulta
-            query_embeddings = await self.embeddings_client.aembed_query(user_input)
-            
-            # 2. Buscar documentos relevantes
+            # 1. Buscar documentos relevantes
             relevant_documents = await self._retrieve_relevant_documents(user_input)
             
-            # 3. Construir contexto con documentos encontrados
+            # 2. Construir contexto con documentos encontrados
             context_text = self._build_context_from_documents(relevant_documents)
             
-            # 4. Generar respuesta usando RAG
-            response = await self._generate_rag_response(user_input, context_text, context)
+            # 3. Generar respuesta usando RAG
+            response = await self._generate_rag_response(" ".join(user_input.split()), context_text, context)
             
-            end_time = datetime.utcnow()
-            processing_time = (end_time - start_time).total_seconds()
+            processing_time = time.perf_counter() - start_time
             
             return {
                 "success": True,
@@ -64,42 +116,245 @@ class AIAgent:
             }
             
         except Exception as e:
-            logger.error(f"Error procesando petición con RAG: {str(e)}")
+            logger.error("Error procesando petición con RAG: %s", e)
             return {
                 "success": False,
                 "error": str(e)
             }
     
-    async def _retrieve_relevant_documents(self, query: str) -> List[Dict[str, Any]]:
+    async def process_request_stream(self, user_input: str, context: Optional[Dict[str, Any]] = None) -> AsyncIterator[str]:
+        """
+        Procesar una petición del usuario con RAG emitiendo la respuesta a medida que se genera
+        
+        Args:
+            user_input: Texto de entrada del usuario
+            context: Contexto adicional para la petición
+            
+        Returns:
+            Iterador asíncrono con los fragmentos de texto de la respuesta
+        """
+        relevant_documents = await self._retrieve_relevant_documents(user_input)
+        context_text = self._build_context_from_documents(relevant_documents)
+        
+        async for chunk in self._stream_rag_response(user_input, context_text, context):
+            yield chunk
+    
+    async def process_requests_batch(self, inputs: List[str]) -> List[Dict[str, Any]]:
+        """
+        Procesar varias peticiones con RAG agrupando las llamadas de embeddings
+        
+        Args:
+            inputs: Lista de textos de entrada del usuario
+            
+        Returns:
+            Lista de respuestas, en el mismo orden que las entradas
+        """
+        try:
+            start_time = time.perf_counter()
+            
+            # 1. Generar los embeddings de todas las consultas en lotes (solo con búsqueda vectorial)
+            if settings.AZURE_SEARCH_VECTOR_FIELD:
+                query_vectors = await self._embed_batch(inputs)
+            else:
+                query_vectors = [None] * len(inputs)
+            
+            # 2. Buscar documentos relevantes para todas las consultas en paralelo
+            documents_per_input = await asyncio.gather(
+                *[self._retrieve_relevant_documents_bounded(user_input, vector) for user_input, vector in zip(inputs, query_vectors)]
+            )
+            
+            # 3. Generar las respuestas usando RAG en paralelo
+            contexts = [self._build_context_from_documents(documents) for documents in documents_per_input]
+            responses = await asyncio.gather(
+                *[self._generate_rag_response(user_input, context) for user_input, context in zip(inputs, contexts)],
+                return_exceptions=True
+            )
+            
+            processing_time = time.perf_counter() - start_time
+            
+            results = []
+            for response, documents, context in zip(responses, documents_per_input, contexts):
+                if isinstance(response, Exception):
+                    results.append({
+                        "success": False,
+                        "error": str(response)
+                    })
+                    continue
+                
+                results.append({
+                    "success": True,
+                    "response": response,
+                    "documents_retrieved": len(documents),
+                    "processing_time_seconds": processing_time,
+                    "model": settings.GENERATION_MODEL,
+                    "embedding_model": settings.EMBEDDING_MODEL,
+                    "context_length": len(context)
+                })
+            
+            logger.info("📦 Lote de %d peticiones procesado en %.2fs", len(inputs), processing_time)
+            return results
+            
+        except Exception as e:
+            logger.error("Error procesando lote de peticiones con RAG: %s", e)
+            return [{"success": False, "error": str(e)} for _ in inputs]
+    
+    async def async_process_stream(self, queries: AsyncIterator[str]) -> AsyncIterator[Dict[str, Any]]:
+        """
+        Procesar un flujo de consultas agrupándolas en lotes
+        Varios workers sacan lotes de una cola compartida y los procesan en paralelo, de
+        modo que siempre hay llamadas en curso contra Azure mientras lleguen consultas
+        
+        Args:
+            queries: Iterador asíncrono de consultas del usuario
+            
+        Returns:
+            Iterador asíncrono con las respuestas, en el mismo orden que las consultas
+        """
+        loop = asyncio.get_running_loop()
+        num_workers = settings.LLM_CONCURRENCY
+        pending: asyncio.Queue = asyncio.Queue()
+        ordered: asyncio.Queue = asyncio.Queue()
+        
+        async def producer() -> None:
+            try:
+                async for query in queries:
+                    future = loop.create_future()
+                    await pending.put((query, future))
+                    await ordered.put(future)
+            except Exception as e:
+                logger.error("Error leyendo el flujo de consultas: %s", e)
+            finally:
+                for _ in range(num_workers):
+                    await pending.put(None)
+                await ordered.put(None)
+        
+        async def worker() -> None:
+            finished = False
+            while not finished:
+                batch, finished = await _drain(pending, settings.EMBEDDING_BATCH_SIZE, 0.005)
+                if not batch:
+                    continue
+                results = await self.process_requests_batch([query for query, _ in batch])
+                for (_, future), result in zip(batch, results):
+                    if not future.done():
+                        future.set_result(result)
+        
+        tasks = [asyncio.create_task(producer())]
+        tasks.extend(asyncio.create_task(worker()) for _ in range(num_workers))
+        
+        try:
+            while (future := await ordered.get()) is not None:
+                yield await future
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+    
+    async def _embed_batch(self, texts: List[str]) -> List[List[float]]:
+        """
+        Generar embeddings para varios textos con el menor número de llamadas posible
+        
+        Args:
+            texts: Textos a vectorizar
+            
+        Returns:
+            Lista de embeddings, en el mismo orden que los textos
+        """
+        batch_size = settings.EMBEDDING_BATCH_SIZE
+        embeddings: List[List[float]] = []
+        for start in range(0, len(texts), batch_size):
+            embeddings.extend(await self.embeddings_client.aembed_documents(texts[start:start + batch_size]))
+        return embeddings
+    
+    async def _retrieve_relevant_documents_bounded(self, query: str, vector: Optional[List[float]] = None) -> List[Dict[str, Any]]:
+        """
+        Recuperar documentos relevantes respetando el límite de búsquedas concurrentes
+        
+        Args:
+            query: Consulta del usuario
+            vector: Embedding ya calculado de la consulta (opcional)
+            
+        Returns:
+            Lista de documentos relevantes
+        """
+        async with self._search_semaphore:
+            return await self._retrieve_relevant_documents(query, vector)
+    
+    async def _embed_query(self, query: str) -> List[float]:
+        """
+        Generar el embedding de una consulta, reutilizando el de una consulta equivalente reciente
+        
+        Args:
+            query: Consulta del usuario
+            
+        Returns:
+            Embedding de la consulta
+        """
+        key = _normalize(query)
+        embedding = self._embedding_cache.get(key)
+        if embedding is None:
+            embedding = await self.embeddings_client.aembed_query(query)
+            self._embedding_cache[key] = embedding
+        return embedding
+    
+    async def _retrieve_relevant_documents(self, query: str, vector: Optional[List[float]] = None) -> List[Dict[str, Any]]:
         """
         Recuperar documentos relevantes usando Azure Search
+        Si el índice tiene un campo vectorial configurado, la consulta se envía también
+        como vector (búsqueda híbrida); si no, el embedding no se calcula
         
         Args:
             query: Consulta del usuario
+            vector: Embedding ya calculado de la consulta (opcional)
             
         Returns:
             Lista de documentos relevantes
         """
+        key = _normalize(query)
+        cached = self._retrieval_cache.get(key)
+        if cached is not None:
+            logger.info("📚 Documentos recuperados desde caché: %d", len(cached))
+            return cached
+        
         try:
+            if vector is None and settings.AZURE_SEARCH_VECTOR_FIELD:
+                vector = await self._embed_query(query)
+            
             # Buscar documentos en Azure Search
-            documents = await search_helper.search_documents(
+            documents = await azure_helpers.search_helper.search_documents(
                 query=query,
-                top=settings.TOP_K_DOCUMENTS
+                top=settings.TOP_K_DOCUMENTS,
+                vector=vector,
+                select=settings.AZURE_SEARCH_SELECT_FIELDS
             )
             
-            logger.info(f"📚 Documentos recuperados: {len(documents)}")
+            # Los resultados vacíos no se guardan: pueden deberse a un error de búsqueda
+            if documents:
+                self._retrieval_cache[key] = documents
+            
+            logger.info("📚 Documentos recuperados: %d", len(documents))
             return documents
             
         except Exception as e:
-            logger.error(f"Error recuperando documentos: {str(e)}")
+            logger.error("Error recuperando documentos: %s", e)
             return []
     
-    def _build_context_from_documents(self, documents: List[Dict[str, Any]]) -> str:
+    def clear_caches(self) -> None:
+        """
+        Vaciar las cachés de embeddings y de búsqueda
+        Debe llamarse tras reconstruir o actualizar el índice
+        """
+        self._embedding_cache.clear()
+        self._retrieval_cache.clear()
+        logger.info("🧹 Cachés de embeddings y búsqueda vaciadas")
+    
+    def _build_context_from_documents(self, documents: List[Dict[str, Any]], token_budget: Optional[int] = None) -> str:
         """
         Construir contexto a partir de documentos recuperados
         
         Args:
             documents: Lista de documentos recuperados
+            token_budget: Tokens máximos para el contexto (por defecto, el presupuesto configurado)
             
         Returns:
             Texto de contexto formateado
@@ -107,14 +362,18 @@ class AIAgent:
         if not documents:
             return ""
         
-        context_parts = []
-        for i, doc in enumerate(documents, 1):
-            content = doc.get("content", "")
-            source = doc.get("source", "Documento desconocido")
-            
-            context_parts.append(f"Documento {i} (Fuente: {source}):\n{content}\n")
+        # Ajustar al presupuesto: más relevantes en los extremos, descartando los menos relevantes
+        packed = pack_by_relevance(
+            documents,
+            get_score=lambda doc: doc.get("@search.score") or 0.0,
+            get_text=lambda doc: doc.get("content", ""),
+            token_budget=get_context_token_budget() if token_budget is None else token_budget
+        )
         
-        return "\n".join(context_parts)
+        return "\n".join(
+            f"Documento {i} (Fuente: {doc.get('source', 'Documento desconocido')}):\n{content}"
+            for i, (doc, content) in enumerate(packed, 1)
+        )
     
     async def _generate_rag_response(self, user_input: str, context: str, additional_context: Optional[Dict[str, Any]] = None) -> str:
         """
@@ -132,15 +391,39 @@ class AIAgent:
             # Construir prompt para RAG
             prompt = self._build_rag_prompt(user_input, context, additional_context)
             
-            # Generar respuesta
-            response = await self.openai_client.ainvoke(prompt)
+            # Llamada sin streaming: el semáforo se libera en cuanto llega la respuesta,
+            # sin depender del ritmo de consumo de un cliente en streaming
+            async with self._llm_semaphore:
+                response = await self.openai_client.ainvoke(prompt)
             
             return response.content
             
         except Exception as e:
-            logger.error(f"Error generando respuesta RAG: {str(e)}")
+            logger.error("Error generando respuesta RAG: %s", e)
             raise
     
+    async def _stream_rag_response(self, user_input: str, context: str, additional_context: Optional[Dict[str, Any]] = None) -> AsyncIterator[str]:
+        """
+        Generar respuesta usando RAG en modo streaming
+        
+        Args:
+            user_input: Consulta del usuario
+            context: Contexto de documentos recuperados
+            additional_context: Contexto adicional
+            
+        Returns:
+            Iterador asíncrono con los fragmentos de la respuesta generada
+        """
+        # Construir prompt para RAG
+        prompt = self._build_rag_prompt(user_input, context, additional_context)
+        
+        # Emitir cada fragmento en cuanto llega del modelo
+        # El semáforo limita las llamadas concurrentes al LLM para no exceder los límites de Azure
+        async with self._llm_semaphore:
+            async for chunk in self.openai_client.astream(prompt):
+                if chunk.content:
+                    yield chunk.content
+    
     def _build_rag_prompt(self, user_input: str, context: str, additional_context: Optional[Dict[str, Any]] = None) -> str:
         """
         Construir prompt para RAG
@@ -153,25 +436,13 @@ class AIAgent:
         Returns:
             Prompt formateado para RAG
         """
-        base_prompt = f"""
-        Eres un asistente de IA inteligente para la aplicación mfn-mvp.
-        
-        Basándote ÚNICAMENTE en el siguiente contexto, responde la pregunta del usuario.
-        Si la información no está en el contexto, indica que no tienes esa información.
-        
-        Contexto:
-        {context}
-        
-        Pregunta del usuario: {user_input}
-        
-        Respuesta:
-        """
+        parts = [_RAG_SYSTEM_PREFIX, "\nContexto:\n", context, "\nPregunta: ", user_input, "\nRespuesta:"]
         
         if additional_context:
-            context_str = "\n".join([f"{k}: {v}" for k, v in additional_context.items()])
-            base_prompt += f"\n\nInformación adicional:\n{context_str}"
+            parts.append("\n\nInformación adicional:\n")
+            parts.append("\n".join(f"{k}: {v}" for k, v in additional_context.items()))
         
-        return base_prompt
+        return "".join(parts)
     
     async def process_document_upload(self, file_path: str) -> Dict[str, Any]:
         """
@@ -186,7 +457,7 @@ class AIAgent:
         try:
             from app.core.rag_pipeline import rag_pipeline
             
-            logger.info(f"📄 Procesando documento: {file_path}")
+            logger.info("📄 Procesando documento: %s", file_path)
             
             # Usar el pipeline RAG para procesar el documento
             result = await rag_pipeline.process_and_index_document(file_path)
@@ -194,7 +465,7 @@ class AIAgent:
             return result
             
         except Exception as e:
-            logger.error(f"Error procesando documento: {str(e)}")
+            logger.error("Error procesando documento: %s", e)
             return {
                 "success": False,
                 "error": str(e),
@@ -213,7 +484,7 @@ class AIAgent:
             Resultados de la búsqueda
         """
         try:
-            documents = await search_helper.search_documents(query=query, top=top)
+            documents = await azure_helpers.search_helper.search_documents(query=query, top=top)
             
             return {
                 "success": True,
@@ -223,7 +494,7 @@ class AIAgent:
             }
             
         except Exception as e:
-            logger.error(f"Error buscando documentos: {str(e)}")
+            logger.error("Error buscando documentos: %s", e)
             return {
                 "success": False,
                 "error": str(e),
@@ -240,6 +511,21 @@ class AIAgent:
         Returns:
             Análisis de sentimiento
         """
+        # Textos que caben en la ventana del modelo local (en tokens): sin llamada a Azure OpenAI
+        try:
+            classification = get_sentiment_classifier().classify(text)
+            if classification is not None:
+                sentiment, probability = classification
+                return {
+                    "success": True,
+                    "sentiment": sentiment,
+                    "text": text,
+                    "confidence": "high" if probability >= 0.6 else "low",
+                    "classifier": "onnx"
+                }
+        except RuntimeError as e:
+            logger.debug("Clasificador local no disponible, usando el LLM: %s", str(e))
+        
         try:
             prompt = f"""
             Analiza el sentimiento del siguiente texto. 
@@ -250,18 +536,20 @@ class AIAgent:
             Sentimiento:
             """
             
-            response = await self.openai_client.ainvoke(prompt)
+            async with self._llm_semaphore:
+                response = await self.openai_client.ainvoke(prompt)
             sentiment = response.content.strip().upper()
             
             return {
                 "success": True,
                 "sentiment": sentiment,
                 "text": text,
-                "confidence": "high" if sentiment in ["POSITIVO", "NEGATIVO", "NEUTRAL"] else "low"
+                "confidence": "high" if sentiment in ["POSITIVO", "NEGATIVO", "NEUTRAL"] else "low",
+                "classifier": "llm"
             }
             
         except Exception as e:
-            logger.error(f"Error analizando sentimiento: {str(e)}")
+            logger.error("Error analizando sentimiento: %s", e)
             return {
                 "success": False,
                 "error": str(e),
@@ -291,12 +579,19 @@ class AIAgent:
             }
             
         except Exception as e:
-            logger.error(f"Error obteniendo estado del sistema: {str(e)}")
+            logger.error("Error obteniendo estado del sistema: %s", e)
             return {
                 "success": False,
                 "error": str(e),
                 "status": "error"
             }
 
-# Instancia global del agente
-ai_agent = AIAgent()
+@functools.cache
+def get_ai_agent() -> AIAgent:
+    """
+    Obtener la instancia global del agente, creándola en el primer uso
+    
+    Returns:
+        Instancia compartida de AIAgent
+    """
+    return AIAgent()
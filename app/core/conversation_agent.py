@@ -4,7 +4,11 @@ Implementa un agente que combina Azure AI Search con Azure OpenAI para respuesta
 """
 
 import asyncio
-from typing import List, Dict, Any, Optional
+import functools
+import logging
+import time
+from typing import List, Dict, Any, Optional, AsyncIterator
+from dataclasses import asdict, dataclass
 from datetime import datetime
 
 from langchain.schema import Document
@@ -15,10 +19,85 @@ from langchain_openai import AzureChatOpenAI
 
 from app.config.settings import settings
 from app.utils.azure_clients import get_openai_client, get_search_client
+from app.utils.context_budget import count_tokens, get_context_token_budget, pack_by_relevance
 from app.utils.logger import get_logger
 
 logger = get_logger(__name__)
 
+# Instrucciones fijas del prompt con contexto adicional
+# Se mantienen sin interpolación para que el prefijo sea idéntico en todas las
+# peticiones y pueda aprovechar la caché de prompts de Azure OpenAI
+_ENHANCED_SYSTEM_PREFIX = (
+    "Eres un asistente de IA para la aplicación mfn-mvp.\n"
+    "Responde la pregunta del usuario usando el siguiente contexto y la información adicional.\n"
+)
+
+# Template de prompt para RAG
+# PromptTemplate es inmutable, así que se construye una sola vez por proceso
+_RAG_PROMPT = PromptTemplate(
+    template="""
+Eres un asistente de IA inteligente y útil para la aplicación mfn-mvp.
+
+Basándote ÚNICAMENTE en el siguiente contexto, responde la pregunta del usuario.
+Si la información no está en el contexto, indica claramente que no tienes esa información.
+
+Contexto:
+{context}
+
+Pregunta: {question}
+
+Respuesta:
+""",
+    input_variables=["context", "question"]
+)
+
+# Templates para la cadena map_reduce (contextos largos)
+# El paso map extrae de cada documento lo relevante y el paso reduce combina los extractos
+_MAP_PROMPT = PromptTemplate(
+    template="""
+Extrae del siguiente fragmento solo la información relevante para responder la pregunta.
+Si no hay información relevante, responde "NADA".
+
+Fragmento:
+{context}
+
+Pregunta: {question}
+
+Información relevante:
+""",
+    input_variables=["context", "question"]
+)
+
+_REDUCE_PROMPT = PromptTemplate(
+    template="""
+Eres un asistente de IA inteligente y útil para la aplicación mfn-mvp.
+
+Basándote ÚNICAMENTE en los siguientes extractos, responde la pregunta del usuario.
+Si la información no está en los extractos, indica claramente que no tienes esa información.
+
+Extractos:
+{summaries}
+
+Pregunta: {question}
+
+Respuesta:
+""",
+    input_variables=["summaries", "question"]
+)
+
+@dataclass(slots=True)
+class FormattedDoc:
+    """
+    Documento fuente resumido que se devuelve junto a la respuesta
+    La respuesta expone cada documento como dict (dataclasses.asdict), igual que antes
+    """
+    id: int
+    content: str
+    source: str
+    chunk_id: str
+    confidence: str
+    full_content_length: int
+
 class ConversationAgent:
     """
     Agente conversacional que combina Azure AI Search con Azure OpenAI
@@ -26,7 +105,27 @@ class ConversationAgent:
     """
     
     def __init__(self):
-        """Inicializar el agente conversacional"""
+        """
+        Inicializar el agente conversacional
+        Los clientes, el retriever y las cadenas se crean en el primer uso (ver _ensure_ready)
+        para no bloquear el arranque del worker
+        """
+        self.openai_client: Optional[AzureChatOpenAI] = None
+        self.retriever: Optional[AzureCognitiveSearchRetriever] = None
+        self.qa_chain: Optional[RetrievalQA] = None
+        self.map_reduce_chain: Optional[RetrievalQA] = None
+        
+        # Template de prompt compartido por todas las instancias
+        self.prompt_template = _RAG_PROMPT
+        
+        # Límite de llamadas concurrentes al LLM
+        self._llm_semaphore = asyncio.Semaphore(settings.LLM_CONCURRENCY)
+        
+        self._ready = False
+        self._ready_lock = asyncio.Lock()
+    
+    def _setup(self) -> None:
+        """Crear el cliente de OpenAI, el retriever y las cadenas de RAG"""
         try:
             # Configurar cliente de Azure OpenAI
             self.openai_client = get_openai_client()
@@ -34,18 +133,30 @@ class ConversationAgent:
             # Configurar retriever de Azure AI Search
             self.retriever = self._setup_retriever()
             
-            # Configurar prompt template
-            self.prompt_template = self._setup_prompt_template()
-            
             # Configurar cadena de RAG
             self.qa_chain = self._setup_qa_chain()
             
+            # Cadena map_reduce para contextos que no caben en un solo prompt (opcional)
+            self.map_reduce_chain = self._setup_qa_chain("map_reduce") if settings.RAG_CHAIN_TYPE == "map_reduce" else None
+            
             logger.info("Agente conversacional inicializado correctamente")
             
         except Exception as e:
-            logger.error(f"Error inicializando agente conversacional: {str(e)}")
+            logger.error("Error inicializando agente conversacional: %s", e)
             raise
     
+    async def _ensure_ready(self) -> None:
+        """
+        Inicializar el agente la primera vez que se usa
+        La construcción (síncrona) se ejecuta en un hilo para no bloquear el event loop
+        """
+        if self._ready:
+            return
+        async with self._ready_lock:
+            if not self._ready:
+                await asyncio.to_thread(self._setup)
+                self._ready = True
+    
     def _setup_retriever(self) -> AzureCognitiveSearchRetriever:
         """
         Configurar el retriever de Azure AI Search
@@ -68,67 +179,45 @@ class ConversationAgent:
             return retriever
             
         except Exception as e:
-            logger.error(f"Error configurando retriever: {str(e)}")
+            logger.error("Error configurando retriever: %s", e)
             raise
     
-    def _setup_prompt_template(self) -> PromptTemplate:
-        """
-        Configurar el template de prompt para RAG
-        
-        Returns:
-            PromptTemplate configurado
-        """
-        try:
-            template = """
-            Eres un asistente de IA inteligente y útil para la aplicación mfn-mvp.
-            
-            Basándote ÚNICAMENTE en el siguiente contexto, responde la pregunta del usuario.
-            Si la información no está en el contexto, indica claramente que no tienes esa información.
-            
-            Contexto:
-            {context}
-            
-            Pregunta: {question}
-            
-            Respuesta:
-            """
-            
-            prompt_template = PromptTemplate(
-                template=template,
-                input_variables=["context", "question"]
-            )
-            
-            logger.info("Template de prompt configurado correctamente")
-            return prompt_template
-            
-        except Exception as e:
-            logger.error(f"Error configurando prompt template: {str(e)}")
-            raise
-    
-    def _setup_qa_chain(self) -> RetrievalQA:
+    def _setup_qa_chain(self, chain_type: str = "stuff") -> RetrievalQA:
         """
         Configurar la cadena de RAG
         
+        Args:
+            chain_type: Tipo de cadena ("stuff" o "map_reduce")
+            
         Returns:
             RetrievalQA configurado
         """
         try:
+            if chain_type == "map_reduce":
+                chain_type_kwargs = {
+                    "question_prompt": _MAP_PROMPT,
+                    "combine_prompt": _REDUCE_PROMPT,
+                    "verbose": settings.DEBUG
+                }
+            else:
+                chain_type_kwargs = {
+                    "prompt": self.prompt_template,
+                    "verbose": settings.DEBUG
+                }
+            
             qa_chain = RetrievalQA.from_chain_type(
                 llm=self.openai_client,
-                chain_type="stuff",
+                chain_type=chain_type,
                 retriever=self.retriever,
-                chain_type_kwargs={
-                    "prompt": self.prompt_template,
-                    "verbose": settings.DEBUG
-                },
+                chain_type_kwargs=chain_type_kwargs,
                 return_source_documents=True
             )
             
-            logger.info("Cadena de RAG configurada correctamente")
+            logger.info("Cadena de RAG (%s) configurada correctamente", chain_type)
             return qa_chain
             
         except Exception as e:
-            logger.error(f"Error configurando cadena de RAG: {str(e)}")
+            logger.error("Error configurando cadena de RAG: %s", e)
             raise
     
     async def ask(self, question: str) -> Dict[str, Any]:
@@ -142,9 +231,10 @@ class ConversationAgent:
             Respuesta con información detallada del proceso RAG
         """
         try:
-            start_time = datetime.utcnow()
+            start_time = time.perf_counter()
             
-            logger.info(f"🤔 Procesando pregunta: {question}")
+            logger.info("🤔 Procesando pregunta: %s", question)
+            await self._ensure_ready()
             
             # 1. Recuperar documentos relevantes
             relevant_docs = await self._retrieve_documents(question)
@@ -152,8 +242,7 @@ class ConversationAgent:
             # 2. Generar respuesta usando la cadena de RAG
             response = await self._generate_response(question, relevant_docs)
             
-            end_time = datetime.utcnow()
-            processing_time = (end_time - start_time).total_seconds()
+            processing_time = time.perf_counter() - start_time
             
             # 3. Construir respuesta final
             result = {
@@ -167,11 +256,11 @@ class ConversationAgent:
                 "retrieval_strategy": "Azure AI Search + RAG"
             }
             
-            logger.info(f"✅ Respuesta generada en {processing_time:.2f}s")
+            logger.info("✅ Respuesta generada en %.2fs", processing_time)
             return result
             
         except Exception as e:
-            logger.error(f"❌ Error procesando pregunta: {str(e)}")
+            logger.error("❌ Error procesando pregunta: %s", e)
             return {
                 "success": False,
                 "question": question,
@@ -179,6 +268,52 @@ class ConversationAgent:
                 "answer": "Lo siento, no pude procesar tu pregunta en este momento."
             }
     
+    async def ask_stream(self, question: str) -> AsyncIterator[Dict[str, Any]]:
+        """
+        Procesar una pregunta del usuario usando RAG emitiendo la respuesta por partes
+        
+        Args:
+            question: Pregunta del usuario
+            
+        Yields:
+            Eventos {"delta": texto} a medida que el modelo genera la respuesta y,
+            al final, un evento con el resultado ("success", tiempos y documentos)
+        """
+        try:
+            start_time = time.perf_counter()
+            
+            logger.info("🤔 Procesando pregunta en streaming: %s", question)
+            await self._ensure_ready()
+            
+            # 1. Recuperar documentos relevantes
+            relevant_docs = await self._retrieve_documents(question)
+            
+            # 2. Construir el prompt con el mismo template que la cadena de RAG
+            context = "\n\n".join(doc.page_content for doc in relevant_docs)
+            prompt = self.prompt_template.format(context=context, question=question)
+            
+            # 3. Emitir la respuesta a medida que se genera
+            async with self._llm_semaphore:
+                async for chunk in self.openai_client.astream(prompt):
+                    if chunk.content:
+                        yield {"delta": chunk.content}
+            
+            processing_time = time.perf_counter() - start_time
+            
+            logger.info("✅ Respuesta en streaming generada en %.2fs", processing_time)
+            yield {
+                "success": True,
+                "processing_time_seconds": processing_time,
+                "documents_retrieved": len(relevant_docs)
+            }
+            
+        except Exception as e:
+            logger.error("❌ Error procesando pregunta en streaming: %s", e)
+            yield {
+                "success": False,
+                "error": str(e)
+            }
+    
     async def _retrieve_documents(self, question: str) -> List[Document]:
         """
         Recuperar documentos relevantes usando el retriever
@@ -191,24 +326,77 @@ class ConversationAgent:
         """
         try:
             # Usar el retriever para obtener documentos relevantes
-            documents = await asyncio.to_thread(
-                self.retriever.get_relevant_documents,
-                question
-            )
+            documents = await self.retriever.ainvoke(question)
             
-            logger.info(f"📚 Documentos recuperados: {len(documents)}")
+            logger.info("📚 Documentos recuperados: %d", len(documents))
             
-            # Logging de documentos recuperados
-            for i, doc in enumerate(documents[:3]):  # Mostrar solo los primeros 3
-                source = doc.metadata.get("source", "Desconocido")
-                logger.info(f"   Documento {i+1}: {source} ({len(doc.page_content)} caracteres)")
+            # Logging de documentos recuperados (solo si el nivel INFO está activo)
+            if logger.is_enabled_for(logging.INFO):
+                for i, doc in enumerate(documents[:3], 1):  # Mostrar solo los primeros 3
+                    logger.info("   Documento %d: %s (%d caracteres)", i, doc.metadata.get("source", "Desconocido"), len(doc.page_content))
             
             return documents
             
         except Exception as e:
-            logger.error(f"Error recuperando documentos: {str(e)}")
+            logger.error("Error recuperando documentos: %s", e)
             return []
     
+    def _expand_queries(self, question: str, additional_context: str = "") -> List[str]:
+        """
+        Generar variantes de la pregunta para mejorar la cobertura de la búsqueda
+        Las variantes se obtienen con reglas, sin llamadas al LLM
+        
+        Args:
+            question: Pregunta del usuario
+            additional_context: Contexto adicional de la pregunta
+            
+        Returns:
+            Lista de consultas sin duplicados, empezando por la pregunta original
+        """
+        queries = [question]
+        
+        # Variante con solo las palabras significativas
+        keywords = " ".join(word.strip("¿?¡!.,;:") for word in question.split() if len(word.strip("¿?¡!.,;:")) > 3)
+        if keywords:
+            queries.append(keywords)
+        
+        # Variante enriquecida con el contexto adicional
+        if additional_context:
+            queries.append(f"{question} {additional_context[:200]}")
+        
+        return list(dict.fromkeys(queries))
+    
+    async def _retrieve_documents_multi(self, question: str, additional_context: str = "") -> List[Document]:
+        """
+        Recuperar documentos para varias variantes de la pregunta en paralelo
+        Los resultados se deduplican y se quedan los TOP_K con mejor puntuación
+        
+        Args:
+            question: Pregunta del usuario
+            additional_context: Contexto adicional de la pregunta
+            
+        Returns:
+            Lista de documentos relevantes
+        """
+        queries = self._expand_queries(question, additional_context)
+        if len(queries) == 1:
+            return await self._retrieve_documents(question)
+        
+        documents_per_query = await asyncio.gather(*[self._retrieve_documents(query) for query in queries])
+        
+        # Deduplicar por id conservando la mejor puntuación de cada documento
+        best: Dict[str, Document] = {}
+        for documents in documents_per_query:
+            for doc in documents:
+                key = doc.metadata.get("id") or doc.page_content
+                current = best.get(key)
+                if current is None or (doc.metadata.get("@search.score") or 0.0) > (current.metadata.get("@search.score") or 0.0):
+                    best[key] = doc
+        
+        ranked = sorted(best.values(), key=lambda doc: doc.metadata.get("@search.score") or 0.0, reverse=True)
+        logger.info("📚 Búsqueda multi-consulta: %d consultas, %d documentos únicos", len(queries), len(best))
+        return ranked[:settings.TOP_K_DOCUMENTS]
+    
     async def _generate_response(self, question: str, documents: List[Document]) -> Dict[str, Any]:
         """
         Generar respuesta usando la cadena de RAG
@@ -221,16 +409,23 @@ class ConversationAgent:
             Respuesta generada
         """
         try:
+            # Si el contexto recuperado no cabe en el presupuesto, usar map_reduce (si está habilitado)
+            chain = self.qa_chain
+            if self.map_reduce_chain is not None:
+                context_tokens = sum(count_tokens(doc.page_content) for doc in documents)
+                if context_tokens > get_context_token_budget():
+                    logger.info("🧩 Contexto de %d tokens: usando cadena map_reduce", context_tokens)
+                    chain = self.map_reduce_chain
+            
             # Usar la cadena de RAG para generar respuesta
-            response = await asyncio.to_thread(
-                self.qa_chain,
-                {"query": question}
-            )
+            # El semáforo limita las llamadas concurrentes al LLM para no exceder los límites de Azure
+            async with self._llm_semaphore:
+                response = await chain.ainvoke({"query": question})
             
             return response
             
         except Exception as e:
-            logger.error(f"Error generando respuesta: {str(e)}")
+            logger.error("Error generando respuesta: %s", e)
             raise
     
     def _format_source_documents(self, documents: List[Document]) -> List[Dict[str, Any]]:
@@ -241,22 +436,19 @@ class ConversationAgent:
             documents: Lista de documentos de LangChain
             
         Returns:
-            Lista de documentos formateados
+            Lista de documentos formateados (dicts con los campos de FormattedDoc)
         """
-        formatted_docs = []
-        
-        for i, doc in enumerate(documents):
-            formatted_doc = {
-                "id": i + 1,
-                "content": doc.page_content[:200] + "..." if len(doc.page_content) > 200 else doc.page_content,
-                "source": doc.metadata.get("source", "Desconocido"),
-                "chunk_id": doc.metadata.get("chunk_id", "N/A"),
-                "confidence": doc.metadata.get("confidence", "N/A"),
-                "full_content_length": len(doc.page_content)
-            }
-            formatted_docs.append(formatted_doc)
-        
-        return formatted_docs
+        return [
+            asdict(FormattedDoc(
+                id=i,
+                content=content[:200] + "..." if (length := len(content := doc.page_content)) > 200 else content,
+                source=(metadata := doc.metadata).get("source", "Desconocido"),
+                chunk_id=metadata.get("chunk_id", "N/A"),
+                confidence=metadata.get("confidence", "N/A"),
+                full_content_length=length
+            ))
+            for i, doc in enumerate(documents, 1)
+        ]
     
     async def ask_with_custom_context(self, question: str, additional_context: str = "") -> Dict[str, Any]:
         """
@@ -270,21 +462,22 @@ class ConversationAgent:
             Respuesta con contexto adicional
         """
         try:
-            start_time = datetime.utcnow()
+            start_time = time.perf_counter()
             
-            logger.info(f"🤔 Procesando pregunta con contexto adicional: {question}")
+            logger.info("🤔 Procesando pregunta con contexto adicional: %s", question)
+            await self._ensure_ready()
             
-            # 1. Recuperar documentos relevantes
-            relevant_docs = await self._retrieve_documents(question)
+            # 1. Recuperar documentos (multi-consulta)
+            relevant_docs = await self._retrieve_documents_multi(question, additional_context)
             
             # 2. Construir prompt con contexto adicional
-            enhanced_prompt = self._build_enhanced_prompt(question, relevant_docs, additional_context)
+            enhanced_prompt = self._build_enhanced_prompt(" ".join(question.split()), relevant_docs, additional_context)
             
             # 3. Generar respuesta
-            response = await self.openai_client.ainvoke(enhanced_prompt)
+            async with self._llm_semaphore:
+                response = await self.openai_client.ainvoke(enhanced_prompt)
             
-            end_time = datetime.utcnow()
-            processing_time = (end_time - start_time).total_seconds()
+            processing_time = time.perf_counter() - start_time
             
             result = {
                 "success": True,
@@ -298,11 +491,11 @@ class ConversationAgent:
                 "retrieval_strategy": "Azure AI Search + RAG + Contexto Adicional"
             }
             
-            logger.info(f"✅ Respuesta con contexto adicional generada en {processing_time:.2f}s")
+            logger.info("✅ Respuesta con contexto adicional generada en %.2fs", processing_time)
             return result
             
         except Exception as e:
-            logger.error(f"❌ Error procesando pregunta con contexto: {str(e)}")
+            logger.error("❌ Error procesando pregunta con contexto: %s", e)
             return {
                 "success": False,
                 "question": question,
@@ -310,7 +503,7 @@ class ConversationAgent:
                 "answer": "Lo siento, no pude procesar tu pregunta en este momento."
             }
     
-    def _build_enhanced_prompt(self, question: str, documents: List[Document], additional_context: str) -> str:
+    def _build_enhanced_prompt(self, question: str, documents: List[Document], additional_context: str, token_budget: Optional[int] = None) -> str:
         """
         Construir prompt mejorado con contexto adicional
         
@@ -318,34 +511,33 @@ class ConversationAgent:
             question: Pregunta del usuario
             documents: Documentos relevantes
             additional_context: Contexto adicional
+            token_budget: Tokens máximos para los documentos (por defecto, el presupuesto configurado)
             
         Returns:
             Prompt mejorado
         """
-        # Construir contexto de documentos
-        context_parts = []
-        for i, doc in enumerate(documents, 1):
-            context_parts.append(f"Documento {i} (Fuente: {doc.metadata.get('source', 'Desconocido')}):\n{doc.page_content}\n")
-        
-        context = "\n".join(context_parts)
-        
-        # Construir prompt completo
-        prompt = f"""
-        Eres un asistente de IA inteligente y útil para la aplicación mfn-mvp.
-        
-        Basándote en el siguiente contexto y la información adicional proporcionada, 
-        responde la pregunta del usuario de manera completa y precisa.
+        # Ajustar los documentos al presupuesto: más relevantes en los extremos
+        packed = pack_by_relevance(
+            documents,
+            get_score=lambda doc: doc.metadata.get("@search.score") or 0.0,
+            get_text=lambda doc: doc.page_content,
+            token_budget=get_context_token_budget() if token_budget is None else token_budget
+        )
         
-        Contexto de documentos:
-        {context}
-        
-        Información adicional:
-        {additional_context}
-        
-        Pregunta: {question}
+        # Construir contexto de documentos
+        context = "\n".join(
+            f"Documento {i} (Fuente: {doc.metadata.get('source', 'Desconocido')}):\n{content}"
+            for i, (doc, content) in enumerate(packed, 1)
+        )
         
-        Respuesta:
-        """
+        # Construir prompt completo sobre el prefijo fijo
+        prompt = "".join((
+            _ENHANCED_SYSTEM_PREFIX,
+            "\nContexto de documentos:\n", context,
+            "\nInformación adicional:\n", additional_context,
+            "\nPregunta: ", question,
+            "\nRespuesta:"
+        ))
         
         return prompt
     
@@ -360,7 +552,7 @@ class ConversationAgent:
             Historial de conversación
         """
         # TODO: Implementar almacenamiento de historial de conversación
-        logger.info(f"📝 Obteniendo historial para sesión: {session_id}")
+        logger.info("📝 Obteniendo historial para sesión: %s", session_id)
         
         return [
             {
@@ -379,6 +571,7 @@ class ConversationAgent:
         """
         try:
             logger.info("🔍 Validando agente conversacional...")
+            await self._ensure_ready()
             
             # Validar cliente de OpenAI
             if not self.openai_client:
@@ -404,7 +597,7 @@ class ConversationAgent:
                 return False
                 
         except Exception as e:
-            logger.error(f"❌ Error validando agente: {str(e)}")
+            logger.error("❌ Error validando agente: %s", e)
             return False
     
     def get_agent_info(self) -> Dict[str, Any]:
@@ -427,5 +620,12 @@ class ConversationAgent:
             "created_at": datetime.utcnow().isoformat()
         }
 
-# Instancia global del agente conversacional
-conversation_agent = ConversationAgent()
+@functools.cache
+def get_conversation_agent() -> ConversationAgent:
+    """
+    Obtener la instancia global del agente, creándola en el primer uso
+    
+    Returns:
+        Instancia compartida de ConversationAgent
+    """
+    return ConversationAgent()
@@ -6,8 +6,9 @@ Muestra cómo usar el ConversationAgent para responder preguntas con RAG
 import asyncio
 from typing import List
 
-from app.core.conversation_agent import conversation_agent
-from app.utils.logger import get_logger
+from app.core.conversation_agent import get_conversation_agent
+from app.utils.azure_clients import close_openai_http_client
+from app.utils.logger import get_logger, setup_logging
 
 logger = get_logger(__name__)
 
@@ -19,27 +20,27 @@ async def example_basic_question():
         question = "¿Qué es la inteligencia artificial?"
         
         # Procesar pregunta
-        result = await conversation_agent.ask(question)
+        result = await get_conversation_agent().ask(question)
         
         if result["success"]:
-            logger.info(f"✅ Respuesta generada:")
-            logger.info(f"   Pregunta: {result['question']}")
-            logger.info(f"   Respuesta: {result['answer'][:200]}...")
-            logger.info(f"   Documentos recuperados: {result['documents_retrieved']}")
-            logger.info(f"   Tiempo de procesamiento: {result['processing_time_seconds']:.2f}s")
+            logger.info("✅ Respuesta generada:")
+            logger.info("   Pregunta: %s", result['question'])
+            logger.info("   Respuesta: %s...", result['answer'][:200])
+            logger.info("   Documentos recuperados: %s", result['documents_retrieved'])
+            logger.info("   Tiempo de procesamiento: %.2fs", result['processing_time_seconds'])
             
             # Mostrar documentos fuente
             if result['source_documents']:
                 logger.info("   Documentos fuente:")
                 for doc in result['source_documents'][:2]:  # Mostrar solo los primeros 2
-                    logger.info(f"     - {doc['source']}: {doc['content'][:100]}...")
+                    logger.info("     - %s: %s...", doc['source'], doc['content'][:100])
         else:
-            logger.error(f"❌ Error: {result.get('error', 'Error desconocido')}")
+            logger.error("❌ Error: %s", result.get('error', 'Error desconocido'))
         
         return result
         
     except Exception as e:
-        logger.error(f"❌ Error en ejemplo básico: {str(e)}")
+        logger.error("❌ Error en ejemplo básico: %s", e)
         raise
 
 async def example_technical_question():
@@ -50,21 +51,21 @@ async def example_technical_question():
         question = "¿Cuáles son los diferentes tipos de machine learning?"
         
         # Procesar pregunta
-        result = await conversation_agent.ask(question)
+        result = await get_conversation_agent().ask(question)
         
         if result["success"]:
-            logger.info(f"✅ Respuesta técnica generada:")
-            logger.info(f"   Pregunta: {result['question']}")
-            logger.info(f"   Respuesta: {result['answer'][:300]}...")
-            logger.info(f"   Estrategia: {result['retrieval_strategy']}")
-            logger.info(f"   Modelo usado: {result['model']}")
+            logger.info("✅ Respuesta técnica generada:")
+            logger.info("   Pregunta: %s", result['question'])
+            logger.info("   Respuesta: %s...", result['answer'][:300])
+            logger.info("   Estrategia: %s", result['retrieval_strategy'])
+            logger.info("   Modelo usado: %s", result['model'])
         else:
-            logger.error(f"❌ Error: {result.get('error', 'Error desconocido')}")
+            logger.error("❌ Error: %s", result.get('error', 'Error desconocido'))
         
         return result
         
     except Exception as e:
-        logger.error(f"❌ Error en ejemplo técnico: {str(e)}")
+        logger.error("❌ Error en ejemplo técnico: %s", e)
         raise
 
 async def example_question_with_context():
@@ -80,21 +81,21 @@ async def example_question_with_context():
         """
         
         # Procesar pregunta con contexto
-        result = await conversation_agent.ask_with_custom_context(question, additional_context)
+        result = await get_conversation_agent().ask_with_custom_context(question, additional_context)
         
         if result["success"]:
-            logger.info(f"✅ Respuesta con contexto generada:")
-            logger.info(f"   Pregunta: {result['question']}")
-            logger.info(f"   Contexto adicional: {result['additional_context'][:100]}...")
-            logger.info(f"   Respuesta: {result['answer'][:250]}...")
-            logger.info(f"   Estrategia: {result['retrieval_strategy']}")
+            logger.info("✅ Respuesta con contexto generada:")
+            logger.info("   Pregunta: %s", result['question'])
+            logger.info("   Contexto adicional: %s...", result['additional_context'][:100])
+            logger.info("   Respuesta: %s...", result['answer'][:250])
+            logger.info("   Estrategia: %s", result['retrieval_strategy'])
         else:
-            logger.error(f"❌ Error: {result.get('error', 'Error desconocido')}")
+            logger.error("❌ Error: %s", result.get('error', 'Error desconocido'))
         
         return result
         
     except Exception as e:
-        logger.error(f"❌ Error en ejemplo con contexto: {str(e)}")
+        logger.error("❌ Error en ejemplo con contexto: %s", e)
         raise
 
 async def example_multiple_questions():
@@ -109,32 +110,35 @@ async def example_multiple_questions():
             "¿Qué son las redes neuronales convolucionales?"
         ]
         
-        results = []
+        # Las preguntas son independientes: se procesan todas en paralelo
+        # (el agente ya limita las llamadas concurrentes al LLM)
+        agent = get_conversation_agent()
+        results = await asyncio.gather(*(agent.ask(question) for question in questions))
         
-        for i, question in enumerate(questions, 1):
-            logger.info(f"   Procesando pregunta {i}/{len(questions)}: {question}")
-            
-            result = await conversation_agent.ask(question)
-            results.append(result)
+        for i, (question, result) in enumerate(zip(questions, results), 1):
+            logger.info("   Pregunta %s/%d: %s", i, len(questions), question)
             
             if result["success"]:
-                logger.info(f"   ✅ Respuesta {i}: {result['answer'][:100]}...")
+                logger.info("   ✅ Respuesta %s: %s...", i, result['answer'][:100])
             else:
-                logger.error(f"   ❌ Error en pregunta {i}: {result.get('error', 'Error desconocido')}")
+                logger.error("   ❌ Error en pregunta %s: %s", i, result.get('error', 'Error desconocido'))
         
-        # Resumen
+        # Resumen (el tiempo total suma los tiempos individuales, que se solapan)
         successful = sum(1 for r in results if r["success"])
         total_time = sum(r.get("processing_time_seconds", 0) for r in results if r["success"])
         
-        logger.info(f"📊 Resumen de preguntas:")
-        logger.info(f"   - Preguntas exitosas: {successful}/{len(questions)}")
-        logger.info(f"   - Tiempo total: {total_time:.2f}s")
-        logger.info(f"   - Tiempo promedio: {total_time/successful:.2f}s por pregunta" if successful > 0 else "   - No hay preguntas exitosas")
+        logger.info("📊 Resumen de preguntas:")
+        logger.info("   - Preguntas exitosas: %s/%d", successful, len(questions))
+        logger.info("   - Tiempo total: %.2fs", total_time)
+        if successful > 0:
+            logger.info("   - Tiempo promedio: %.2fs por pregunta", total_time / successful)
+        else:
+            logger.info("   - No hay preguntas exitosas")
         
         return results
         
     except Exception as e:
-        logger.error(f"❌ Error en ejemplo múltiple: {str(e)}")
+        logger.error("❌ Error en ejemplo múltiple: %s", e)
         raise
 
 async def example_agent_validation():
@@ -143,26 +147,26 @@ async def example_agent_validation():
         logger.info("🔍 Ejemplo: Validando agente conversacional")
         
         # Validar agente
-        is_valid = await conversation_agent.validate_agent()
+        is_valid = await get_conversation_agent().validate_agent()
         
         if is_valid:
             logger.info("✅ Agente conversacional validado correctamente")
             
             # Obtener información del agente
-            agent_info = conversation_agent.get_agent_info()
+            agent_info = get_conversation_agent().get_agent_info()
             logger.info("📋 Información del agente:")
-            logger.info(f"   - Tipo: {agent_info['agent_type']}")
-            logger.info(f"   - Modelo: {agent_info['model']}")
-            logger.info(f"   - Retriever: {agent_info['retriever_type']}")
-            logger.info(f"   - Índice de búsqueda: {agent_info['search_index']}")
-            logger.info(f"   - Documentos top-k: {agent_info['top_k_documents']}")
+            logger.info("   - Tipo: %s", agent_info['agent_type'])
+            logger.info("   - Modelo: %s", agent_info['model'])
+            logger.info("   - Retriever: %s", agent_info['retriever_type'])
+            logger.info("   - Índice de búsqueda: %s", agent_info['search_index'])
+            logger.info("   - Documentos top-k: %s", agent_info['top_k_documents'])
         else:
             logger.error("❌ Agente conversacional tiene problemas")
         
         return is_valid
         
     except Exception as e:
-        logger.error(f"❌ Error validando agente: {str(e)}")
+        logger.error("❌ Error validando agente: %s", e)
         raise
 
 async def example_conversation_flow():
@@ -180,11 +184,13 @@ async def example_conversation_flow():
         
         conversation_history = []
         
-        for i, question in enumerate(conversation, 1):
-            logger.info(f"   Turno {i}: {question}")
+        # El agente no guarda historial, así que los turnos pueden procesarse en paralelo
+        agent = get_conversation_agent()
+        results = await asyncio.gather(*(agent.ask(question) for question in conversation))
+        
+        for i, (question, result) in enumerate(zip(conversation, results), 1):
+            logger.info("   Turno %s: %s", i, question)
             
-            # Procesar pregunta
-            result = await conversation_agent.ask(question)
             conversation_history.append({
                 "turn": i,
                 "question": question,
@@ -193,24 +199,21 @@ async def example_conversation_flow():
             })
             
             if result["success"]:
-                logger.info(f"   Respuesta: {result['answer'][:150]}...")
+                logger.info("   Respuesta: %s...", result['answer'][:150])
             else:
-                logger.error(f"   Error: {result.get('error', 'Error desconocido')}")
-            
-            # Pausa entre preguntas
-            await asyncio.sleep(1)
+                logger.error("   Error: %s", result.get('error', 'Error desconocido'))
         
         # Resumen de la conversación
         successful_turns = sum(1 for turn in conversation_history if turn["success"])
         
-        logger.info(f"📝 Resumen de la conversación:")
-        logger.info(f"   - Turnos exitosos: {successful_turns}/{len(conversation)}")
-        logger.info(f"   - Conversación completada: {'Sí' if successful_turns == len(conversation) else 'Parcialmente'}")
+        logger.info("📝 Resumen de la conversación:")
+        logger.info("   - Turnos exitosos: %s/%d", successful_turns, len(conversation))
+        logger.info("   - Conversación completada: %s", 'Sí' if successful_turns == len(conversation) else 'Parcialmente')
         
         return conversation_history
         
     except Exception as e:
-        logger.error(f"❌ Error en flujo de conversación: {str(e)}")
+        logger.error("❌ Error en flujo de conversación: %s", e)
         raise
 
 async def main():
@@ -218,35 +221,29 @@ async def main():
     try:
         logger.info("🚀 Iniciando ejemplos del agente conversacional...")
         
-        # 1. Validar agente
+        # 1. Validar agente (debe ejecutarse antes que el resto)
         logger.info("=" * 60)
         await example_agent_validation()
         
-        # 2. Pregunta básica
-        logger.info("=" * 60)
-        await example_basic_question()
-        
-        # 3. Pregunta técnica
-        logger.info("=" * 60)
-        await example_technical_question()
-        
-        # 4. Pregunta con contexto
-        logger.info("=" * 60)
-        await example_question_with_context()
-        
-        # 5. Múltiples preguntas
-        logger.info("=" * 60)
-        await example_multiple_questions()
-        
-        # 6. Flujo de conversación
+        # 2-6. Ejemplos independientes entre sí: se ejecutan en paralelo
         logger.info("=" * 60)
-        await example_conversation_flow()
+        await asyncio.gather(
+            example_basic_question(),
+            example_technical_question(),
+            example_question_with_context(),
+            example_multiple_questions(),
+            example_conversation_flow()
+        )
         
         logger.info("🎉 Todos los ejemplos del agente conversacional completados exitosamente!")
         
     except Exception as e:
-        logger.error(f"❌ Error en ejemplos del agente conversacional: {str(e)}")
+        logger.error("❌ Error en ejemplos del agente conversacional: %s", e)
+    finally:
+        # Cerrar el cliente HTTP compartido antes de que asyncio.run cierre el loop
+        await close_openai_http_client()
 
 if __name__ == "__main__":
+    setup_logging()
     # Ejecutar ejemplos
     asyncio.run(main())
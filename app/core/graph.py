@@ -3,18 +3,98 @@ Define el flujo del agente de procesamiento y consulta de facturas
 utilizando LangGraph, con una lógica de enrutamiento para manejar
 preguntas simples y complejas (multi-paso).
 """
-import json
-from typing import TypedDict, List, Literal
+import asyncio
+import functools
+import re
+from typing import TypedDict, List, Literal, Optional, get_args
+
+import orjson
+from cachetools import LRUCache, TTLCache
 
 from langgraph.graph import StateGraph, END
 from langchain_core.prompts import ChatPromptTemplate
 
-from app.core.rag_pipeline import invoice_processor
-from app.utils.azure_clients import get_openai_client
+from app.core.rag_pipeline import build_invoice_filter, invoice_processor
+from app.utils.azure_clients import get_openai_client, get_openai_small_client
 from app.utils.logger import get_logger
 
 logger = get_logger(__name__)
 
+# --- Clasificador local de preguntas (evita la llamada al LLM en el router) ---
+BALANCE_RE = re.compile(r"\b(balance|resultado final|neto|ganancia|p[ée]rdida)\b", re.I)
+SUMMARY_RE = re.compile(r"\b(resumen|resum[ií]|panorama|situaci[óo]n)\b", re.I)
+SIMPLE_RE = re.compile(
+    r"\b(joni|hernan|hernán|maxi|leo|ingresos?|egresos?|gast[óoa]s?|gastaron|factura[s]?|compras?|ventas?)\b",
+    re.I
+)
+
+# Entidades filtrables: socios y tipo de factura
+PARTNER_RE = re.compile(r"\b(joni|hern[aá]n|maxi|leo)\b", re.I)
+INCOME_RE = re.compile(r"\b(ingresos?|cobr[óoa]s?|cobraron|ventas?)\b", re.I)
+EXPENSE_RE = re.compile(r"\b(egresos?|gast[óoa]s?|gastaron|compras?)\b", re.I)
+
+def _build_filter_by_rules(question: str) -> Optional[str]:
+    """
+    Construir el filtro OData directamente cuando las entidades son inequívocas
+    
+    Args:
+        question: Pregunta del usuario
+        
+    Returns:
+        Filtro OData, 'NO_FILTER' si no hay entidades, o None si el caso es ambiguo
+    """
+    partners = {match.upper().replace("Á", "A") for match in PARTNER_RE.findall(question)}
+    types = set()
+    if INCOME_RE.search(question):
+        types.add("ingreso")
+    if EXPENSE_RE.search(question):
+        types.add("egreso")
+    
+    if not partners and not types:
+        return "NO_FILTER"
+    if len(partners) > 1 or len(types) > 1:
+        return None
+    
+    return build_invoice_filter(next(iter(partners), None), next(iter(types), None))
+
+@functools.lru_cache(maxsize=1024)
+def _classify_by_rules(question: str) -> Optional[str]:
+    """
+    Clasificar la pregunta con expresiones regulares
+    
+    Args:
+        question: Pregunta normalizada (minúsculas, espacios simples)
+        
+    Returns:
+        Categoría de la tarea, o None si ninguna regla aplica
+    """
+    if BALANCE_RE.search(question):
+        return "calculo_balance"
+    if SUMMARY_RE.search(question):
+        return "resumen_general"
+    if SIMPLE_RE.search(question):
+        return "busqueda_simple"
+    return None
+
+# Campos de cada factura que se envían al LLM y máximo de facturas por prompt
+_PROMPT_FIELDS = ("PartnerName", "InvoiceType", "VendorName", "InvoiceTotal", "InvoiceDate")
+_MAX_PROMPT_RESULTS = 20
+
+# Decisiones del LLM para preguntas que las reglas no clasifican
+_llm_route_cache: LRUCache = LRUCache(maxsize=1024)
+
+# --- Herramienta de clasificación: obliga al router a responder con una categoría válida ---
+TaskType = Literal["busqueda_simple", "calculo_balance", "resumen_general"]
+_TASK_TYPES = frozenset(get_args(TaskType))
+
+def classify(task_type: TaskType) -> str:
+    """Clasificar la pregunta del usuario en una categoría de tarea.
+
+    Args:
+        task_type: Categoría de la pregunta
+    """
+    return task_type
+
 # --- 1. Definimos el Estado del Agente (Ahora más completo) ---
 class AgentState(TypedDict):
     question: str
@@ -24,48 +104,84 @@ class AgentState(TypedDict):
     income_total: float
     expense_total: float
     final_answer: str
+    # Mensaje del error de búsqueda, si lo hubo; los estados con error no se guardan en caché
+    error: str | None
+
+# Respuesta cuando Azure AI Search falla durante la búsqueda o el cálculo de totales
+_SEARCH_ERROR_ANSWER = "Lo siento, no pude consultar las facturas en este momento. Intenta de nuevo en unos minutos."
 
 # --- 2. Creamos la Clase del Grafo y sus Nodos ---
 class AgentGraph:
+    # --- Prompts precompilados (se construyen una sola vez por proceso) ---
+    _ROUTER_PROMPT = ChatPromptTemplate.from_messages([
+        ("system",
+         "Tu tarea es clasificar la pregunta del usuario en una de las siguientes categorías para determinar el plan de acción: "
+         "`busqueda_simple`, `calculo_balance`, `resumen_general`. "
+         "- `busqueda_simple`: Preguntas sobre ingresos o egresos de una persona específica (Joni, Hernan, etc.), o listas de facturas. Ejemplos: 'cuánto gastó joni?', 'muéstrame los ingresos de hernan', 'lista las facturas de egreso'. "
+         "- `calculo_balance`: Preguntas que piden un balance total, comparando ingresos y egresos. Ejemplos: 'cuál es el balance general?', 'dame el resultado final'. "
+         "- `resumen_general`: Preguntas muy abiertas que piden un resumen de todo. Ejemplo: 'dame un resumen de la situación'. "
+         "Responde SIEMPRE Y ÚNICAMENTE con una de las categorías."
+         ),
+        ("user", "{question}")
+    ])
+
+    _FILTER_PROMPT = ChatPromptTemplate.from_messages([
+         ("system",
+          "Eres un experto programador que convierte preguntas a filtros OData para Azure AI Search. "
+          "Campos disponibles: `PartnerName`, `InvoiceType`. "
+          "Reglas: `PartnerName` puede ser 'JONI', 'HERNAN', 'MAXI', 'LEO'. `InvoiceType` puede ser 'ingreso' o 'egreso'. "
+          "Usa 'eq' para strings y 'and' para combinar. Si no se necesita filtro, responde 'NO_FILTER'. "
+          "Responde SIEMPRE Y ÚNICAMENTE con el filtro o 'NO_FILTER'."
+         ),
+        ("user", "Pregunta: {question}")
+    ])
+
+    _ANSWER_PROMPT = ChatPromptTemplate.from_messages([
+        ("system",
+         "Eres un asistente contable amigable y directo. Tu tarea es responder la pregunta del usuario basándote únicamente en los datos de las facturas que se te proporcionan. "
+         "Resume la información de forma clara. El número de facturas y el total ya están calculados sobre todas las facturas encontradas: "
+         "úsalos tal cual y no sumes la lista, que puede mostrar solo una parte. Responde en español."
+        ),
+        ("user", "Pregunta del usuario: {question}\n\n"
+                 "Facturas encontradas: {invoice_count}. Total de InvoiceTotal: ${invoice_total}\n"
+                 "Datos de {shown_count} de esas facturas:\n{search_results}")
+    ])
+
     def __init__(self):
+        # Modelo pequeño para clasificar y generar filtros; el grande solo para la respuesta final
+        self.llm_small = get_openai_small_client()
         self.llm = get_openai_client()
+        # Salida restringida con function calling: solo se generan los argumentos de la herramienta
+        self._router_chain = self._ROUTER_PROMPT | self.llm_small.bind_tools([classify], tool_choice="classify").bind(max_tokens=20)
+        self._filter_chain = self._FILTER_PROMPT | self.llm_small
+        self._answer_chain = self._ANSWER_PROMPT | self.llm
         self.graph = self._build_graph()
+        # Respuestas recientes por pregunta normalizada; se vacía al cargar nuevas facturas
+        self._response_cache: TTLCache = TTLCache(maxsize=2048, ttl=300)
         logger.info("✅ Grafo de LangGraph con router construido y compilado")
 
-    # --- Herramienta auxiliar para sumar totales ---
-    def _sum_totals(self, search_results: List[dict]) -> float:
-        total = 0.0
-        for result in search_results:
-            # El campo 'content' es un string JSON, necesitamos parsearlo
-            try:
-                content_data = json.loads(result.get("content", "{}"))
-                total += content_data.get("InvoiceTotal", 0.0)
-            except (json.JSONDecodeError, TypeError):
-                continue
-        return total
-
     # --- NODO 1 (NUEVO): El Router Estratégico ---
     async def route_question_node(self, state: AgentState) -> dict:
         logger.info("🧠 Nodo 1 (Router): Clasificando la pregunta...")
         question = state["question"]
-
-        prompt = ChatPromptTemplate.from_messages([
-            ("system",
-             "Tu tarea es clasificar la pregunta del usuario en una de las siguientes categorías para determinar el plan de acción: "
-             "`busqueda_simple`, `calculo_balance`, `resumen_general`. "
-             "- `busqueda_simple`: Preguntas sobre ingresos o egresos de una persona específica (Joni, Hernan, etc.), o listas de facturas. Ejemplos: 'cuánto gastó joni?', 'muéstrame los ingresos de hernan', 'lista las facturas de egreso'. "
-             "- `calculo_balance`: Preguntas que piden un balance total, comparando ingresos y egresos. Ejemplos: 'cuál es el balance general?', 'dame el resultado final'. "
-             "- `resumen_general`: Preguntas muy abiertas que piden un resumen de todo. Ejemplo: 'dame un resumen de la situación'. "
-             "Responde SIEMPRE Y ÚNICAMENTE con una de las categorías."
-             ),
-            ("user", "{question}")
-        ])
+        normalized = " ".join(question.lower().split())
         
-        chain = prompt | self.llm
-        response = await chain.ainvoke({"question": question})
-        task_type = response.content.strip()
+        # Primero reglas locales y decisiones anteriores; el LLM solo si ninguna aplica
+        task_type = _classify_by_rules(normalized) or _llm_route_cache.get(normalized)
+        if task_type:
+            logger.info("  B - Tarea clasificada como: %s", task_type)
+            return {"task_type": task_type}
+
+        response = await self._router_chain.ainvoke({"question": question})
+        if response.tool_calls:
+            task_type = response.tool_calls[0]["args"].get("task_type", "")
+        else:
+            task_type = response.content.strip()
+        # Solo se memorizan categorías válidas: una salida errónea del router no queda fijada
+        if task_type in _TASK_TYPES:
+            _llm_route_cache[normalized] = task_type
         
-        logger.info(f"  B - Tarea clasificada como: {task_type}")
+        logger.info("  B - Tarea clasificada como: %s", task_type)
         return {"task_type": task_type}
 
     # --- NODO 2a: Generar Filtro (para búsquedas simples) ---
@@ -73,20 +189,16 @@ class AgentGraph:
         # (Esta función es idéntica a la anterior)
         logger.info("🧠 Nodo 2a: Generando filtro para búsqueda simple...")
         question = state["question"]
-        prompt = ChatPromptTemplate.from_messages([
-             ("system",
-              "Eres un experto programador que convierte preguntas a filtros OData para Azure AI Search. "
-              "Campos disponibles: `PartnerName`, `InvoiceType`. "
-              "Reglas: `PartnerName` puede ser 'JONI', 'HERNAN', 'MAXI', 'LEO'. `InvoiceType` puede ser 'ingreso' o 'egreso'. "
-              "Usa 'eq' para strings y 'and' para combinar. Si no se necesita filtro, responde 'NO_FILTER'. "
-              "Responde SIEMPRE Y ÚNICAMENTE con el filtro o 'NO_FILTER'."
-             ),
-            ("user", "Pregunta: {question}")
-        ])
-        chain = prompt | self.llm
-        response = await chain.ainvoke({"question": question})
+        
+        # Casos simples (ninguna o una sola entidad de cada tipo) sin llamar al LLM
+        filter_query = _build_filter_by_rules(question)
+        if filter_query is not None:
+            logger.info("   - Filtro generado por reglas: %s", filter_query)
+            return {"filter_query": filter_query}
+        
+        response = await self._filter_chain.ainvoke({"question": question})
         filter_query = response.content.strip()
-        logger.info(f"   - Filtro generado: {filter_query}")
+        logger.info("   - Filtro generado: %s", filter_query)
         return {"filter_query": filter_query}
     
     # --- NODO 3a: Ejecutar Búsqueda Simple ---
@@ -95,28 +207,29 @@ class AgentGraph:
         logger.info("🔎 Nodo 3a: Ejecutando búsqueda simple...")
         filter_query = state["filter_query"]
         if filter_query and filter_query != "NO_FILTER":
-            search_results = await invoice_processor.query_invoices(filter_query)
-            logger.info(f"   - Se encontraron {len(search_results)} resultados.")
+            try:
+                search_results = await invoice_processor.search_invoices(filter_query)
+            except Exception as e:
+                logger.error("❌ Error durante la búsqueda: %s", e, exc_info=True)
+                return {"search_results": [], "error": str(e)}
+            logger.info("   - Se encontraron %d resultados.", len(search_results))
             return {"search_results": search_results}
         else:
             logger.info("   - No se generó un filtro. Saltando búsqueda.")
             return {"search_results": []}
 
-    # --- NODO 2b: Buscar Ingresos (para cálculo de balance) ---
-    async def search_income_node(self, state: AgentState) -> dict:
-        logger.info("💰 Nodo 2b: Buscando todos los ingresos...")
-        search_results = await invoice_processor.query_invoices("InvoiceType eq 'ingreso'")
-        income_total = self._sum_totals(search_results)
-        logger.info(f"   - Total de ingresos encontrado: {income_total}")
-        return {"income_total": income_total}
-
-    # --- NODO 3b: Buscar Egresos (para cálculo de balance) ---
-    async def search_expense_node(self, state: AgentState) -> dict:
-        logger.info("💸 Nodo 3b: Buscando todos los egresos...")
-        search_results = await invoice_processor.query_invoices("InvoiceType eq 'egreso'")
-        expense_total = self._sum_totals(search_results)
-        logger.info(f"   - Total de egresos encontrado: {expense_total}")
-        return {"expense_total": expense_total}
+    # --- NODO 2b: Buscar Ingresos y Egresos en una sola consulta (para cálculo de balance) ---
+    async def search_balance_node(self, state: AgentState) -> dict:
+        logger.info("💰 Nodo 2b: Buscando todos los ingresos y egresos...")
+        try:
+            totals = await invoice_processor.aggregate_by_type()
+        except Exception as e:
+            logger.error("❌ Error calculando los totales: %s", e, exc_info=True)
+            return {"error": str(e)}
+        income_total, expense_total = totals["ingreso"], totals["egreso"]
+        logger.info("   - Total de ingresos encontrado: %s", income_total)
+        logger.info("   - Total de egresos encontrado: %s", expense_total)
+        return {"income_total": income_total, "expense_total": expense_total}
 
     # --- NODO 4: Generar Respuesta (para todos los flujos) ---
     async def generate_answer_node(self, state: AgentState) -> dict:
@@ -124,6 +237,11 @@ class AgentGraph:
         question = state["question"]
         task_type = state["task_type"]
 
+        # Si la búsqueda falló no se inventa una respuesta con datos vacíos
+        if state.get("error"):
+            logger.info("   - La búsqueda falló, generando respuesta de error.")
+            return {"final_answer": _SEARCH_ERROR_ANSWER}
+
         # Si el flujo fue de cálculo de balance, usamos esos datos
         if task_type in ["calculo_balance", "resumen_general"]:
             income = state.get("income_total", 0.0)
@@ -146,24 +264,25 @@ class AgentGraph:
             logger.info("   - No hay resultados, generando respuesta por defecto.")
             return {"final_answer": final_answer}
 
-        prompt = ChatPromptTemplate.from_messages([
-            ("system",
-             "Eres un asistente contable amigable y directo. Tu tarea es responder la pregunta del usuario basándote únicamente en los datos de las facturas que se te proporcionan. "
-             "Resume la información de forma clara y, si hay montos, súmalos para dar un total. Responde en español."
-            ),
-            ("user", "Pregunta del usuario: {question}\n\n"
-                     "Estos son los datos de las facturas encontradas:\n{search_results}")
-        ])
-        chain = prompt | self.llm
-        response = await chain.ainvoke({"question": question, "search_results": str(search_results)})
+        # El conteo y el total se calculan aquí sobre todos los resultados; al LLM solo
+        # se le envía una muestra en JSON compacto para limitar los tokens del prompt
+        invoice_total = sum(result.get("InvoiceTotal") or 0.0 for result in search_results)
+        compact = [{field: result.get(field) for field in _PROMPT_FIELDS} for result in search_results[:_MAX_PROMPT_RESULTS]]
+        response = await self._answer_chain.ainvoke({
+            "question": question,
+            "invoice_count": len(search_results),
+            "invoice_total": f"{invoice_total:,.2f}",
+            "shown_count": len(compact),
+            "search_results": orjson.dumps(compact).decode()
+        })
         final_answer = response.content
-        logger.info(f"   - Respuesta de búsqueda simple generada.")
+        logger.info("   - Respuesta de búsqueda simple generada.")
         return {"final_answer": final_answer}
 
     # --- NODO DE "NO SÉ QUÉ HACER" ---
     def unsupported_node(self, state: AgentState) -> dict:
         final_answer = "No estoy seguro de cómo procesar esa pregunta. Por favor, intenta preguntarme sobre gastos, ingresos o un balance general."
-        logger.warning(f"   - Tarea no soportada: {state['task_type']}")
+        logger.warning("   - Tarea no soportada: %s", state['task_type'])
         return {"final_answer": final_answer}
 
     # --- Definimos la Lógica Condicional del Grafo ---
@@ -183,8 +302,7 @@ class AgentGraph:
         workflow.add_node("router", self.route_question_node)
         workflow.add_node("generate_filter", self.generate_filter_node)
         workflow.add_node("execute_search", self.execute_search_node)
-        workflow.add_node("search_income", self.search_income_node)
-        workflow.add_node("search_expense", self.search_expense_node)
+        workflow.add_node("search_balance", self.search_balance_node)
         workflow.add_node("generate_answer", self.generate_answer_node)
         workflow.add_node("unsupported", self.unsupported_node)
 
@@ -195,7 +313,7 @@ class AgentGraph:
             self.decide_path,
             {
                 "simple": "generate_filter",
-                "balance": "search_income",
+                "balance": "search_balance",
                 "unsupported": "unsupported"
             }
         )
@@ -205,8 +323,7 @@ class AgentGraph:
         workflow.add_edge("execute_search", "generate_answer")
 
         # Rama de Cálculo de Balance
-        workflow.add_edge("search_income", "search_expense")
-        workflow.add_edge("search_expense", "generate_answer")
+        workflow.add_edge("search_balance", "generate_answer")
 
         # Puntos finales
         workflow.add_edge("generate_answer", END)
@@ -214,16 +331,61 @@ class AgentGraph:
         
         return workflow.compile()
 
+    async def warmup(self) -> None:
+        """
+        Abrir la conexión con Azure OpenAI antes de la primera pregunta real
+        Se listan los modelos del recurso, una llamada que no consume tokens: basta para
+        resolver el DNS, negociar TLS y dejar la conexión en el pool HTTP compartido
+        """
+        try:
+            await self.llm.root_async_client.models.list()
+            logger.info("🔥 Conexión con Azure OpenAI precalentada")
+        except Exception as e:
+            logger.warning("⚠️ No se pudo precalentar el cliente de Azure OpenAI: %s", e)
+
     # --- Método principal para ejecutar el grafo ---
+    def get_cached_state(self, question: str) -> Optional[dict]:
+        """Devolver el estado final en caché para la pregunta normalizada, o None si no está"""
+        return self._response_cache.get(" ".join(question.lower().split()))
+
     async def run(self, question: str) -> dict:
+        cached = self.get_cached_state(question)
+        if cached is not None:
+            logger.info("⚡ Respuesta servida desde caché")
+            return cached
+        
+        key = " ".join(question.lower().split())
         initial_state = {
             "question": question, 
             "income_total": 0.0, 
             "expense_total": 0.0, 
-            "search_results": []
+            "search_results": [],
+            "error": None
         }
         final_state = await self.graph.ainvoke(initial_state)
+        # Solo se guardan los estados correctos: un fallo transitorio no debe servirse desde caché
+        if not final_state.get("error"):
+            self._response_cache[key] = final_state
         return final_state
 
-# Instancia global del agente
-agent_graph = AgentGraph()
+    def clear_cache(self) -> None:
+        """Vaciar la caché de respuestas (p. ej. tras cargar una factura nueva)"""
+        self._response_cache.clear()
+
+# Instancia global del agente (se construye en el primer uso, no al importar)
+_agent_graph_singleton: Optional[AgentGraph] = None
+_agent_graph_lock = asyncio.Lock()
+
+async def get_agent_graph() -> AgentGraph:
+    """
+    Obtener la instancia compartida del grafo, compilándolo en el primer uso
+
+    Returns:
+        Instancia global de AgentGraph
+    """
+    global _agent_graph_singleton
+    if _agent_graph_singleton is None:
+        async with _agent_graph_lock:
+            if _agent_graph_singleton is None:
+                _agent_graph_singleton = AgentGraph()
+    return _agent_graph_singleton
@@ -9,7 +9,7 @@ from pathlib import Path
 from typing import List
 
 from app.core.rag_pipeline import rag_pipeline
-from app.utils.logger import get_logger
+from app.utils.logger import get_logger, setup_logging
 
 logger = get_logger(__name__)
 
@@ -46,14 +46,14 @@ async def example_process_single_document():
             result = await rag_pipeline.process_and_index_document(temp_file)
             
             if result["success"]:
-                logger.info(f"✅ Documento procesado exitosamente:")
-                logger.info(f"   - Archivo: {result['file_path']}")
-                logger.info(f"   - Documentos procesados: {result['documents_processed']}")
-                logger.info(f"   - Tiempo de procesamiento: {result['processing_time_seconds']:.2f}s")
-                logger.info(f"   - Tamaño del archivo: {result['file_size_bytes']} bytes")
-                logger.info(f"   - Modelo de embeddings: {result['embedding_model']}")
+                logger.info("✅ Documento procesado exitosamente:")
+                logger.info("   - Archivo: %s", result['file_path'])
+                logger.info("   - Documentos procesados: %s", result['documents_processed'])
+                logger.info("   - Tiempo de procesamiento: %.2fs", result['processing_time_seconds'])
+                logger.info("   - Tamaño del archivo: %s bytes", result['file_size_bytes'])
+                logger.info("   - Modelo de embeddings: %s", result['embedding_model'])
             else:
-                logger.error(f"❌ Error procesando documento: {result.get('error', 'Error desconocido')}")
+                logger.error("❌ Error procesando documento: %s", result.get('error', 'Error desconocido'))
             
             return result
             
@@ -63,7 +63,7 @@ async def example_process_single_document():
                 os.remove(temp_file)
                 
     except Exception as e:
-        logger.error(f"❌ Error en ejemplo de documento único: {str(e)}")
+        logger.error("❌ Error en ejemplo de documento único: %s", e)
         raise
 
 async def example_process_multiple_documents():
@@ -125,47 +125,57 @@ async def example_process_multiple_documents():
             }
         ]
         
-        # Crear archivos temporales
-        temp_files = []
-        for doc in documents:
-            file_path = doc["name"]
-            with open(file_path, "w", encoding="utf-8") as f:
-                f.write(doc["content"])
-            temp_files.append(file_path)
+        # Crear archivos temporales en paralelo, fuera del event loop
+        temp_files = [doc["name"] for doc in documents]
+        await asyncio.gather(*[
+            asyncio.to_thread(Path(doc["name"]).write_text, doc["content"], encoding="utf-8")
+            for doc in documents
+        ])
         
         try:
-            results = []
+            # Procesar todos los documentos en paralelo, con un máximo de llamadas
+            # simultáneas a Azure para evitar errores 429
+            semaphore = asyncio.Semaphore(5)
+            
+            async def process_bounded(file_path: str):
+                async with semaphore:
+                    logger.info("📄 Procesando: %s", file_path)
+                    return await rag_pipeline.process_and_index_document(file_path)
             
-            # Procesar cada documento
-            for file_path in temp_files:
-                logger.info(f"📄 Procesando: {file_path}")
-                result = await rag_pipeline.process_and_index_document(file_path)
+            tasks = [asyncio.create_task(process_bounded(file_path)) for file_path in temp_files]
+            gathered = await asyncio.gather(*tasks, return_exceptions=True)
+            
+            results = []
+            for file_path, result in zip(temp_files, gathered):
+                if isinstance(result, Exception):
+                    result = {"success": False, "file_path": file_path, "error": str(result)}
                 results.append(result)
                 
                 if result["success"]:
-                    logger.info(f"✅ {file_path}: {result['documents_processed']} chunks procesados")
+                    logger.info("✅ %s: %s chunks procesados", file_path, result['documents_processed'])
                 else:
-                    logger.error(f"❌ {file_path}: {result.get('error', 'Error desconocido')}")
+                    logger.error("❌ %s: %s", file_path, result.get('error', 'Error desconocido'))
             
             # Resumen
             successful = sum(1 for r in results if r["success"])
             total_documents = len(results)
             total_chunks = sum(r.get("documents_processed", 0) for r in results if r["success"])
             
-            logger.info(f"📊 Resumen del procesamiento:")
-            logger.info(f"   - Documentos exitosos: {successful}/{total_documents}")
-            logger.info(f"   - Total de chunks procesados: {total_chunks}")
+            logger.info("📊 Resumen del procesamiento:")
+            logger.info("   - Documentos exitosos: %s/%s", successful, total_documents)
+            logger.info("   - Total de chunks procesados: %s", total_chunks)
             
             return results
             
         finally:
             # Limpiar archivos temporales
-            for file_path in temp_files:
-                if os.path.exists(file_path):
-                    os.remove(file_path)
+            await asyncio.gather(*[
+                asyncio.to_thread(Path(file_path).unlink, missing_ok=True)
+                for file_path in temp_files
+            ])
                     
     except Exception as e:
-        logger.error(f"❌ Error en ejemplo de múltiples documentos: {str(e)}")
+        logger.error("❌ Error en ejemplo de múltiples documentos: %s", e)
         raise
 
 async def example_step_by_step_processing():
@@ -196,20 +206,20 @@ async def example_step_by_step_processing():
             logger.info("🔄 Paso 1: Procesando documento...")
             documents = await rag_pipeline.process_document(temp_file)
             
-            logger.info(f"✅ Documento procesado: {len(documents)} chunks creados")
+            logger.info("✅ Documento procesado: %s chunks creados", len(documents))
             
             # Mostrar información de los chunks
             for i, doc in enumerate(documents[:3]):  # Mostrar solo los primeros 3
-                logger.info(f"   Chunk {i+1}: {doc['chunk_size']} caracteres")
+                logger.info("   Chunk %s: %s caracteres", i+1, doc['chunk_size'])
             
             # Paso 2: Agregar al índice de búsqueda
             logger.info("🔄 Paso 2: Agregando al índice de búsqueda...")
             index_success = await rag_pipeline.add_documents_to_search(documents)
             
             if index_success:
-                logger.info(f"✅ Documentos agregados al índice exitosamente")
+                logger.info("✅ Documentos agregados al índice exitosamente")
             else:
-                logger.error(f"❌ Error agregando documentos al índice")
+                logger.error("❌ Error agregando documentos al índice")
             
             return {
                 "documents_processed": len(documents),
@@ -222,7 +232,7 @@ async def example_step_by_step_processing():
                 os.remove(temp_file)
                 
     except Exception as e:
-        logger.error(f"❌ Error en ejemplo paso a paso: {str(e)}")
+        logger.error("❌ Error en ejemplo paso a paso: %s", e)
         raise
 
 async def example_validate_pipeline():
@@ -241,7 +251,7 @@ async def example_validate_pipeline():
         return is_valid
         
     except Exception as e:
-        logger.error(f"❌ Error validando pipeline: {str(e)}")
+        logger.error("❌ Error validando pipeline: %s", e)
         raise
 
 async def main():
@@ -268,8 +278,9 @@ async def main():
         logger.info("🎉 Todos los ejemplos del pipeline RAG completados exitosamente!")
         
     except Exception as e:
-        logger.error(f"❌ Error en ejemplos del pipeline: {str(e)}")
+        logger.error("❌ Error en ejemplos del pipeline: %s", e)
 
 if __name__ == "__main__":
+    setup_logging()
     # Ejecutar ejemplos
     asyncio.run(main())
@@ -4,14 +4,20 @@ Utiliza Azure Document Intelligence para extraer información, previene duplicad
 usando un hash SHA-256, y Azure Search para indexar los datos extraídos.
 """
 
+import asyncio
+import functools
 import uuid
-import json
 import hashlib
+import weakref
 from datetime import datetime, timezone
-from typing import Dict, Any, Union, Optional
+from pathlib import Path
+from typing import Dict, Any, Union, Optional, AsyncIterator, Awaitable, Callable, List, Tuple
+
+import orjson
+from cachetools import TTLCache
 
 from azure.core.exceptions import HttpResponseError
-from app.utils.azure_clients import get_doc_intelligence_client, get_search_client
+from app.utils.azure_clients import get_async_doc_intelligence_client, get_async_search_client
 from app.utils.logger import get_logger
 
 logger = get_logger(__name__)
@@ -20,34 +26,176 @@ logger = get_logger(__name__)
 MODELO_EMITIDAS = "opendoors-emitidas-custom"
 MODELO_RECIBIDAS = "opendoors-recibidas-custom"
 
+# --- Valores válidos para los filtros OData (se validan antes de construir el filtro) ---
+PARTNERS = frozenset({"HERNAN", "JONI", "MAXI", "LEO"})
+INVOICE_TYPES = frozenset({"ingreso", "egreso"})
+
+# Si la faceta de métrica (InvoiceTotal,metric:sum) falla una vez, la versión de la API
+# del servicio no la admite: las siguientes agregaciones van directas a la suma en streaming
+_facet_sum_supported = True
+
+@functools.lru_cache(maxsize=256)
+def build_invoice_filter(partner: Optional[str] = None, invoice_type: Optional[str] = None) -> Optional[str]:
+    """
+    Construir el filtro OData por socio y tipo de factura a partir de valores validados
+    
+    Args:
+        partner: Socio (JONI, HERNAN, MAXI, LEO) o None
+        invoice_type: 'ingreso', 'egreso' o None
+        
+    Returns:
+        Filtro OData, o None si no se indicó ningún criterio
+        
+    Raises:
+        ValueError: Si el socio o el tipo no son valores conocidos
+    """
+    if partner is not None and partner not in PARTNERS:
+        raise ValueError(f"Socio desconocido: {partner}")
+    if invoice_type is not None and invoice_type not in INVOICE_TYPES:
+        raise ValueError(f"Tipo de factura desconocido: {invoice_type}")
+    
+    clauses = []
+    if partner is not None:
+        clauses.append(f"PartnerName eq '{partner}'")
+    if invoice_type is not None:
+        clauses.append(f"InvoiceType eq '{invoice_type}'")
+    return " and ".join(clauses) or None
+
+# Importes en formato local ($1.234,56): se quitan '$', separadores de miles y espacios,
+# y la coma decimal pasa a punto, todo en una sola pasada de str.translate
+_CURRENCY_TABLE = str.maketrans({"$": None, ".": None, " ": None, "\t": None, "\n": None, ",": "."})
+
+def _clean_currency(value: Any) -> float:
+    """Convertir un importe extraído por Document Intelligence a float (0.0 si no es válido)"""
+    if value is None: return 0.0
+    try:
+        return float(str(value).translate(_CURRENCY_TABLE))
+    except (ValueError, TypeError): return 0.0
+
+class _IndexBatcher:
+    """
+    Agrupa las subidas al índice en una sola llamada a upload_documents.
+    Si la cola está vacía el documento se sube de inmediato; los que llegan mientras
+    hay una subida en curso se juntan y salen en la siguiente llamada.
+    La cola y el worker son propios de cada event loop (API, scripts, Function App).
+    """
+
+    def __init__(self, upload_documents: Callable[[List[Dict[str, Any]]], Awaitable[List[Any]]], max_batch: int = 100):
+        """
+        Args:
+            upload_documents: Función asíncrona que sube un lote (SearchClient.upload_documents)
+            max_batch: Máximo de documentos por llamada
+        """
+        self._upload_documents = upload_documents
+        self._max_batch = max_batch
+        # event loop -> (cola, worker); la entrada desaparece cuando el loop se libera
+        self._per_loop: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+
+    def _queue_for_running_loop(self) -> asyncio.Queue:
+        """Obtener la cola del event loop actual, arrancando su worker si no existe o terminó"""
+        loop = asyncio.get_running_loop()
+        state = self._per_loop.get(loop)
+        if state is None or state[1].done():
+            queue: asyncio.Queue = asyncio.Queue()
+            state = (queue, loop.create_task(self._run(queue)))
+            self._per_loop[loop] = state
+        return state[0]
+
+    async def submit(self, document: Dict[str, Any]) -> Any:
+        """
+        Encolar un documento y esperar a que se suba su lote
+        
+        Args:
+            document: Documento estructurado para el índice
+            
+        Returns:
+            Resultado de indexación del documento (succeeded, error_message)
+        """
+        queue = self._queue_for_running_loop()
+        future = asyncio.get_running_loop().create_future()
+        queue.put_nowait((document, future))
+        return await future
+
+    async def _run(self, queue: asyncio.Queue) -> None:
+        """Vaciar la cola en lotes mientras haya documentos pendientes"""
+        while True:
+            # Sin esperas artificiales: el lote es lo que ya está en la cola
+            batch = [await queue.get()]
+            while len(batch) < self._max_batch and not queue.empty():
+                batch.append(queue.get_nowait())
+            
+            documents = [document for document, _ in batch]
+            # Una sola marca de tiempo por lote en lugar de una por documento
+            processed_at = datetime.now(timezone.utc).isoformat()
+            for document in documents:
+                document["processed_at"] = processed_at
+            try:
+                upload_result = await self._upload_documents(documents)
+                logger.info("📤 Lote de %s documentos subido al índice", len(documents))
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            
+            for (_, future), result in zip(batch, upload_result):
+                if not future.done():
+                    future.set_result(result)
+
 class InvoiceProcessor:
     """
     Procesador especializado para facturas que incluye lógica anti-duplicados.
     """
 
+    # Parámetros fijos de la búsqueda de duplicados: solo interesa el conteo, sin documentos
+    _DUP_KWARGS: Dict[str, Any] = {"search_text": "*", "select": ["id"], "top": 0, "include_total_count": True}
+
     def __init__(self):
         """Inicializar el procesador de facturas"""
-        self.doc_intelligence_client = get_doc_intelligence_client()
-        self.search_client = get_search_client()
+        # Totales por filtro; se invalidan al subir una factura nueva
+        self._totals_cache: TTLCache = TTLCache(maxsize=64, ttl=60)
+        # Hashes que ya se sabe que están en el índice (evita consultarlo). Solo se guardan
+        # aciertos: otro worker o proceso puede indexar un hash que aquí se vio como nuevo
+        self._hash_cache: TTLCache = TTLCache(maxsize=10_000, ttl=3600)
+        # Subidas al índice agrupadas en lotes
+        self._batcher = _IndexBatcher(lambda documents: self.search_client.upload_documents(documents))
         logger.info("Procesador de facturas inicializado correctamente")
 
-    def _calculate_file_hash(self, file_bytes: bytes) -> str:
-        """Calcula el hash SHA-256 de un archivo para usarlo como huella digital."""
-        sha256_hash = hashlib.sha256()
-        sha256_hash.update(file_bytes)
-        return sha256_hash.hexdigest()
+    # Clientes asíncronos: se obtienen en el primer uso, ya dentro del event loop,
+    # porque comparten una sesión de aiohttp que no puede crearse al importar
+    @property
+    def search_client(self):
+        return get_async_search_client()
+
+    @property
+    def doc_intelligence_client(self):
+        return get_async_doc_intelligence_client()
+
+    def _read_and_hash_file(self, file_path: str) -> Tuple[bytes, str]:
+        """
+        Lee el archivo una sola vez y calcula su hash SHA-256 para usarlo como huella digital.
+        Se ejecuta en un hilo: ni la lectura ni el hash de archivos grandes bloquean el event loop.
+        """
+        file_bytes = Path(file_path).read_bytes()
+        return file_bytes, hashlib.sha256(file_bytes).hexdigest()
 
     async def _is_duplicate(self, file_hash: str) -> bool:
         """Verifica si ya existe una factura con el mismo hash en el índice."""
+        if file_hash in self._hash_cache:
+            logger.info("⚡ Duplicado detectado desde caché")
+            return True
+        
         try:
             filter_query = f"file_hash eq '{file_hash}'"
-            logger.info(f"🔎 Verificando duplicados con el filtro: {filter_query}")
-            search_results = self.search_client.search(search_text="*", filter=filter_query, include_total_count=True)
-            count = search_results.get_count()
-            logger.info(f"Se encontraron {count} facturas con el mismo hash.")
+            logger.info("🔎 Verificando duplicados con el filtro: %s", filter_query)
+            search_results = await self.search_client.search(filter=filter_query, **self._DUP_KWARGS)
+            count = await search_results.get_count()
+            logger.info("Se encontraron %s facturas con el mismo hash.", count)
+            if count > 0:
+                self._hash_cache[file_hash] = True
             return count > 0
         except Exception as e:
-            logger.error(f"❌ Error verificando duplicados: {str(e)}", exc_info=True)
+            logger.error("❌ Error verificando duplicados: %s", e, exc_info=True)
             return True
 
     async def _analyze_with_model(self, model_id: str, document_bytes: bytes) -> Optional[Any]:
@@ -56,65 +204,70 @@ class InvoiceProcessor:
         Ahora incluye una verificación estricta de docType y confianza.
         """
         try:
-            logger.info(f"🔍 Analizando con modelo: {model_id}...")
-            poller = self.doc_intelligence_client.begin_analyze_document(model_id, document_bytes)
-            result = poller.result()
+            logger.info("🔍 Analizando con modelo: %s...", model_id)
+            poller = await self.doc_intelligence_client.begin_analyze_document(model_id, document_bytes)
+            result = await poller.result()
 
             if result and result.documents:
                 document = result.documents[0]
                 doc_type = document.doc_type
                 confidence = document.confidence
                 
-                logger.info(f"Modelo {model_id} detectó docType: '{doc_type}' con confianza: {confidence:.2%}")
+                logger.info("Modelo %s detectó docType: '%s' con confianza: %.2f%%", model_id, doc_type, confidence * 100)
 
                 expected_doc_type = model_id
                 
                 if doc_type == expected_doc_type and confidence > 0.95: # <-- 1. Umbral de confianza aumentado
-                    logger.info(f"✅ Verificación exitosa para el modelo {model_id}")
+                    logger.info("✅ Verificación exitosa para el modelo %s", model_id)
                     return result
                 else:
-                    logger.warning(f"⚠️ Verificación fallida para {model_id}. docType o confianza no cumplen el umbral.")
+                    logger.warning("⚠️ Verificación fallida para %s. docType o confianza no cumplen el umbral.", model_id)
                     return None
             else:
-                logger.warning(f"⚠️ El modelo {model_id} se ejecutó pero no encontró documentos en el archivo.")
+                logger.warning("⚠️ El modelo %s se ejecutó pero no encontró documentos en el archivo.", model_id)
                 return None
         except HttpResponseError as e:
-            logger.warning(f"El modelo {model_id} no pudo procesar el documento. Error: {e.message}")
+            logger.warning("El modelo %s no pudo procesar el documento. Error: %s", model_id, e.message)
             return None
         except Exception as e:
-            logger.error(f"Error inesperado durante el análisis con {model_id}: {str(e)}")
+            logger.error("Error inesperado durante el análisis con %s: %s", model_id, e)
             raise
 
+    async def _classify_invoice(self, document_bytes: bytes) -> Tuple[Optional[Any], Optional[str]]:
+        """
+        Analizar el documento con los modelos de emitidas y recibidas en paralelo.
+        Si ambos superan la verificación, gana EMITIDAS, igual que en el análisis secuencial.
+
+        Returns:
+            Resultado del análisis y tipo de factura ('ingreso' o 'egreso'), o (None, None)
+        """
+        issued_result, received_result = await asyncio.gather(
+            self._analyze_with_model(MODELO_EMITIDAS, document_bytes),
+            self._analyze_with_model(MODELO_RECIBIDAS, document_bytes)
+        )
+        if issued_result:
+            logger.info("📊 Factura clasificada como INGRESO.")
+            return issued_result, "ingreso"  # <-- 2. Estandarizado a minúscula
+        if received_result:
+            logger.info("📊 Factura clasificada como EGRESO.")
+            return received_result, "egreso"
+        return None, None
+
     async def process_and_upload_invoice(self, file_path: str, partner_name: str) -> Dict[str, Any]:
         """
         Procesa una factura, previene duplicados, determina el tipo (INGRESO/EGRESO)
         y la sube al índice de búsqueda.
         """
         try:
-            logger.info(f"📄 Procesando nueva factura: {file_path}")
-            with open(file_path, 'rb') as file:
-                document_bytes = file.read()
-
-            file_hash = self._calculate_file_hash(document_bytes)
-            logger.info(f"🔑 Huella digital (hash) del archivo: {file_hash}")
+            logger.info("📄 Procesando nueva factura: %s", file_path)
+            # El archivo se lee una sola vez y el hash se calcula sobre esos bytes, ambos fuera del event loop
+            document_bytes, file_hash = await asyncio.to_thread(self._read_and_hash_file, file_path)
+            logger.info("🔑 Huella digital (hash) del archivo: %s", file_hash)
             if await self._is_duplicate(file_hash):
                 logger.warning("🚫 Factura duplicada detectada. Proceso cancelado.")
                 return { "success": False, "error": "duplicate", "message": "Esta factura ya fue cargada anteriormente." }
             
-            analysis_result = None
-            invoice_type = None
-
-            analysis_result = await self._analyze_with_model(MODELO_EMITIDAS, document_bytes)
-            if analysis_result:
-                invoice_type = "ingreso"  # <-- 2. Estandarizado a minúscula
-                logger.info("📊 Factura clasificada como INGRESO.")
-            
-            if not analysis_result:
-                logger.info("Intentando con modelo de facturas recibidas...")
-                analysis_result = await self._analyze_with_model(MODELO_RECIBIDAS, document_bytes)
-                if analysis_result:
-                    invoice_type = "egreso"   # <-- 2. Estandarizado a minúscula
-                    logger.info("📊 Factura clasificada como EGRESO.")
+            analysis_result, invoice_type = await self._classify_invoice(document_bytes)
             
             if not analysis_result or not invoice_type:
                 raise ValueError("No se pudo analizar la factura con ninguno de los modelos disponibles.")
@@ -123,19 +276,21 @@ class InvoiceProcessor:
             structured_document = self._create_structured_document(invoice_data, file_path, invoice_type, partner_name, file_hash)
 
             logger.info("📤 Subiendo factura al índice de búsqueda...")
-            upload_result = self.search_client.upload_documents([structured_document])
+            upload_result = await self._batcher.submit(structured_document)
             
-            upload_success = bool(upload_result and len(upload_result) > 0 and upload_result[0].succeeded)
+            upload_success = bool(upload_result and upload_result.succeeded)
             if upload_success:
                 logger.info("✅ Factura subida al índice exitosamente")
+                self.invalidate_totals()
+                self._hash_cache[file_hash] = True
             else:
-                error_message = upload_result[0].error_message if upload_result and upload_result[0].error_message else "Error desconocido"
-                logger.error(f"❌ Error subiendo factura: {error_message}")
+                error_message = upload_result.error_message if upload_result and upload_result.error_message else "Error desconocido"
+                logger.error("❌ Error subiendo factura: %s", error_message)
 
             return { "success": upload_success, "invoice_data": invoice_data, "invoice_type": invoice_type }
 
         except Exception as e:
-            logger.error(f"Error procesando factura: {str(e)}", exc_info=True)
+            logger.error("Error procesando factura: %s", e, exc_info=True)
             return { "success": False, "error": str(e) }
 
     def _extract_invoice_fields(self, analysis_result) -> Dict[str, Any]:
@@ -145,28 +300,23 @@ class InvoiceProcessor:
             document = analysis_result.documents[0]
             fields = document.fields
             invoice_data = {}
-            def clean_currency(value: Any) -> float:
-                if value is None: return 0.0
-                try:
-                    return float(str(value).replace("$", "").strip().replace(".", "").replace(",", "."))
-                except (ValueError, TypeError): return 0.0
             def get_field_value(field_name: str) -> Union[str, float, None]:
                 field = fields.get(field_name)
                 return field.content if field else None
             invoice_data["VendorName"] = get_field_value("VendorName") or "N/A"
             invoice_data["InvoiceDate"] = get_field_value("InvoiceDate") or "N/A"
-            invoice_data["InvoiceTotal"] = clean_currency(get_field_value("InvoiceTotal"))
-            invoice_data["TotalTax"] = clean_currency(get_field_value("TotalTax"))
-            logger.info(f"📋 Campos extraídos y limpios: {invoice_data}")
+            invoice_data["InvoiceTotal"] = _clean_currency(get_field_value("InvoiceTotal"))
+            invoice_data["TotalTax"] = _clean_currency(get_field_value("TotalTax"))
+            logger.info("📋 Campos extraídos y limpios: %s", invoice_data)
             return invoice_data
         except Exception as e:
-            logger.error(f"Error extrayendo campos: {str(e)}", exc_info=True)
+            logger.error("Error extrayendo campos: %s", e, exc_info=True)
             return { "VendorName": "N/A", "InvoiceDate": "N/A", "InvoiceTotal": 0.0, "TotalTax": 0.0 }
 
     def _create_structured_document(self, invoice_data: Dict[str, Any], file_path: str, invoice_type: str, partner_name: str, file_hash: str) -> Dict[str, Any]:
-        """Crear un diccionario estructurado para el índice de búsqueda, incluyendo el hash."""
+        """Crear un diccionario estructurado para el índice de búsqueda, incluyendo el hash (processed_at lo asigna el lote al subir)."""
         document_id = f"invoice_{uuid.uuid4().hex}"
-        content_str = json.dumps(invoice_data)
+        content_str = orjson.dumps(invoice_data).decode()
         structured_document = {
             "id": document_id, 
             "content": content_str, 
@@ -176,24 +326,131 @@ class InvoiceProcessor:
             "TotalTax": invoice_data.get("TotalTax", 0.0), 
             "source_file": file_path, 
             "document_type": "invoice",
-            "processed_at": datetime.now(timezone.utc).isoformat(), 
             "InvoiceType": invoice_type, 
             "PartnerName": partner_name,
             "file_hash": file_hash
         }
-        logger.info(f"📝 Documento estructurado creado con ID: {document_id} y Hash: {file_hash}")
+        logger.info("📝 Documento estructurado creado con ID: %s y Hash: %s", document_id, file_hash)
         return structured_document
 
-    async def query_invoices(self, filter_query: str) -> list[Dict[str, Any]]:
-        """Realiza una consulta filtrada en el índice de Azure AI Search."""
+    async def search_invoices(self, filter_query: str, top: Optional[int] = None) -> list[Dict[str, Any]]:
+        """Realiza una consulta filtrada en el índice de Azure AI Search; los errores se propagan."""
+        logger.info("🔎 Realizando búsqueda con filtro: %s", filter_query)
+        search_results = await self.search_client.search(search_text="*", filter=filter_query, include_total_count=True, top=top)
+        results_list = [dict(result) async for result in search_results]
+        logger.info("✅ Búsqueda completada. Se encontraron %s resultados.", await search_results.get_count())
+        return results_list
+
+    async def query_invoices(self, filter_query: str, top: Optional[int] = None) -> list[Dict[str, Any]]:
+        """Realiza una consulta filtrada en el índice de Azure AI Search (top limita los resultados)."""
         try:
-            logger.info(f"🔎 Realizando búsqueda con filtro: {filter_query}")
-            search_results = self.search_client.search(search_text="*", filter=filter_query, include_total_count=True)
-            results_list = [dict(result) for result in search_results]
-            logger.info(f"✅ Búsqueda completada. Se encontraron {search_results.get_count()} resultados.")
-            return results_list
+            return await self.search_invoices(filter_query, top)
         except Exception as e:
-            logger.error(f"❌ Error durante la búsqueda: {str(e)}", exc_info=True)
+            logger.error("❌ Error durante la búsqueda: %s", e, exc_info=True)
             return []
 
+    async def stream_invoice_totals(self, filter_query: str) -> AsyncIterator[float]:
+        """
+        Emitir el InvoiceTotal de cada factura que cumple el filtro, página a página
+        Solo se pide el campo content y no se construye la lista completa de resultados
+        
+        Args:
+            filter_query: Filtro OData para Azure AI Search
+            
+        Returns:
+            Iterador asíncrono con el total de cada factura
+        """
+        logger.info("🔎 Sumando totales con filtro: %s", filter_query)
+        search_results = await self.search_client.search(search_text="*", filter=filter_query, select=["content"])
+        async for page in search_results.by_page():
+            async for result in page:
+                # El campo 'content' es un string JSON con los datos de la factura
+                try:
+                    yield orjson.loads(result.get("content") or b"{}").get("InvoiceTotal", 0.0)
+                except (orjson.JSONDecodeError, AttributeError):
+                    continue
+
+    async def aggregate_total(self, filter_query: str) -> float:
+        """
+        Obtener la suma de InvoiceTotal de las facturas que cumplen el filtro
+        La suma la calcula Azure AI Search con una faceta de métrica (top=0, sin documentos);
+        si el servicio no la devuelve, se suma en streaming como respaldo y la faceta
+        no se vuelve a intentar en este proceso
+        
+        Args:
+            filter_query: Filtro OData para Azure AI Search
+            
+        Returns:
+            Total acumulado
+        """
+        cached = self._totals_cache.get(filter_query)
+        if cached is not None:
+            return cached
+        
+        total = await self._aggregate_total_uncached(filter_query)
+        self._totals_cache[filter_query] = total
+        return total
+    
+    async def _aggregate_total_uncached(self, filter_query: str) -> float:
+        """Calcular la suma de InvoiceTotal sin pasar por la caché de totales"""
+        async def facet_sum() -> Optional[float]:
+            search_results = await self.search_client.search(
+                search_text="*",
+                filter=filter_query,
+                facets=["InvoiceTotal,metric:sum"],
+                top=0
+            )
+            for facet in (await search_results.get_facets() or {}).get("InvoiceTotal", []):
+                if "sum" in facet:
+                    return float(facet["sum"])
+            return None
+        
+        global _facet_sum_supported
+        if _facet_sum_supported:
+            try:
+                total = await facet_sum()
+                if total is not None:
+                    logger.info("✅ Total agregado por Azure AI Search para %s: %s", filter_query, total)
+                    return total
+                logger.warning("⚠️ El índice no devolvió la faceta de suma; se suma en streaming a partir de ahora")
+            except HttpResponseError as e:
+                logger.warning("⚠️ Agregación por facetas no disponible (%s); se suma en streaming a partir de ahora", e.message)
+            _facet_sum_supported = False
+        
+        total = 0.0
+        async for invoice_total in self.stream_invoice_totals(filter_query):
+            total += invoice_total
+        return total
+
+    async def aggregate_by_type(self) -> Dict[str, float]:
+        """
+        Obtener la suma de InvoiceTotal de ingresos y egresos
+        Las dos agregaciones por faceta (top=0, sin documentos) se lanzan en paralelo
+        y comparten la caché de totales de aggregate_total
+
+        Returns:
+            Diccionario con los totales de 'ingreso' y 'egreso'
+        """
+        income_total, expense_total = await asyncio.gather(
+            self.aggregate_total(build_invoice_filter(invoice_type="ingreso")),
+            self.aggregate_total(build_invoice_filter(invoice_type="egreso"))
+        )
+        return {"ingreso": income_total, "egreso": expense_total}
+
+    def get_cached_total(self, invoice_type: str) -> Optional[float]:
+        """
+        Obtener el total en caché de un tipo de factura, sin consultar el índice
+        
+        Args:
+            invoice_type: 'ingreso' o 'egreso'
+            
+        Returns:
+            Total en caché, o None si no está o ha caducado
+        """
+        return self._totals_cache.get(build_invoice_filter(invoice_type=invoice_type))
+    
+    def invalidate_totals(self) -> None:
+        """Vaciar la caché de totales (se llama tras subir una factura)"""
+        self._totals_cache.clear()
+
 invoice_processor = InvoiceProcessor()
\ No newline at end of file
@@ -0,0 +1,118 @@
+"""
+Clasificador de sentimiento local con ONNX Runtime
+Evita una llamada a Azure OpenAI para textos cortos usando un modelo distilbert
+multilingüe cuantizado a int8
+
+Preparar el modelo (una sola vez):
+    optimum-cli export onnx --model lxyuan/distilbert-base-multilingual-cased-sentiments-student \
+        --task text-classification sentiment_onnx/
+    optimum-cli onnxruntime quantize --onnx_model sentiment_onnx/ --avx2 -o sentiment_onnx_int8/
+
+y definir SENTIMENT_ONNX_MODEL_DIR con la carpeta resultante
+"""
+
+import functools
+import os
+from pathlib import Path
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+import orjson
+
+from app.config.settings import settings
+from app.utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+# Etiquetas del modelo traducidas a las que devuelve el agente
+_LABELS: Dict[str, str] = {
+    "positive": "POSITIVO",
+    "neutral": "NEUTRAL",
+    "negative": "NEGATIVO"
+}
+
+# Ventana del modelo en tokens; los textos más largos se truncarían
+MAX_TOKENS = 512
+
+class OnnxSentimentClassifier:
+    """Clasificador de sentimiento que ejecuta un modelo ONNX en CPU"""
+
+    def __init__(self, model_dir: str):
+        """
+        Cargar el modelo, el tokenizador y las etiquetas desde una carpeta exportada con optimum
+
+        Args:
+            model_dir: Carpeta con model_quantized.onnx (o model.onnx), tokenizer.json y config.json
+
+        Raises:
+            RuntimeError: Si faltan las dependencias opcionales o los archivos del modelo
+        """
+        try:
+            import onnxruntime as ort
+            from tokenizers import Tokenizer
+        except ImportError as e:
+            raise RuntimeError(f"Dependencias de ONNX no instaladas: {str(e)}") from e
+
+        model_path = os.path.join(model_dir, "model_quantized.onnx")
+        if not os.path.exists(model_path):
+            model_path = os.path.join(model_dir, "model.onnx")
+
+        try:
+            self.session = ort.InferenceSession(model_path, providers=["CPUExecutionProvider"])
+            self.tokenizer = Tokenizer.from_file(os.path.join(model_dir, "tokenizer.json"))
+            id2label = orjson.loads(Path(model_dir, "config.json").read_bytes())["id2label"]
+        except Exception as e:
+            raise RuntimeError(f"No se pudo cargar el modelo de sentimiento: {str(e)}") from e
+
+        self.tokenizer.enable_truncation(max_length=MAX_TOKENS)
+        self.labels = [_LABELS.get(id2label[str(i)].lower(), id2label[str(i)].upper()) for i in range(len(id2label))]
+        self._input_names = {model_input.name for model_input in self.session.get_inputs()}
+
+        logger.info("✅ Clasificador de sentimiento ONNX cargado desde %s", model_path)
+
+    def classify(self, text: str) -> Optional[Tuple[str, float]]:
+        """
+        Clasificar el sentimiento de un texto
+
+        Args:
+            text: Texto a clasificar
+
+        Returns:
+            Etiqueta (POSITIVO, NEGATIVO o NEUTRAL) y su probabilidad, o None si el texto
+            supera MAX_TOKENS tokens y el modelo solo vería una parte
+
+        Raises:
+            RuntimeError: Si la inferencia falla
+        """
+        try:
+            encoding = self.tokenizer.encode(text)
+            # El tokenizador trunca a MAX_TOKENS; lo que no cabe queda en overflowing
+            if encoding.overflowing:
+                return None
+            feeds = {
+                "input_ids": np.array([encoding.ids], dtype=np.int64),
+                "attention_mask": np.array([encoding.attention_mask], dtype=np.int64)
+            }
+            logits = self.session.run(None, {name: value for name, value in feeds.items() if name in self._input_names})[0][0]
+        except Exception as e:
+            raise RuntimeError(f"Error en la inferencia ONNX: {str(e)}") from e
+
+        probabilities = np.exp(logits - logits.max())
+        probabilities /= probabilities.sum()
+        index = int(probabilities.argmax())
+        return self.labels[index], float(probabilities[index])
+
+@functools.cache
+def get_sentiment_classifier() -> OnnxSentimentClassifier:
+    """
+    Obtener el clasificador de sentimiento local, cargándolo en el primer uso
+
+    Returns:
+        Instancia compartida de OnnxSentimentClassifier
+
+    Raises:
+        RuntimeError: Si el modelo no está configurado o no se puede cargar
+    """
+    if not settings.SENTIMENT_ONNX_MODEL_DIR:
+        raise RuntimeError("SENTIMENT_ONNX_MODEL_DIR no está configurado")
+    return OnnxSentimentClassifier(settings.SENTIMENT_ONNX_MODEL_DIR)
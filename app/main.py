@@ -2,30 +2,66 @@
 API web simple usando FastAPI
 Endpoints para procesar facturas y chatear con el agente.
 """
+import asyncio
 import os
 import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
 from enum import Enum
 from typing import Dict, Any
 
+from anyio import to_thread
 from fastapi import FastAPI, UploadFile, File, HTTPException, Form
-from fastapi.responses import JSONResponse
-from dotenv import load_dotenv
+from fastapi.responses import ORJSONResponse, StreamingResponse
+
+from app.utils.logger import get_logger, setup_logging
+
+# Configurar el logging antes de importar el resto de módulos, que ya registran mensajes al cargarse
+setup_logging()
 
 # Importamos los dos componentes principales de nuestra lógica
 from app.core.rag_pipeline import invoice_processor
-from app.core.graph import agent_graph
-from app.utils.logger import get_logger
-
-# Cargar variables de entorno del archivo .env
-load_dotenv()
+from app.core.graph import get_agent_graph
+from app.config.settings import settings
+from app.utils.azure_clients import (
+    close_async_azure_clients,
+    close_azure_sync_transport,
+    close_openai_http_client,
+    validate_all_clients
+)
 
 logger = get_logger(__name__)
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Ciclo de vida de la aplicación: precalienta los clientes al arrancar y libera las conexiones HTTP al apagar"""
+    # Acotar los hilos de trabajo: asyncio.to_thread usa el executor por defecto del loop
+    # y anyio (endpoints síncronos de FastAPI) su propio limitador
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=settings.THREAD_POOL_SIZE))
+    to_thread.current_default_thread_limiter().total_tokens = settings.THREAD_POOL_SIZE
+    
+    # Fallar al arrancar si la configuración de Azure está incompleta, no en la primera petición
+    validate_all_clients(strict=True)
+    
+    # Compilar el grafo y abrir las conexiones con Azure OpenAI y Azure AI Search
+    # para que la primera pregunta no pague el DNS, el TLS ni la autenticación
+    agent_graph = await get_agent_graph()
+    await asyncio.gather(
+        agent_graph.warmup(),
+        invoice_processor.query_invoices("InvoiceType eq 'ingreso'", top=1)
+    )
+    yield
+    await asyncio.gather(close_openai_http_client(), close_async_azure_clients())
+    close_azure_sync_transport()
+
 # Crear instancia de la aplicación FastAPI
 app = FastAPI(
     title="API de Agente Contable",
     description="API para procesar facturas y responder preguntas sobre ellas.",
-    version="2.0.0"
+    version="2.0.0",
+    # orjson serializa todas las respuestas JSON (más rápido que el json estándar)
+    default_response_class=ORJSONResponse,
+    lifespan=lifespan
 )
 
 # La clase InvoiceType se elimina porque ya no la necesitamos.
@@ -47,30 +83,34 @@ async def process_invoice(
     # El parámetro 'invoice_type' se ha eliminado de aquí.
     file: UploadFile = File(...),
     partner_name: PartnerName = Form(...)
-) -> JSONResponse:
+):
     """
     Endpoint para procesar y almacenar una nueva factura.
     """
     temp_file_path = None
     try:
-        logger.info(f"📄 Recibiendo archivo: {file.filename}")
+        logger.info("📄 Recibiendo archivo: %s", file.filename)
         file_extension = os.path.splitext(file.filename.lower())[1]
         temp_fd, temp_file_path = tempfile.mkstemp(suffix=file_extension)
         
+        # Copiar la subida por bloques de 1 MB: memoria constante y escritura fuera del event loop
         with os.fdopen(temp_fd, 'wb') as temp_file:
-            content = await file.read()
-            temp_file.write(content)
+            while chunk := await file.read(1 << 20):
+                await asyncio.to_thread(temp_file.write, chunk)
 
         # La llamada a la función ya no pasa 'invoice_type'.
         result = await invoice_processor.process_and_upload_invoice(
             file_path=temp_file_path,
             partner_name=partner_name.value
         )
+        # Las respuestas en caché del agente pueden haber quedado desactualizadas
+        if result.get("success"):
+            (await get_agent_graph()).clear_cache()
         response_data = { "success": result.get("success", False), "message": "Procesamiento de factura completado", "filename": file.filename, "processing_result": result }
-        return JSONResponse(content=response_data, status_code=200)
+        return response_data
 
     except Exception as e:
-        logger.error(f"❌ Error en el endpoint /process-invoice/: {str(e)}", exc_info=True)
+        logger.error("❌ Error en el endpoint /process-invoice/: %s", e, exc_info=True)
         raise HTTPException(status_code=500, detail=f"Error interno del servidor: {str(e)}")
     finally:
         if temp_file_path and os.path.exists(temp_file_path):
@@ -83,17 +123,53 @@ async def chat_with_agent(question: str = Form(...)):
     Recibe una pregunta en lenguaje natural, la procesa y devuelve una respuesta.
     """
     try:
-        logger.info(f"💬 Nueva pregunta para el agente: {question}")
-        # Usamos el método run() de nuestro grafo, que ejecuta el flujo completo
-        final_state = await agent_graph.run(question)
+        logger.info("💬 Nueva pregunta para el agente: %s", question)
+        agent_graph = await get_agent_graph()
+        # Las preguntas repetidas se responden desde la caché del grafo sin ejecutarlo
+        final_state = agent_graph.get_cached_state(question)
+        cached = final_state is not None
+        if not cached:
+            # Usamos el método run() de nuestro grafo, que ejecuta el flujo completo
+            final_state = await agent_graph.run(question)
         
-        return JSONResponse(content={
-            "success": True,
+        response_data = {
+            "success": not final_state.get("error"),
             "question": question,
             "answer": final_state.get("final_answer"),
-            "trace": final_state # Opcional: devuelve el estado completo para depuración
-        }, status_code=200)
+            "cached": cached
+        }
+        # El estado completo (resultados de búsqueda incluidos) solo se devuelve para depuración
+        if settings.DEBUG_TRACE:
+            response_data["trace"] = final_state
+        return response_data
 
     except Exception as e:
-        logger.error(f"❌ Error en el endpoint /chat/: {str(e)}", exc_info=True)
-        raise HTTPException(status_code=500, detail=f"Error interno del servidor: {str(e)}")
\ No newline at end of file
+        logger.error("❌ Error en el endpoint /chat/: %s", e, exc_info=True)
+        raise HTTPException(status_code=500, detail=f"Error interno del servidor: {str(e)}")
+
+@app.post("/chat/stream/")
+async def chat_stream(question: str = Form(...)) -> StreamingResponse:
+    """
+    Recibe una pregunta y devuelve la respuesta del agente RAG en streaming,
+    fragmento a fragmento, a medida que el modelo la genera.
+    """
+    # Import diferido: el agente RAG solo se inicializa si se usa este endpoint
+    from app.core.ai_agent import get_ai_agent
+
+    logger.info("💬 Nueva pregunta en streaming: %s", question)
+    return StreamingResponse(get_ai_agent().process_request_stream(question), media_type="text/plain; charset=utf-8")
+
+if __name__ == "__main__":
+    import sys
+
+    import uvicorn
+
+    # uvloop y httptools aceleran el event loop y el parser HTTP; uvloop no existe en Windows
+    uvicorn.run(
+        "app.main:app",
+        host="127.0.0.1",
+        port=8000,
+        reload=True,
+        loop="asyncio" if sys.platform == "win32" else "uvloop",
+        http="httptools"
+    )
@@ -1,18 +1,279 @@
 import os
-from typing import Optional
+import threading
+from dataclasses import dataclass
+from typing import Optional, Union
+
+import aiohttp
+import httpx
+import requests
 from azure.core.credentials import AzureKeyCredential
+from azure.identity import DefaultAzureCredential, get_bearer_token_provider
+from azure.identity.aio import DefaultAzureCredential as AsyncDefaultAzureCredential
+from azure.core.pipeline.transport import AioHttpTransport, RequestsTransport
 from azure.ai.formrecognizer import DocumentAnalysisClient
+from azure.ai.formrecognizer.aio import DocumentAnalysisClient as AsyncDocumentAnalysisClient
 from azure.search.documents import SearchClient
-from langchain_openai import AzureChatOpenAI
+from azure.search.documents.aio import SearchClient as AsyncSearchClient
+from azure.storage.blob import BlobServiceClient, ContainerClient
+from langchain_openai import AzureChatOpenAI, AzureOpenAIEmbeddings
+from openai import DefaultAioHttpClient
 
+from app.config.settings import settings  # Carga el .env antes de leer el entorno
 from app.utils.logger import get_logger
 
 logger = get_logger(__name__)
 
+
+@dataclass(frozen=True)
+class _AzCfg:
+    """Variables de entorno de los clientes de Azure, leídas una sola vez al importar"""
+    openai_endpoint: Optional[str]
+    openai_api_key: Optional[str]
+    openai_deployment: Optional[str]
+    openai_small_deployment: Optional[str]
+    openai_embedding_deployment: str
+    openai_api_version: str
+    search_endpoint: Optional[str]
+    search_api_key: Optional[str]
+    search_index_name: Optional[str]
+    doc_intelligence_endpoint: Optional[str]
+    doc_intelligence_key: Optional[str]
+    storage_connection_string: Optional[str]
+    storage_container_name: Optional[str]
+
+
+# Versión de la API de Azure OpenAI si OPENAI_API_VERSION no está definida
+_DEFAULT_OPENAI_API_VERSION = "2024-12-01-preview"
+
+_CFG = _AzCfg(
+    openai_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT"),
+    openai_api_key=os.getenv("AZURE_OPENAI_API_KEY"),
+    openai_deployment=os.getenv("AZURE_OPENAI_DEPLOYMENT_NAME"),
+    openai_small_deployment=os.getenv("AZURE_OPENAI_SMALL_DEPLOYMENT_NAME"),
+    # Por defecto el deployment de embeddings se llama como el modelo (EMBEDDING_MODEL)
+    openai_embedding_deployment=os.getenv("AZURE_OPENAI_EMBEDDING_DEPLOYMENT_NAME", settings.EMBEDDING_MODEL),
+    openai_api_version=os.getenv("OPENAI_API_VERSION", _DEFAULT_OPENAI_API_VERSION),
+    search_endpoint=os.getenv("AZURE_SEARCH_ENDPOINT"),
+    search_api_key=os.getenv("AZURE_SEARCH_API_KEY"),
+    search_index_name=os.getenv("AZURE_SEARCH_INDEX_NAME"),
+    doc_intelligence_endpoint=os.getenv("AZURE_DOCUMENT_INTELLIGENCE_ENDPOINT"),
+    doc_intelligence_key=os.getenv("AZURE_DOCUMENT_INTELLIGENCE_KEY"),
+    storage_connection_string=os.getenv("AZURE_STORAGE_CONNECTION_STRING"),
+    storage_container_name=os.getenv("AZURE_STORAGE_CONTAINER_NAME")
+)
+
+# Nombre de la variable de entorno de cada campo de _CFG, para indicar cuál falta
+_ENV_NAMES = {
+    "openai_endpoint": "AZURE_OPENAI_ENDPOINT",
+    "openai_api_key": "AZURE_OPENAI_API_KEY",
+    "openai_deployment": "AZURE_OPENAI_DEPLOYMENT_NAME",
+    "openai_small_deployment": "AZURE_OPENAI_SMALL_DEPLOYMENT_NAME",
+    "openai_embedding_deployment": "AZURE_OPENAI_EMBEDDING_DEPLOYMENT_NAME",
+    "openai_api_version": "OPENAI_API_VERSION",
+    "search_endpoint": "AZURE_SEARCH_ENDPOINT",
+    "search_api_key": "AZURE_SEARCH_API_KEY",
+    "search_index_name": "AZURE_SEARCH_INDEX_NAME",
+    "doc_intelligence_endpoint": "AZURE_DOCUMENT_INTELLIGENCE_ENDPOINT",
+    "doc_intelligence_key": "AZURE_DOCUMENT_INTELLIGENCE_KEY",
+    "storage_connection_string": "AZURE_STORAGE_CONNECTION_STRING",
+    "storage_container_name": "AZURE_STORAGE_CONTAINER_NAME"
+}
+
+# Las claves de servicio solo son opcionales con AZURE_USE_ENTRA_ID activado: así un nombre de
+# variable mal escrito falla con un error claro en lugar de sondear la identidad administrada
+_USE_ENTRA_ID = settings.AZURE_USE_ENTRA_ID
+_OPENAI_KEY = () if _USE_ENTRA_ID else ("openai_api_key",)
+_SEARCH_KEY = () if _USE_ENTRA_ID else ("search_api_key",)
+_DOC_INTELLIGENCE_KEY = () if _USE_ENTRA_ID else ("doc_intelligence_key",)
+
+# Campos obligatorios de cada servicio
+_REQUIRED_OPENAI = ("openai_endpoint", "openai_deployment", "openai_api_version") + _OPENAI_KEY
+_REQUIRED_OPENAI_SMALL = ("openai_endpoint", "openai_api_version") + _OPENAI_KEY
+_REQUIRED_OPENAI_EMBEDDINGS = ("openai_endpoint", "openai_embedding_deployment", "openai_api_version") + _OPENAI_KEY
+_REQUIRED_SEARCH = ("search_endpoint", "search_index_name") + _SEARCH_KEY
+_REQUIRED_DOC_INTELLIGENCE = ("doc_intelligence_endpoint",) + _DOC_INTELLIGENCE_KEY
+_REQUIRED_STORAGE = ("storage_connection_string",)
+
+
+def _missing_vars(required) -> list:
+    """
+    Variables de entorno obligatorias sin definir; una cadena vacía cuenta como no definida
+    """
+    return [_ENV_NAMES[name] for name in required if not getattr(_CFG, name)]
+
+
+def _check_required(service: str, required) -> None:
+    """
+    Lanzar ValueError indicando qué variables de entorno faltan para un servicio
+    """
+    missing = _missing_vars(required)
+    if missing:
+        raise ValueError(f"Faltan variables de entorno para {service}: {', '.join(missing)}")
+
+
+# Avisar al importar de la configuración incompleta; el arranque de la API falla con
+# validate_all_clients(strict=True) y cada getter falla al usarse si le falta algo
+_missing = _missing_vars(
+    _REQUIRED_OPENAI + _REQUIRED_SEARCH + _REQUIRED_DOC_INTELLIGENCE + _REQUIRED_STORAGE + ("storage_container_name",)
+)
+if _missing:
+    logger.warning("⚠️ Variables de entorno de Azure sin definir: %s", ', '.join(_missing))
+
 # Cache para los clientes (singleton pattern)
+# Un solo lock reentrante protege la creación: algunos getters llaman a otros
+_client_lock = threading.RLock()
 _openai_client: Optional[AzureChatOpenAI] = None
+_openai_small_client: Optional[AzureChatOpenAI] = None
+_openai_embeddings_client: Optional[AzureOpenAIEmbeddings] = None
 _search_client: Optional[SearchClient] = None
 _doc_intelligence_client: Optional[DocumentAnalysisClient] = None
+_async_search_client: Optional[AsyncSearchClient] = None
+_async_doc_intelligence_client: Optional[AsyncDocumentAnalysisClient] = None
+_azure_aio_session: Optional[aiohttp.ClientSession] = None
+_openai_http_client: Optional[DefaultAioHttpClient] = None
+_blob_service_client: Optional[BlobServiceClient] = None
+_azure_requests_session: Optional[requests.Session] = None
+_credential: Optional[DefaultAzureCredential] = None
+_async_credential: Optional[AsyncDefaultAzureCredential] = None
+
+# Ámbito del token de Entra ID para Azure OpenAI y Document Intelligence
+_COGNITIVE_SERVICES_SCOPE = "https://cognitiveservices.azure.com/.default"
+
+# Timeouts comunes de los transportes de Azure (segundos)
+_TRANSPORT_KWARGS = {"connection_timeout": 5, "read_timeout": 30, "connection_verify": True}
+
+
+def get_credential() -> DefaultAzureCredential:
+    """
+    Obtener la credencial de Entra ID compartida por todos los clientes síncronos.
+    La caché de tokens del SDK es por instancia: compartirla evita pedir un token por cliente.
+    """
+    global _credential
+    if _credential is None:
+        with _client_lock:
+            if _credential is None:
+                _credential = DefaultAzureCredential(exclude_interactive_browser_credential=True)
+                logger.info("Credencial de Entra ID compartida inicializada correctamente")
+    return _credential
+
+
+def get_async_credential() -> AsyncDefaultAzureCredential:
+    """
+    Obtener la credencial de Entra ID compartida por todos los clientes asíncronos
+    """
+    global _async_credential
+    if _async_credential is None:
+        with _client_lock:
+            if _async_credential is None:
+                _async_credential = AsyncDefaultAzureCredential(exclude_interactive_browser_credential=True)
+                logger.info("Credencial asíncrona de Entra ID compartida inicializada correctamente")
+    return _async_credential
+
+
+def _require_entra_id() -> None:
+    """
+    Lanzar ValueError si falta una clave de servicio y no se ha activado AZURE_USE_ENTRA_ID
+    """
+    if not _USE_ENTRA_ID:
+        raise ValueError("Falta la clave del servicio y AZURE_USE_ENTRA_ID no está activado")
+
+
+def _credential_for(key: Optional[str]) -> Union[AzureKeyCredential, DefaultAzureCredential]:
+    """
+    Usar la clave del servicio si está configurada y, si no, la credencial de Entra ID compartida
+    (solo con AZURE_USE_ENTRA_ID activado)
+    """
+    if key:
+        return AzureKeyCredential(key)
+    _require_entra_id()
+    return get_credential()
+
+
+def _async_credential_for(key: Optional[str]) -> Union[AzureKeyCredential, AsyncDefaultAzureCredential]:
+    """
+    Variante de _credential_for para los clientes asíncronos
+    """
+    if key:
+        return AzureKeyCredential(key)
+    _require_entra_id()
+    return get_async_credential()
+
+
+def _openai_auth_kwargs(api_key: Optional[str]) -> dict:
+    """
+    Argumentos de autenticación de AzureChatOpenAI: clave API o tokens de la credencial compartida
+    """
+    if api_key:
+        return {"api_key": api_key}
+    _require_entra_id()
+    return {"azure_ad_token_provider": get_bearer_token_provider(get_credential(), _COGNITIVE_SERVICES_SCOPE)}
+
+
+def get_azure_sync_transport() -> RequestsTransport:
+    """
+    Obtener un transporte para los SDK síncronos de Azure sobre una sesión de requests compartida.
+    Search, Document Intelligence y Blob Storage reutilizan el mismo pool de conexiones.
+    """
+    global _azure_requests_session
+    if _azure_requests_session is None:
+        with _client_lock:
+            if _azure_requests_session is None:
+                _azure_requests_session = requests.Session()
+                # Un pool por host (Search, Document Intelligence, Storage) con hasta N conexiones cada uno
+                adapter = requests.adapters.HTTPAdapter(
+                    pool_connections=20,
+                    pool_maxsize=settings.AZURE_HTTP_POOL_PER_HOST
+                )
+                _azure_requests_session.mount("https://", adapter)
+                logger.info("Sesión HTTP (requests) compartida para Azure inicializada correctamente")
+    # session_owner=False: cerrar un cliente no cierra la sesión que usan los demás
+    return RequestsTransport(session=_azure_requests_session, session_owner=False, **_TRANSPORT_KWARGS)
+
+
+def close_azure_sync_transport() -> None:
+    """
+    Cerrar la sesión HTTP compartida de los clientes síncronos de Azure
+    """
+    global _azure_requests_session
+    if _azure_requests_session is not None:
+        _azure_requests_session.close()
+        _azure_requests_session = None
+        logger.info("Sesión HTTP compartida de Azure (requests) cerrada")
+
+
+def get_openai_http_client() -> DefaultAioHttpClient:
+    """
+    Obtener el cliente HTTP asíncrono compartido para Azure OpenAI.
+    Usa el transporte de aiohttp, que se degrada mucho menos que httpx bajo concurrencia.
+    Las conexiones se mantienen vivas y se reutilizan entre peticiones.
+    """
+    global _openai_http_client
+    if _openai_http_client is None:
+        with _client_lock:
+            if _openai_http_client is None:
+                _openai_http_client = DefaultAioHttpClient(
+                    limits=httpx.Limits(max_connections=64, max_keepalive_connections=32)
+                )
+                logger.info("Cliente HTTP (aiohttp) para Azure OpenAI inicializado correctamente")
+    return _openai_http_client
+
+
+async def close_openai_http_client() -> None:
+    """
+    Cerrar el cliente HTTP compartido de Azure OpenAI y liberar su pool de conexiones
+    """
+    global _openai_http_client, _openai_client, _openai_small_client, _openai_embeddings_client
+    with _client_lock:
+        http_client = _openai_http_client
+        # Los clientes de chat y embeddings en caché usan este cliente HTTP: se descartan
+        # para que el siguiente get_openai_client() los reconstruya con uno nuevo
+        _openai_http_client = None
+        _openai_client = None
+        _openai_small_client = None
+        _openai_embeddings_client = None
+    if http_client is not None:
+        await http_client.aclose()
+        logger.info("Cliente HTTP de Azure OpenAI cerrado")
 
 
 def get_openai_client() -> AzureChatOpenAI:
@@ -22,55 +283,123 @@ def get_openai_client() -> AzureChatOpenAI:
     """
     global _openai_client
     if _openai_client is None:
-        try:
-            # Validamos que todas las variables necesarias existan
-            endpoint = os.getenv("AZURE_OPENAI_ENDPOINT")
-            api_key = os.getenv("AZURE_OPENAI_API_KEY")
-            deployment = os.getenv("AZURE_OPENAI_DEPLOYMENT_NAME")
-            api_version = os.getenv("OPENAI_API_VERSION")
-
-            if not all([endpoint, api_key, deployment, api_version]):
-                raise ValueError("Faltan variables de entorno para Azure OpenAI.")
-
-            _openai_client = AzureChatOpenAI(
-                azure_endpoint=endpoint,
-                api_key=api_key,
-                azure_deployment=deployment,
-                api_version=api_version # <-- CORREGIDO: Se lee del .env
-            )
-            logger.info("Cliente de Azure OpenAI inicializado correctamente")
-        except Exception as e:
-            logger.error(f"Error inicializando cliente de Azure OpenAI: {str(e)}")
-            raise
+        with _client_lock:
+            if _openai_client is None:
+                try:
+                    # Validamos que todas las variables necesarias existan
+                    endpoint = _CFG.openai_endpoint
+                    api_key = _CFG.openai_api_key
+                    deployment = _CFG.openai_deployment
+                    api_version = _CFG.openai_api_version
+
+                    _check_required("Azure OpenAI", _REQUIRED_OPENAI)
+
+                    _openai_client = AzureChatOpenAI(
+                        azure_endpoint=endpoint,
+                        azure_deployment=deployment,
+                        api_version=api_version,
+                        http_async_client=get_openai_http_client(),
+                        **_openai_auth_kwargs(api_key)
+                    )
+                    logger.info("Cliente de Azure OpenAI inicializado correctamente")
+                except Exception as e:
+                    logger.error("Error inicializando cliente de Azure OpenAI: %s", e)
+                    raise
     return _openai_client
 
 
+def get_openai_small_client() -> AzureChatOpenAI:
+    """
+    Obtener cliente de Azure OpenAI para un modelo pequeño (clasificación, filtros).
+    Usa el deployment de AZURE_OPENAI_SMALL_DEPLOYMENT_NAME; si no está definido,
+    devuelve el cliente principal.
+    """
+    global _openai_small_client
+    if _openai_small_client is None:
+        with _client_lock:
+            if _openai_small_client is None:
+                deployment = _CFG.openai_small_deployment
+                if not deployment:
+                    return get_openai_client()
+                try:
+                    endpoint = _CFG.openai_endpoint
+                    api_key = _CFG.openai_api_key
+                    api_version = _CFG.openai_api_version
+
+                    _check_required("Azure OpenAI", _REQUIRED_OPENAI_SMALL)
+
+                    _openai_small_client = AzureChatOpenAI(
+                        azure_endpoint=endpoint,
+                        azure_deployment=deployment,
+                        api_version=api_version,
+                        temperature=0,
+                        http_async_client=get_openai_http_client(),
+                        **_openai_auth_kwargs(api_key)
+                    )
+                    logger.info("Cliente de Azure OpenAI (modelo pequeño: %s) inicializado correctamente", deployment)
+                except Exception as e:
+                    logger.error("Error inicializando cliente de Azure OpenAI (modelo pequeño): %s", e)
+                    raise
+    return _openai_small_client
+
+
+def get_openai_embeddings_client() -> AzureOpenAIEmbeddings:
+    """
+    Obtener cliente de embeddings de Azure OpenAI.
+    Usa el deployment de AZURE_OPENAI_EMBEDDING_DEPLOYMENT_NAME o, si no está definido,
+    el de EMBEDDING_MODEL, y comparte el cliente HTTP con los clientes de chat.
+    """
+    global _openai_embeddings_client
+    if _openai_embeddings_client is None:
+        with _client_lock:
+            if _openai_embeddings_client is None:
+                try:
+                    endpoint = _CFG.openai_endpoint
+                    api_key = _CFG.openai_api_key
+                    deployment = _CFG.openai_embedding_deployment
+                    api_version = _CFG.openai_api_version
+
+                    _check_required("Azure OpenAI (embeddings)", _REQUIRED_OPENAI_EMBEDDINGS)
+
+                    _openai_embeddings_client = AzureOpenAIEmbeddings(
+                        azure_endpoint=endpoint,
+                        azure_deployment=deployment,
+                        api_version=api_version,
+                        http_async_client=get_openai_http_client(),
+                        **_openai_auth_kwargs(api_key)
+                    )
+                    logger.info("Cliente de embeddings de Azure OpenAI (%s) inicializado correctamente", deployment)
+                except Exception as e:
+                    logger.error("Error inicializando cliente de embeddings de Azure OpenAI: %s", e)
+                    raise
+    return _openai_embeddings_client
+
+
 def get_search_client() -> SearchClient:
     """
     Obtener cliente de Azure Cognitive Search
     """
     global _search_client
     if _search_client is None:
-        try:
-            endpoint = os.getenv("AZURE_SEARCH_ENDPOINT") # <-- CORREGIDO: Nombre simplificado
-            key = os.getenv("AZURE_SEARCH_ADMIN_KEY")
-            index_name = os.getenv("AZURE_SEARCH_INDEX_NAME") # <-- CORREGIDO: Se valida que exista
-
-            if not all([endpoint, key, index_name]):
-                error_msg = "Revisa tus variables de entorno. Faltan valores para Azure Search (ENDPOINT, ADMIN_KEY, INDEX_NAME)."
-                logger.error({"event": error_msg})
-                raise ValueError(error_msg)
-
-            credential = AzureKeyCredential(key)
-            _search_client = SearchClient(
-                endpoint=endpoint,
-                index_name=index_name,
-                credential=credential
-            )
-            logger.info("Cliente de Azure Cognitive Search inicializado correctamente")
-        except Exception as e:
-            logger.error(f"Error inicializando cliente de Azure Cognitive Search: {str(e)}")
-            raise
+        with _client_lock:
+            if _search_client is None:
+                try:
+                    endpoint = _CFG.search_endpoint # <-- CORREGIDO: Nombre simplificado
+                    key = _CFG.search_api_key
+                    index_name = _CFG.search_index_name # <-- CORREGIDO: Se valida que exista
+
+                    _check_required("Azure Search", _REQUIRED_SEARCH)
+
+                    _search_client = SearchClient(
+                        endpoint=endpoint,
+                        index_name=index_name,
+                        credential=_credential_for(key),
+                        transport=get_azure_sync_transport()
+                    )
+                    logger.info("Cliente de Azure Cognitive Search inicializado correctamente")
+                except Exception as e:
+                    logger.error("Error inicializando cliente de Azure Cognitive Search: %s", e)
+                    raise
     return _search_client
 
 
@@ -80,20 +409,187 @@ def get_doc_intelligence_client() -> DocumentAnalysisClient:
     """
     global _doc_intelligence_client
     if _doc_intelligence_client is None:
+        with _client_lock:
+            if _doc_intelligence_client is None:
+                try:
+                    endpoint = _CFG.doc_intelligence_endpoint
+                    key = _CFG.doc_intelligence_key
+
+                    _check_required("Azure Document Intelligence", _REQUIRED_DOC_INTELLIGENCE)
+
+                    _doc_intelligence_client = DocumentAnalysisClient(
+                        endpoint=endpoint,
+                        credential=_credential_for(key),
+                        transport=get_azure_sync_transport()
+                    )
+                    logger.info("Cliente de Azure Document Intelligence inicializado correctamente")
+                except Exception as e:
+                    logger.error("Error inicializando cliente de Azure Document Intelligence: %s", e)
+                    raise
+    return _doc_intelligence_client
+
+
+def get_blob_service_client() -> BlobServiceClient:
+    """
+    Obtener cliente de Azure Blob Storage
+    """
+    global _blob_service_client
+    if _blob_service_client is None:
+        with _client_lock:
+            if _blob_service_client is None:
+                try:
+                    connection_string = _CFG.storage_connection_string
+
+                    _check_required("Azure Storage", _REQUIRED_STORAGE)
+
+                    _blob_service_client = BlobServiceClient.from_connection_string(
+                        connection_string,
+                        transport=get_azure_sync_transport()
+                    )
+                    logger.info("Cliente de Azure Blob Storage inicializado correctamente")
+                except Exception as e:
+                    logger.error("Error inicializando cliente de Azure Blob Storage: %s", e)
+                    raise
+    return _blob_service_client
+
+
+def get_blob_container_client(container_name: Optional[str] = None) -> ContainerClient:
+    """
+    Obtener cliente de un contenedor de Azure Blob Storage (comparte el transporte del servicio)
+    """
+    container_name = container_name or _CFG.storage_container_name
+    if not container_name:
+        raise ValueError("Falta AZURE_STORAGE_CONTAINER_NAME para Azure Storage.")
+    return get_blob_service_client().get_container_client(container_name)
+
+
+def validate_all_clients(strict: bool = False) -> bool:
+    """
+    Validar que todos los clientes de Azure se pueden construir con la configuración actual.
+    Los que usan Entra ID comparten la misma credencial, así que el token se obtiene una sola vez.
+    
+    Args:
+        strict: Lanzar una excepción en lugar de devolver False (para el arranque de la aplicación)
+    
+    Returns:
+        True si todos los clientes se inicializaron correctamente, False en caso contrario
+        
+    Raises:
+        ValueError: Si strict es True y algún cliente no se puede construir
+    """
+    # Con variables obligatorias sin definir no hace falta intentar construir ningún cliente
+    if _missing:
+        logger.error("❌ Configuración de Azure incompleta: %s", ', '.join(_missing))
+        if strict:
+            raise ValueError(f"Faltan variables de entorno de Azure: {', '.join(_missing)}")
+        return False
+    
+    getters = (get_openai_client, get_search_client, get_doc_intelligence_client, get_blob_service_client)
+    errors = []
+    for getter in getters:
         try:
-            endpoint = os.getenv("AZURE_DOC_INTELLIGENCE_ENDPOINT")
-            key = os.getenv("AZURE_DOC_INTELLIGENCE_KEY")
-
-            if not all([endpoint, key]):
-                raise ValueError("Configuraciones de Azure Document Intelligence incompletas.")
-
-            credential = AzureKeyCredential(key)
-            _doc_intelligence_client = DocumentAnalysisClient(
-                endpoint=endpoint,
-                credential=credential
-            )
-            logger.info("Cliente de Azure Document Intelligence inicializado correctamente")
+            getter()
         except Exception as e:
-            logger.error(f"Error inicializando cliente de Azure Document Intelligence: {str(e)}")
-            raise
-    return _doc_intelligence_client
\ No newline at end of file
+            logger.error("❌ Cliente no válido (%s): %s", getter.__name__, e)
+            errors.append(f"{getter.__name__}: {e}")
+    if errors and strict:
+        raise ValueError(f"Clientes de Azure no válidos: {'; '.join(errors)}")
+    return not errors
+
+
+def get_azure_aio_transport() -> AioHttpTransport:
+    """
+    Obtener un transporte para los SDK asíncronos de Azure sobre una sesión de aiohttp compartida.
+    Las conexiones TLS se mantienen vivas y se reutilizan entre Search y Document Intelligence.
+    Debe llamarse con el event loop en marcha.
+    """
+    global _azure_aio_session
+    if _azure_aio_session is None or _azure_aio_session.closed:
+        with _client_lock:
+            if _azure_aio_session is None or _azure_aio_session.closed:
+                # Límites explícitos: evitan esperas por conexión en ráfagas y acotan los sockets abiertos
+                _azure_aio_session = aiohttp.ClientSession(
+                    connector=aiohttp.TCPConnector(
+                        limit=settings.AZURE_HTTP_POOL_MAXSIZE,
+                        limit_per_host=settings.AZURE_HTTP_POOL_PER_HOST,
+                        ttl_dns_cache=300,
+                        keepalive_timeout=settings.AZURE_HTTP_MAX_IDLE_SECONDS
+                    )
+                )
+                logger.info("Sesión HTTP (aiohttp) compartida para Azure inicializada correctamente")
+    # session_owner=False: cerrar un cliente no cierra la sesión que usan los demás
+    return AioHttpTransport(session=_azure_aio_session, session_owner=False, **_TRANSPORT_KWARGS)
+
+
+def get_async_search_client() -> AsyncSearchClient:
+    """
+    Obtener cliente asíncrono de Azure Cognitive Search (no bloquea el event loop)
+    """
+    global _async_search_client
+    if _async_search_client is None:
+        with _client_lock:
+            if _async_search_client is None:
+                try:
+                    endpoint = _CFG.search_endpoint
+                    key = _CFG.search_api_key
+                    index_name = _CFG.search_index_name
+
+                    _check_required("Azure Search", _REQUIRED_SEARCH)
+
+                    _async_search_client = AsyncSearchClient(
+                        endpoint=endpoint,
+                        index_name=index_name,
+                        credential=_async_credential_for(key),
+                        transport=get_azure_aio_transport()
+                    )
+                    logger.info("Cliente asíncrono de Azure Cognitive Search inicializado correctamente")
+                except Exception as e:
+                    logger.error("Error inicializando cliente asíncrono de Azure Cognitive Search: %s", e)
+                    raise
+    return _async_search_client
+
+
+def get_async_doc_intelligence_client() -> AsyncDocumentAnalysisClient:
+    """
+    Obtener cliente asíncrono de Azure Document Intelligence (no bloquea el event loop)
+    """
+    global _async_doc_intelligence_client
+    if _async_doc_intelligence_client is None:
+        with _client_lock:
+            if _async_doc_intelligence_client is None:
+                try:
+                    endpoint = _CFG.doc_intelligence_endpoint
+                    key = _CFG.doc_intelligence_key
+
+                    _check_required("Azure Document Intelligence", _REQUIRED_DOC_INTELLIGENCE)
+
+                    _async_doc_intelligence_client = AsyncDocumentAnalysisClient(
+                        endpoint=endpoint,
+                        credential=_async_credential_for(key),
+                        transport=get_azure_aio_transport()
+                    )
+                    logger.info("Cliente asíncrono de Azure Document Intelligence inicializado correctamente")
+                except Exception as e:
+                    logger.error("Error inicializando cliente asíncrono de Azure Document Intelligence: %s", e)
+                    raise
+    return _async_doc_intelligence_client
+
+
+async def close_async_azure_clients() -> None:
+    """
+    Cerrar los clientes asíncronos de Azure Search y Document Intelligence, la sesión HTTP y la credencial compartidas
+    """
+    global _async_search_client, _async_doc_intelligence_client, _azure_aio_session, _async_credential
+    if _async_search_client is not None:
+        await _async_search_client.close()
+        _async_search_client = None
+    if _async_doc_intelligence_client is not None:
+        await _async_doc_intelligence_client.close()
+        _async_doc_intelligence_client = None
+    if _azure_aio_session is not None:
+        await _azure_aio_session.close()
+        _azure_aio_session = None
+    if _async_credential is not None:
+        await _async_credential.close()
+        _async_credential = None
+    logger.info("Clientes asíncronos de Azure cerrados")
@@ -3,12 +3,18 @@ Utilidades para trabajar con servicios de Azure
 Actualizado para usar los nuevos clientes de Azure AI
 """
 
+import asyncio
 import logging
-from typing import Optional, Dict, Any, List
+import threading
+from typing import Optional, Dict, Any, List, AsyncIterator, Iterable, Iterator
+
+import orjson
 from azure.storage.blob import BlobServiceClient, ContainerClient
-from azure.ai.search import SearchClient
+from azure.search.documents import SearchClient
+from azure.search.documents.models import VectorizedQuery
 from azure.ai.formrecognizer import DocumentAnalysisClient
 from azure.core.credentials import AzureKeyCredential
+from azure.core.exceptions import AzureError
 
 from app.config.settings import settings
 from app.utils.logger import get_logger
@@ -21,6 +27,35 @@ from app.utils.azure_clients import (
 
 logger = get_logger(__name__)
 
+# Límites de Azure Search por petición de indexación
+_SEARCH_MAX_BATCH_DOCS = 1000
+_SEARCH_MAX_BATCH_BYTES = 16 * 1024 * 1024
+# Lotes de indexación enviados en paralelo como máximo
+_SEARCH_MAX_CONCURRENT_BATCHES = 8
+
+def _search_batches(documents: Iterable[Dict[str, Any]], batch_size: int) -> Iterator[List[Dict[str, Any]]]:
+    """
+    Agrupar documentos en lotes que respetan los límites de tamaño de Azure Search
+    
+    Args:
+        documents: Documentos a indexar
+        batch_size: Número máximo de documentos por lote
+        
+    Returns:
+        Iterador de lotes de documentos
+    """
+    batch: List[Dict[str, Any]] = []
+    batch_bytes = 0
+    for document in documents:
+        size = len(orjson.dumps(document))
+        if batch and (len(batch) >= batch_size or batch_bytes + size > _SEARCH_MAX_BATCH_BYTES):
+            yield batch
+            batch, batch_bytes = [], 0
+        batch.append(document)
+        batch_bytes += size
+    if batch:
+        yield batch
+
 class AzureStorageHelper:
     """Helper para trabajar con Azure Storage usando los nuevos clientes"""
     
@@ -29,10 +64,30 @@ class AzureStorageHelper:
         try:
             self.client = get_blob_service_client()
             self.container_name = settings.AZURE_STORAGE_CONTAINER_NAME
+            # Un ContainerClient por contenedor, reutilizado entre llamadas
+            self._containers: Dict[str, ContainerClient] = {}
             logger.info("Azure Storage Helper inicializado correctamente")
-        except Exception as e:
+        except Exception:
             self.client = None
-            logger.error(f"Error inicializando Azure Storage Helper: {str(e)}")
+            logger.exception("Error inicializando Azure Storage Helper")
+        # Se decide una sola vez si el helper está operativo
+        self.enabled = self.client is not None
+    
+    def _container(self, container_name: Optional[str] = None) -> ContainerClient:
+        """
+        Obtener el cliente de un contenedor, creándolo solo la primera vez
+        
+        Args:
+            container_name: Nombre del contenedor (opcional, usa el de configuración por defecto)
+            
+        Returns:
+            Cliente del contenedor
+        """
+        container_name = container_name or self.container_name
+        container_client = self._containers.get(container_name)
+        if container_client is None:
+            container_client = self._containers[container_name] = self.client.get_container_client(container_name)
+        return container_client
     
     async def upload_blob(self, blob_name: str, data: bytes, container_name: Optional[str] = None) -> bool:
         """
@@ -47,19 +102,18 @@ class AzureStorageHelper:
             True si se subió correctamente, False en caso contrario
         """
         try:
-            if not self.client:
+            if not self.enabled:
                 return False
             
             container_name = container_name or self.container_name
-            container_client = self.client.get_container_client(container_name)
-            blob_client = container_client.get_blob_client(blob_name)
+            blob_client = self._container(container_name).get_blob_client(blob_name)
             
-            blob_client.upload_blob(data, overwrite=True)
-            logger.info(f"Blob {blob_name} subido exitosamente al contenedor {container_name}")
+            await asyncio.to_thread(blob_client.upload_blob, data, overwrite=True)
+            logger.info("Blob %s subido exitosamente al contenedor %s", blob_name, container_name)
             return True
             
-        except Exception as e:
-            logger.error(f"Error subiendo blob {blob_name}: {str(e)}")
+        except AzureError:
+            logger.exception("Error subiendo blob %s", blob_name)
             return False
     
     async def download_blob(self, blob_name: str, container_name: Optional[str] = None) -> Optional[bytes]:
@@ -74,18 +128,15 @@ class AzureStorageHelper:
             Datos del blob o None si hay error
         """
         try:
-            if not self.client:
+            if not self.enabled:
                 return None
             
-            container_name = container_name or self.container_name
-            container_client = self.client.get_container_client(container_name)
-            blob_client = container_client.get_blob_client(blob_name)
+            blob_client = self._container(container_name).get_blob_client(blob_name)
             
-            download_stream = blob_client.download_blob()
-            return download_stream.readall()
+            return await asyncio.to_thread(lambda: blob_client.download_blob().readall())
             
-        except Exception as e:
-            logger.error(f"Error descargando blob {blob_name}: {str(e)}")
+        except AzureError:
+            logger.exception("Error descargando blob %s", blob_name)
             return None
     
     async def list_blobs(self, container_name: Optional[str] = None, prefix: Optional[str] = None) -> List[str]:
@@ -99,22 +150,34 @@ class AzureStorageHelper:
         Returns:
             Lista de nombres de blobs
         """
-        try:
-            if not self.client:
-                return []
-            
-            container_name = container_name or self.container_name
-            container_client = self.client.get_container_client(container_name)
+        return [blob_name async for blob_name in self.iter_blobs(container_name, prefix)]
+    
+    async def iter_blobs(self, container_name: Optional[str] = None, prefix: Optional[str] = None) -> AsyncIterator[str]:
+        """
+        Recorrer los blobs de un contenedor, página a página
+        Los nombres se emiten a medida que llegan, así que quien solo necesita los primeros
+        puede dejar de iterar sin descargar el resto del listado
+        
+        Args:
+            container_name: Nombre del contenedor (opcional, usa el de configuración por defecto)
+            prefix: Prefijo para filtrar blobs
             
-            blobs = []
-            for blob in container_client.list_blobs(name_starts_with=prefix):
-                blobs.append(blob.name)
+        Returns:
+            Iterador asíncrono con los nombres de los blobs
+        """
+        if not self.enabled:
+            return
+        
+        try:
+            pages = self._container(container_name).list_blobs(name_starts_with=prefix, results_per_page=5000).by_page()
             
-            return blobs
+            # Cada página se descarga en un hilo para no bloquear el event loop
+            while (page := await asyncio.to_thread(next, pages, None)) is not None:
+                for blob in page:
+                    yield blob.name
             
-        except Exception as e:
-            logger.error(f"Error listando blobs: {str(e)}")
-            return []
+        except AzureError:
+            logger.exception("Error listando blobs")
 
 class AzureSearchHelper:
     """Helper para trabajar con Azure Cognitive Search"""
@@ -124,11 +187,13 @@ class AzureSearchHelper:
         try:
             self.client = get_search_client()
             logger.info("Azure Search Helper inicializado correctamente")
-        except Exception as e:
+        except Exception:
             self.client = None
-            logger.error(f"Error inicializando Azure Search Helper: {str(e)}")
+            logger.exception("Error inicializando Azure Search Helper")
+        # Se decide una sola vez si el helper está operativo
+        self.enabled = self.client is not None
     
-    async def search_documents(self, query: str, top: int = 5, filter: Optional[str] = None) -> List[Dict[str, Any]]:
+    async def search_documents(self, query: str, top: int = 5, filter: Optional[str] = None, vector: Optional[List[float]] = None, select: Optional[List[str]] = None) -> List[Dict[str, Any]]:
         """
         Buscar documentos en Azure Cognitive Search
         
@@ -136,31 +201,81 @@ class AzureSearchHelper:
             query: Consulta de búsqueda
             top: Número máximo de resultados
             filter: Filtro opcional para la búsqueda
+            vector: Embedding de la consulta para búsqueda híbrida (requiere AZURE_SEARCH_VECTOR_FIELD)
+            select: Campos a devolver (opcional); evita traer campos grandes como el vectorial
             
         Returns:
             Lista de documentos encontrados
         """
         try:
-            if not self.client:
+            if not self.enabled:
                 return []
             
-            results = self.client.search(
-                search_text=query,
-                top=top,
-                filter=filter
-            )
-            
-            documents = []
-            for result in results:
-                documents.append(dict(result))
-            
-            logger.info(f"Búsqueda completada: {len(documents)} documentos encontrados")
+            vector_queries = None
+            if vector is not None and settings.AZURE_SEARCH_VECTOR_FIELD:
+                vector_queries = [VectorizedQuery(
+                    vector=vector,
+                    k_nearest_neighbors=top,
+                    fields=settings.AZURE_SEARCH_VECTOR_FIELD
+                )]
+            
+            # El SDK es síncrono: la búsqueda y la paginación se ejecutan en un hilo
+            documents = await asyncio.to_thread(lambda: [
+                dict(result) for result in self.client.search(
+                    search_text=query,
+                    top=top,
+                    filter=filter,
+                    vector_queries=vector_queries,
+                    select=select or None
+                )
+            ])
+            
+            logger.info("Búsqueda completada: %s documentos encontrados", len(documents))
             return documents
             
-        except Exception as e:
-            logger.error(f"Error en búsqueda de documentos: {str(e)}")
+        except AzureError:
+            logger.exception("Error en búsqueda de documentos")
             return []
     
+    async def upload_documents(self, documents: Iterable[Dict[str, Any]], batch_size: int = _SEARCH_MAX_BATCH_DOCS) -> List[bool]:
+        """
+        Subir documentos al índice de búsqueda en lotes (hasta 1000 documentos / 16 MB por petición)
+        
+        Args:
+            documents: Documentos a subir
+            batch_size: Número máximo de documentos por lote
+            
+        Returns:
+            Lista con el resultado (succeeded) de cada documento, en el mismo orden,
+            para poder reintentar solo los que fallaron
+        """
+        documents = list(documents)
+        if not self.enabled:
+            return [False] * len(documents)
+        try:
+            batches = list(_search_batches(documents, min(batch_size, _SEARCH_MAX_BATCH_DOCS)))
+        except TypeError:
+            # Documentos no serializables (orjson.JSONEncodeError): no se sube ninguno
+            logger.exception("Error preparando los lotes de documentos para el índice")
+            return [False] * len(documents)
+        
+        semaphore = asyncio.Semaphore(_SEARCH_MAX_CONCURRENT_BATCHES)
+        
+        async def upload_batch(batch: List[Dict[str, Any]]) -> List[bool]:
+            async with semaphore:
+                try:
+                    results = await asyncio.to_thread(self.client.upload_documents, batch)
+                    return [result.succeeded for result in results]
+                except AzureError:
+                    logger.exception("Error subiendo lote de %d documentos al índice", len(batch))
+                    return [False] * len(batch)
+        
+        batch_results = await asyncio.gather(*[upload_batch(batch) for batch in batches])
+        succeeded = [ok for batch_result in batch_results for ok in batch_result]
+        
+        logger.info("Documentos subidos al índice de búsqueda: %s/%s", sum(succeeded), len(succeeded))
+        return succeeded
+    
     async def upload_document(self, document: Dict[str, Any]) -> bool:
         """
         Subir un documento al índice de búsqueda
@@ -171,17 +286,20 @@ class AzureSearchHelper:
         Returns:
             True si se subió correctamente, False en caso contrario
         """
-        try:
-            if not self.client:
-                return False
-            
-            self.client.upload_documents([document])
-            logger.info("Documento subido exitosamente al índice de búsqueda")
-            return True
-            
-        except Exception as e:
-            logger.error(f"Error subiendo documento al índice: {str(e)}")
-            return False
+        return (await self.upload_documents([document]))[0]
+
+def _extract_text(result) -> str:
+    """
+    Unir el texto de todas las líneas de un resultado de Document Intelligence
+    
+    Args:
+        result: Resultado de begin_analyze_document
+        
+    Returns:
+        Texto extraído, una línea por renglón (las líneas sin contenido se omiten)
+    """
+    lines = [line.content for page in result.pages for line in page.lines if line.content is not None]
+    return "\n".join(lines) + "\n" if lines else ""
 
 class AzureDocumentIntelligenceHelper:
     """Helper para trabajar con Azure Document Intelligence"""
@@ -191,9 +309,11 @@ class AzureDocumentIntelligenceHelper:
         try:
             self.client = get_doc_intelligence_client()
             logger.info("Azure Document Intelligence Helper inicializado correctamente")
-        except Exception as e:
+        except Exception:
             self.client = None
-            logger.error(f"Error inicializando Azure Document Intelligence Helper: {str(e)}")
+            logger.exception("Error inicializando Azure Document Intelligence Helper")
+        # Se decide una sola vez si el helper está operativo
+        self.enabled = self.client is not None
     
     async def analyze_document(self, document_url: str, model: str = "prebuilt-document") -> Optional[Dict[str, Any]]:
         """
@@ -207,17 +327,14 @@ class AzureDocumentIntelligenceHelper:
             Resultado del análisis o None si hay error
         """
         try:
-            if not self.client:
+            if not self.enabled:
                 return None
             
-            poller = self.client.begin_analyze_document_from_url(model, document_url)
-            result = poller.result()
+            result = await asyncio.to_thread(
+                lambda: self.client.begin_analyze_document_from_url(model, document_url).result()
+            )
             
-            # Extraer texto del documento
-            extracted_text = ""
-            for page in result.pages:
-                for line in page.lines:
-                    extracted_text += line.content + "\n"
+            extracted_text = _extract_text(result)
             
             analysis_result = {
                 "text": extracted_text,
@@ -226,11 +343,11 @@ class AzureDocumentIntelligenceHelper:
                 "model": model
             }
             
-            logger.info(f"Documento analizado exitosamente: {len(extracted_text)} caracteres extraídos")
+            logger.info("Documento analizado exitosamente: %s caracteres extraídos", len(extracted_text))
             return analysis_result
             
-        except Exception as e:
-            logger.error(f"Error analizando documento: {str(e)}")
+        except AzureError:
+            logger.exception("Error analizando documento")
             return None
     
     async def analyze_document_bytes(self, document_bytes: bytes, model: str = "prebuilt-document") -> Optional[Dict[str, Any]]:
@@ -245,17 +362,14 @@ class AzureDocumentIntelligenceHelper:
             Resultado del análisis o None si hay error
         """
         try:
-            if not self.client:
+            if not self.enabled:
                 return None
             
-            poller = self.client.begin_analyze_document(model, document_bytes)
-            result = poller.result()
+            result = await asyncio.to_thread(
+                lambda: self.client.begin_analyze_document(model, document_bytes).result()
+            )
             
-            # Extraer texto del documento
-            extracted_text = ""
-            for page in result.pages:
-                for line in page.lines:
-                    extracted_text += line.content + "\n"
+            extracted_text = _extract_text(result)
             
             analysis_result = {
                 "text": extracted_text,
@@ -264,14 +378,45 @@ class AzureDocumentIntelligenceHelper:
                 "model": model
             }
             
-            logger.info(f"Documento analizado exitosamente: {len(extracted_text)} caracteres extraídos")
+            logger.info("Documento analizado exitosamente: %s caracteres extraídos", len(extracted_text))
             return analysis_result
             
-        except Exception as e:
-            logger.error(f"Error analizando documento: {str(e)}")
+        except AzureError:
+            logger.exception("Error analizando documento")
             return None
 
-# Instancias globales de los helpers
-storage_helper = AzureStorageHelper()
-search_helper = AzureSearchHelper()
-doc_intelligence_helper = AzureDocumentIntelligenceHelper()
+# Instancias globales de los helpers: se construyen en el primer acceso (PEP 562),
+# así importar el módulo no crea clientes de servicios que no se usan
+_HELPER_CLASSES = {
+    "storage_helper": AzureStorageHelper,
+    "search_helper": AzureSearchHelper,
+    "doc_intelligence_helper": AzureDocumentIntelligenceHelper
+}
+_helpers: Dict[str, Any] = {}
+# Lock reentrante, como en azure_clients: el primer acceso puede llegar a la vez desde
+# varios hilos (workers de asyncio.to_thread) y cada helper debe construirse una sola vez
+_helpers_lock = threading.RLock()
+
+def __getattr__(name: str) -> Any:
+    """
+    Construir y memorizar un helper global la primera vez que se accede a él
+    
+    Args:
+        name: Nombre del atributo del módulo
+        
+    Returns:
+        Instancia compartida del helper
+        
+    Raises:
+        AttributeError: Si el nombre no corresponde a ningún helper
+    """
+    helper_class = _HELPER_CLASSES.get(name)
+    if helper_class is None:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    helper = _helpers.get(name)
+    if helper is None:
+        with _helpers_lock:
+            helper = _helpers.get(name)
+            if helper is None:
+                helper = _helpers[name] = helper_class()
+    return helper
@@ -0,0 +1,115 @@
+"""
+Utilidades para ajustar el contexto recuperado a un presupuesto de tokens
+Ordena los fragmentos por relevancia, descarta los menos relevantes que no entran
+en el presupuesto y coloca los más relevantes en los extremos del prompt
+"""
+
+import functools
+import re
+from typing import Callable, List, Sequence, Tuple, TypeVar
+
+import tiktoken
+
+from app.config.settings import settings
+
+T = TypeVar("T")
+
+# Separador de oraciones usado para recortar fragmentos demasiado largos
+_SENTENCE_SPLIT = re.compile(r'(?<=[.!?])\s+')
+
+@functools.cache
+def _get_encoding() -> "tiktoken.Encoding":
+    """
+    Obtener el tokenizador del modelo de generación (se crea una sola vez)
+
+    Returns:
+        Codificador de tiktoken para el modelo configurado
+    """
+    try:
+        return tiktoken.encoding_for_model(settings.GENERATION_MODEL)
+    except KeyError:
+        # Nombre de deployment o modelo desconocido para tiktoken
+        return tiktoken.get_encoding("cl100k_base")
+
+def count_tokens(text: str) -> int:
+    """
+    Contar los tokens de un texto con el tokenizador del modelo de generación
+
+    Args:
+        text: Texto a medir
+
+    Returns:
+        Número de tokens
+    """
+    return len(_get_encoding().encode(text))
+
+def get_context_token_budget() -> int:
+    """
+    Obtener el presupuesto de tokens disponible para el contexto de documentos
+
+    Returns:
+        Tokens máximos del prompt menos la reserva para instrucciones y pregunta
+    """
+    return max(settings.MAX_PROMPT_TOKENS - settings.PROMPT_TOKEN_RESERVE, 0)
+
+def _truncate_to_sentences(text: str, token_budget: int) -> Tuple[str, int]:
+    """
+    Recortar un texto en el límite de una oración para que no supere el presupuesto
+
+    Args:
+        text: Texto a recortar
+        token_budget: Tokens máximos permitidos
+
+    Returns:
+        Texto recortado y número de tokens que ocupa
+    """
+    kept: List[str] = []
+    used = 0
+    for sentence in _SENTENCE_SPLIT.split(text):
+        tokens = count_tokens(sentence)
+        if used + tokens > token_budget:
+            break
+        kept.append(sentence)
+        used += tokens
+    return " ".join(kept), used
+
+def pack_by_relevance(
+    items: Sequence[T],
+    get_score: Callable[[T], float],
+    get_text: Callable[[T], str],
+    token_budget: int
+) -> List[Tuple[T, str]]:
+    """
+    Seleccionar y ordenar fragmentos de contexto dentro de un presupuesto de tokens
+
+    Los fragmentos se ordenan por relevancia y se incluyen mientras quepan. Un
+    fragmento que por sí solo supera la mitad del presupuesto se recorta por
+    oraciones. El resultado se reordena en forma de U: el más relevante al
+    principio, el segundo al final y el resto en el medio.
+
+    Args:
+        items: Fragmentos recuperados, en el orden del buscador
+        get_score: Función que devuelve la relevancia de un fragmento
+        get_text: Función que devuelve el texto de un fragmento
+        token_budget: Tokens disponibles para el contexto
+
+    Returns:
+        Lista de (fragmento, texto a incluir) en el orden en que deben ir en el prompt
+    """
+    # sorted es estable: con puntuaciones iguales se respeta el orden del buscador
+    ranked = sorted(items, key=get_score, reverse=True)
+
+    selected: List[Tuple[T, str]] = []
+    remaining = token_budget
+    for item in ranked:
+        text = get_text(item)
+        tokens = count_tokens(text)
+        if tokens > token_budget // 2:
+            text, tokens = _truncate_to_sentences(text, min(remaining, token_budget // 2))
+        if not text or tokens > remaining:
+            continue
+        selected.append((item, text))
+        remaining -= tokens
+
+    # Orden en U: posiciones pares al frente y posiciones impares al final, invertidas
+    return selected[0::2] + selected[1::2][::-1]
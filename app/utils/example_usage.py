@@ -12,14 +12,15 @@ from app.utils.azure_clients import (
     get_search_client,
     get_doc_intelligence_client,
     get_blob_service_client,
-    validate_all_clients
+    validate_all_clients,
+    close_openai_http_client
 )
 from app.utils.azure_helpers import (
     storage_helper,
     search_helper,
     doc_intelligence_helper
 )
-from app.utils.logger import get_logger
+from app.utils.logger import get_logger, setup_logging
 
 logger = get_logger(__name__)
 
@@ -38,7 +39,7 @@ async def example_validate_configuration():
         return True
         
     except Exception as e:
-        logger.error(f"❌ Error en validación: {str(e)}")
+        logger.error("❌ Error en validación: %s", e)
         return False
 
 async def example_document_processing():
@@ -56,27 +57,27 @@ async def example_document_processing():
         algoritmos que pueden aprender y hacer predicciones basándose en datos.
         """
         
-        # 2. Subir documento a Azure Storage
+        # 2. Extraer texto con Document Intelligence (simulado)
+        # En producción, esto procesaría un PDF o imagen real
+        extracted_text = document_content  # Simulado
+        
+        # 3-4. Subir el documento a Azure Storage y crear los embeddings del texto en paralelo
+        # (son independientes; el índice se actualiza cuando terminan ambos)
         document_name = "ai_document.txt"
-        success = await storage_helper.upload_blob(
-            blob_name=document_name,
-            data=document_content.encode('utf-8')
+        embeddings_client = get_openai_embeddings_client()
+        success, embeddings = await asyncio.gather(
+            storage_helper.upload_blob(
+                blob_name=document_name,
+                data=document_content.encode('utf-8')
+            ),
+            embeddings_client.aembed_query(extracted_text)
         )
         
         if not success:
             raise Exception("Error subiendo documento a Storage")
         
-        logger.info(f"📤 Documento subido: {document_name}")
-        
-        # 3. Extraer texto con Document Intelligence (simulado)
-        # En producción, esto procesaría un PDF o imagen real
-        extracted_text = document_content  # Simulado
-        
-        # 4. Crear embeddings del texto
-        embeddings_client = get_openai_embeddings_client()
-        embeddings = await embeddings_client.aembed_query(extracted_text)
-        
-        logger.info(f"🔢 Embeddings generados: {len(embeddings)} dimensiones")
+        logger.info("📤 Documento subido: %s", document_name)
+        logger.info("🔢 Embeddings generados: %s dimensiones", len(embeddings))
         
         # 5. Crear documento para el índice de búsqueda
         search_document = {
@@ -105,7 +106,7 @@ async def example_document_processing():
         }
         
     except Exception as e:
-        logger.error(f"❌ Error procesando documento: {str(e)}")
+        logger.error("❌ Error procesando documento: %s", e)
         raise
 
 async def example_rag_query():
@@ -116,18 +117,23 @@ async def example_rag_query():
         # 1. Consulta del usuario
         user_query = "¿Qué es la inteligencia artificial?"
         
-        # 2. Generar embeddings de la consulta
-        embeddings_client = get_openai_embeddings_client()
-        query_embeddings = await embeddings_client.aembed_query(user_query)
+        # 2. Generar embeddings de la consulta (solo si el índice tiene campo vectorial;
+        # si no, la búsqueda es por texto y el embedding no se usaría)
+        query_embeddings = None
+        if settings.AZURE_SEARCH_VECTOR_FIELD:
+            embeddings_client = get_openai_embeddings_client()
+            query_embeddings = await embeddings_client.aembed_query(user_query)
         
-        # 3. Buscar documentos similares
-        # En producción, usarías búsqueda vectorial
+        # 3. Buscar documentos similares con búsqueda híbrida (texto + vector),
+        # trayendo solo los campos necesarios
         search_results = await search_helper.search_documents(
             query=user_query,
-            top=3
+            top=3,
+            vector=query_embeddings,
+            select=settings.AZURE_SEARCH_SELECT_FIELDS
         )
         
-        logger.info(f"📚 Documentos encontrados: {len(search_results)}")
+        logger.info("📚 Documentos encontrados: %s", len(search_results))
         
         # 4. Construir contexto con los documentos encontrados
         context = ""
@@ -160,7 +166,7 @@ async def example_rag_query():
         }
         
     except Exception as e:
-        logger.error(f"❌ Error en consulta RAG: {str(e)}")
+        logger.error("❌ Error en consulta RAG: %s", e)
         raise
 
 async def example_list_storage_contents():
@@ -170,15 +176,15 @@ async def example_list_storage_contents():
         
         blobs = await storage_helper.list_blobs()
         
-        logger.info(f"📋 Encontrados {len(blobs)} blobs en el storage")
+        logger.info("📋 Encontrados %s blobs en el storage", len(blobs))
         
         for blob in blobs:
-            logger.info(f"  - {blob}")
+            logger.info("  - %s", blob)
         
         return blobs
         
     except Exception as e:
-        logger.error(f"❌ Error listando storage: {str(e)}")
+        logger.error("❌ Error listando storage: %s", e)
         raise
 
 async def main():
@@ -193,21 +199,25 @@ async def main():
         
         # 2. Procesar documento
         doc_result = await example_document_processing()
-        logger.info(f"✅ Documento procesado: {doc_result}")
+        logger.info("✅ Documento procesado: %s", doc_result)
         
         # 3. Realizar consulta RAG
         rag_result = await example_rag_query()
-        logger.info(f"✅ Consulta RAG completada: {rag_result}")
+        logger.info("✅ Consulta RAG completada: %s", rag_result)
         
         # 4. Listar contenido del storage
         storage_contents = await example_list_storage_contents()
-        logger.info(f"✅ Storage listado: {len(storage_contents)} elementos")
+        logger.info("✅ Storage listado: %s elementos", len(storage_contents))
         
         logger.info("🎉 Todos los ejemplos completados exitosamente!")
         
     except Exception as e:
-        logger.error(f"❌ Error en ejemplos: {str(e)}")
+        logger.error("❌ Error en ejemplos: %s", e)
+    finally:
+        # Cerrar el cliente HTTP compartido antes de que asyncio.run cierre el loop
+        await close_openai_http_client()
 
 if __name__ == "__main__":
+    setup_logging()
     # Ejecutar ejemplos
     asyncio.run(main())
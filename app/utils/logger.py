@@ -2,6 +2,7 @@
 Configuración de logging para mfn-mvp
 """
 
+import functools
 import logging
 import structlog
 from typing import Optional
@@ -10,44 +11,56 @@ from app.config.settings import settings
 def setup_logging(log_level: Optional[str] = None) -> None:
     """
     Configurar el sistema de logging de la aplicación
+    Se llama una sola vez desde cada punto de entrada (API, Function App, ejemplos)
     
     Args:
         log_level: Nivel de logging (DEBUG, INFO, WARNING, ERROR, CRITICAL)
     """
     if log_level is None:
         log_level = settings.LOG_LEVEL
+    level = getattr(logging, log_level.upper())
+    
+    processors = [
+        structlog.stdlib.add_logger_name,
+        structlog.stdlib.add_log_level,
+        structlog.stdlib.PositionalArgumentsFormatter(),
+        structlog.processors.TimeStamper(fmt="iso")
+    ]
+    # El renderizado de stack_info solo se usa al depurar
+    if level <= logging.DEBUG:
+        processors.append(structlog.processors.StackInfoRenderer())
+    processors += [
+        structlog.processors.format_exc_info,
+        structlog.processors.UnicodeDecoder(),
+        structlog.processors.JSONRenderer()
+    ]
     
     # Configurar structlog para logging estructurado
+    # El wrapper filtrante descarta los mensajes por debajo del nivel antes de
+    # ejecutar ningún procesador
     structlog.configure(
-        processors=[
-            structlog.stdlib.filter_by_level,
-            structlog.stdlib.add_logger_name,
-            structlog.stdlib.add_log_level,
-            structlog.stdlib.PositionalArgumentsFormatter(),
-            structlog.processors.TimeStamper(fmt="iso"),
-            structlog.processors.StackInfoRenderer(),
-            structlog.processors.format_exc_info,
-            structlog.processors.UnicodeDecoder(),
-            structlog.processors.JSONRenderer()
-        ],
+        processors=processors,
         context_class=dict,
         logger_factory=structlog.stdlib.LoggerFactory(),
-        wrapper_class=structlog.stdlib.BoundLogger,
+        wrapper_class=structlog.make_filtering_bound_logger(level),
         cache_logger_on_first_use=True,
     )
     
     # Configurar logging estándar
     logging.basicConfig(
         format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-        level=getattr(logging, log_level.upper()),
+        level=level,
         handlers=[
             logging.StreamHandler(),
         ]
     )
 
+@functools.lru_cache(maxsize=None)
 def get_logger(name: str) -> structlog.BoundLogger:
     """
     Obtener un logger configurado para un módulo específico
+    Se memoriza por nombre; debe llamarse una vez por módulo
+    (logger = get_logger(__name__)), nunca dentro de funciones
     
     Args:
         name: Nombre del módulo (generalmente __name__)
@@ -56,6 +69,3 @@ def get_logger(name: str) -> structlog.BoundLogger:
         Logger configurado
     """
     return structlog.get_logger(name)
-
-# Configurar logging al importar el módulo
-setup_logging()